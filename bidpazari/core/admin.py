@@ -1,7 +1,14 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import Item, Transaction, User, UserHasItem
+from .models import (
+    ArchivedAuction,
+    Item,
+    Settlement,
+    Transaction,
+    User,
+    UserHasItem,
+)
 
 admin.site.register(User, UserAdmin)
 
@@ -24,3 +31,13 @@ class TransactionAdmin(admin.ModelAdmin):
 @admin.register(UserHasItem)
 class UserHasItemAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'item', 'is_sold')
+
+
+@admin.register(ArchivedAuction)
+class ArchivedAuctionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'uhi', 'winner', 'winning_amount', 'created')
+
+
+@admin.register(Settlement)
+class SettlementAdmin(admin.ModelAdmin):
+    list_display = ('id', 'key', 'uhi', 'created')
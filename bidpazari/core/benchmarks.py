@@ -0,0 +1,655 @@
+"""
+Benchmarks of the auction runtime. Run them with ``./manage.py benchmark <name>``.
+
+Benchmarks build their users, items and auctions in memory (the model instances are
+never saved), so they can be run against any database without touching it. The
+settlement benchmark, which measures database writes, rolls them back.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, reset_queries
+from django.db.models import Max
+from django.db.transaction import atomic, set_rollback
+from django.test.utils import CaptureQueriesContext
+
+from bidpazari.core.exceptions import (
+    BiddingNotAllowed,
+    InsufficientBalanceError,
+)
+from bidpazari.core.models import Item, Transaction, User, UserHasItem
+from bidpazari.core.runtime.auction import Auction
+from bidpazari.core.runtime.common import RuntimeManager, runtime_manager
+from bidpazari.core.runtime.money import parse_amount, to_cents
+from bidpazari.core.runtime.net.codecs import CODECS, encode_msgpack_default
+from bidpazari.core.runtime.net.decorators import command, make_notification
+from bidpazari.core.runtime.net.metrics import (
+    LatencyRecorder,
+    monitor_loop_lag,
+)
+from bidpazari.core.runtime.net.protocol import COMMANDS
+from bidpazari.core.runtime.shards import ShardPool
+from bidpazari.core.runtime.user import RuntimeUser
+from bidpazari.core.runtime.watchers import ItemWatcher
+
+BENCHMARKS = {}
+
+
+class benchmark:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __call__(self, func):
+        BENCHMARKS[self.name] = func
+        return func
+
+
+def get_benchmark_by_name(name):
+    return BENCHMARKS[name]
+
+
+def make_runtime_user(id_: int, balance=Decimal(0)) -> RuntimeUser:
+    username = f'bench{id_}'
+    runtime_user = RuntimeUser(
+        username,
+        f'{username}@bidpazari.local',
+        password_raw=None,
+        first_name='Bench',
+        last_name=str(id_),
+    )
+    runtime_user.persistent_user = User(
+        id=id_, username=username, first_name='Bench', last_name=str(id_)
+    )
+    runtime_user.initial_balance = balance
+    return runtime_user
+
+
+def make_auction(
+    id_: int, owner: RuntimeUser, bidding_strategy_identifier: str, **kwargs
+) -> Auction:
+    item = Item(id=id_, title=f'Item #{id_}', item_type='Benchmark')
+    uhi = UserHasItem(id=id_, user=owner.persistent_user, item=item)
+    return Auction(uhi, bidding_strategy_identifier, **kwargs)
+
+
+@benchmark('bid_stress')
+def bid_stress(auctions=8, users=64, threads=8, bids_per_thread=2000, shards=0, seed=0):
+    """
+    Hammers increment auctions with bids from many threads and verifies afterwards
+    that no update was lost: every accepted bid is in the bidding history, histories
+    are strictly increasing and every bidder's reservation matches their open bids.
+    With shards > 0 the bids are executed by that many shard workers.
+    """
+    previous_shards = runtime_manager.shards
+    runtime_manager.shards = ShardPool(shards) if shards else None
+
+    try:
+        return _bid_stress(auctions, users, threads, bids_per_thread, seed)
+    finally:
+        runtime_manager.shards = previous_shards
+
+
+def _bid_stress(auctions, users, threads, bids_per_thread, seed):
+    rng = random.Random(seed)
+    owner = make_runtime_user(0)
+    bidders = [
+        make_runtime_user(i, balance=Decimal(10 ** 9)) for i in range(1, users + 1)
+    ]
+    auction_list = [
+        make_auction(
+            i,
+            owner,
+            'increment',
+            initial_price=Decimal(1),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        for i in range(1, auctions + 1)
+    ]
+    for auction in auction_list:
+        auction.start()
+
+    accepted = [[0] * auctions for _ in range(threads)]
+    rejected = [0] * threads
+    plans = [
+        [
+            (rng.randrange(auctions), rng.choice(bidders), rng.randint(1, 3))
+            for _ in range(bids_per_thread)
+        ]
+        for _ in range(threads)
+    ]
+
+    def work(thread_index):
+        for auction_index, bidder, step in plans[thread_index]:
+            auction = auction_list[auction_index]
+            amount = auction.bidding_strategy.highest_bid + step
+            try:
+                auction.bid(bidder, amount)
+            except (BiddingNotAllowed, InsufficientBalanceError):
+                rejected[thread_index] += 1
+            else:
+                accepted[thread_index][auction_index] += 1
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    started_at = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started_at
+
+    violations = []
+
+    for index, auction in enumerate(auction_list):
+        strategy = auction.bidding_strategy
+        history = [amount for _, amount in strategy.bidding_history]
+        accepted_count = sum(counts[index] for counts in accepted)
+
+        if len(history) != accepted_count:
+            violations.append(
+                f'Auction #{auction.id}: {accepted_count} bids accepted, '
+                f'{len(history)} recorded.'
+            )
+        if any(a >= b for a, b in zip(history, history[1:])):
+            violations.append(f'Auction #{auction.id}: history is not increasing.')
+        if history and strategy.highest_bid != history[-1]:
+            violations.append(f'Auction #{auction.id}: highest bid was lost.')
+
+    for bidder in bidders:
+        expected = sum(
+            auction.bidding_strategy.reservations.get(bidder, Decimal(0))
+            for auction in auction_list
+        )
+        if bidder.reserved_balance != expected:
+            violations.append(
+                f'User #{bidder.id}: reserved {bidder.reserved_balance}, '
+                f'open bids {expected}.'
+            )
+
+    total = threads * bids_per_thread
+    return {
+        'bids': total,
+        'accepted': sum(map(sum, accepted)),
+        'rejected': sum(rejected),
+        'seconds': round(elapsed, 3),
+        'bids_per_second': round(total / elapsed),
+        'violations': violations,
+    }
+
+
+@benchmark('login_storm')
+def login_storm(logins=200, concurrency=50, blocking=1):
+    """
+    Fires concurrent password checks (PBKDF2, as in the "login" command) through the
+    command dispatcher and reports how late the event loop wakes up meanwhile. With
+    blocking=0 the checks run on the event loop, as all commands used to.
+    """
+    user = User(username='bench')
+    user.set_password('bench')
+
+    def check_password(context, password):
+        return {'ok': user.check_password(password)}
+
+    handler = command('benchmark_login', blocking=bool(blocking))(check_password)
+    COMMANDS.pop('benchmark_login')
+    lag = LatencyRecorder()
+    latency = LatencyRecorder()
+
+    async def login(semaphore):
+        async with semaphore:
+            started_at = time.perf_counter()
+            await handler(None, password='bench')
+            latency.observe('login', time.perf_counter() - started_at)
+
+    async def storm():
+        semaphore = asyncio.Semaphore(concurrency)
+        monitor = asyncio.ensure_future(monitor_loop_lag(lag, interval=0.01))
+        await asyncio.gather(*(login(semaphore) for _ in range(logins)))
+        await asyncio.sleep(0.05)  # Let the monitor take its last sample
+        monitor.cancel()
+
+    loop = asyncio.new_event_loop()
+    started_at = time.perf_counter()
+    try:
+        loop.run_until_complete(storm())
+    finally:
+        loop.close()
+    elapsed = time.perf_counter() - started_at
+
+    lag_summary = lag.summary().get('event_loop', {})
+    login_summary = latency.summary()['login']
+    return {
+        'logins': logins,
+        'seconds': round(elapsed, 3),
+        'logins_per_second': round(logins / elapsed),
+        'login_p50_ms': login_summary['p50_ms'],
+        'login_p99_ms': login_summary['p99_ms'],
+        'loop_lag_p99_ms': lag_summary.get('p99_ms'),
+        'loop_lag_max_ms': lag_summary.get('max_ms'),
+        'violations': [],
+    }
+
+
+@benchmark('codecs')
+def wire_codecs(auctions=100, rounds=100):
+    """
+    Encodes item notifications (i.e. Auction.to_json() payloads) with every available
+    codec and with the indented, key-sorted JSON used before codecs were introduced.
+    """
+    owner = make_runtime_user(0)
+    notifications = [
+        make_notification(
+            {
+                'domain': 'item',
+                'auction': make_auction(
+                    i,
+                    owner,
+                    'increment',
+                    initial_price=Decimal('5.25'),
+                    minimum_increment=Decimal(1),
+                    maximum_price=None,
+                ).to_json(),
+            }
+        )
+        for i in range(1, auctions + 1)
+    ]
+    encoders = {
+        'pretty_json': lambda obj: json.dumps(
+            obj, indent=4, sort_keys=True, cls=DjangoJSONEncoder
+        ),
+        **{name: codec.encode for name, codec in CODECS.items()},
+    }
+    report = {'frames': auctions * rounds}
+
+    for name, encode in encoders.items():
+        started_at = time.perf_counter()
+        for _ in range(rounds):
+            for notification in notifications:
+                encode(notification)
+        elapsed = time.perf_counter() - started_at
+
+        frames = [encode(notification) for notification in notifications]
+        sizes = [
+            len(frame.encode() if isinstance(frame, str) else frame) for frame in frames
+        ]
+        report[f'{name}_bytes_per_frame'] = round(sum(sizes) / len(sizes))
+        report[f'{name}_us_per_frame'] = round(elapsed / report['frames'] * 10 ** 6, 2)
+
+    report['violations'] = []
+    return report
+
+
+@benchmark('auction_listing')
+def auction_listing(auctions=5000, bids=20, listings=20):
+    """
+    Renders Auction.to_django() for every auction, as the auctions page does, on an
+    unchanged runtime. Only the first listing renders the auctions; the others are
+    served from their cached views.
+    """
+    owner = make_runtime_user(0)
+    bidder = make_runtime_user(1, balance=Decimal(10 ** 9))
+    auction_list = [
+        make_auction(
+            i,
+            owner,
+            'increment',
+            initial_price=Decimal(1),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        for i in range(1, auctions + 1)
+    ]
+    for auction in auction_list:
+        auction.start()
+        for amount in range(2, bids + 2):
+            auction.bid(bidder, Decimal(amount))
+
+    timings = []
+    for _ in range(listings):
+        started_at = time.perf_counter()
+        views = [auction.to_django() for auction in auction_list]
+        timings.append(time.perf_counter() - started_at)
+
+    violations = [
+        f'Auction #{view["id"]}: activity has {len(view["activity"])} entries.'
+        for view in views
+        if len(view['activity']) != bids + 1
+    ]
+    return {
+        'auctions': auctions,
+        'first_listing_ms': round(timings[0] * 1000, 1),
+        'cached_listing_ms': round(min(timings[1:]) * 1000, 1),
+        'violations': violations,
+    }
+
+
+@benchmark('item_watchers')
+def item_watchers(watchers=100000, item_types=1000, wildcards=10, auctions=200):
+    """
+    Announces new auctions to `watchers` item watchers spread over `item_types` item
+    types, plus `wildcards` watchers of every type. Compares the item type index of
+    RuntimeManager with a scan of every watcher, as done before the index.
+    """
+    manager = RuntimeManager()
+    notified = {'indexed': 0, 'scan': 0}
+    mode = 'indexed'
+
+    def callback(auction):
+        notified[mode] += 1
+
+    watcher_list = [
+        ItemWatcher(callback, item_type=f'Type {i % item_types}')
+        for i in range(watchers)
+    ] + [ItemWatcher(callback) for _ in range(wildcards)]
+    started_at = time.perf_counter()
+    for item_watcher in watcher_list:
+        manager.register_item_watcher(item_watcher)
+    register_elapsed = time.perf_counter() - started_at
+
+    owner = make_runtime_user(0)
+    auction_list = []
+    for i in range(auctions):
+        auction = make_auction(
+            i + 1,
+            owner,
+            'increment',
+            initial_price=Decimal(1),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        auction.item.item_type = f'Type {i % item_types}'
+        auction_list.append(auction)
+
+    started_at = time.perf_counter()
+    for auction in auction_list:
+        manager.notify_users_of_new_auction(auction)
+    indexed_elapsed = time.perf_counter() - started_at
+
+    mode = 'scan'
+    started_at = time.perf_counter()
+    for auction in auction_list:
+        for item_watcher in watcher_list:
+            item_watcher.notify(auction)
+    scan_elapsed = time.perf_counter() - started_at
+
+    violations = []
+    if notified['indexed'] != notified['scan']:
+        violations.append(
+            f'Index notified {notified["indexed"]} watchers, scan {notified["scan"]}.'
+        )
+    return {
+        'watchers': len(watcher_list),
+        'notifications': notified['indexed'],
+        'register_ms': round(register_elapsed * 1000, 1),
+        'indexed_us_per_auction': round(indexed_elapsed / auctions * 10 ** 6, 2),
+        'scan_us_per_auction': round(scan_elapsed / auctions * 10 ** 6, 2),
+        'violations': violations,
+    }
+
+
+@benchmark('highest_contribution')
+def highest_contribution(bids=100000, bidders=1000, reads=100, seed=0):
+    """
+    Places many small bids in a highest contribution auction, looking up the winner
+    after each of them as notifications do. Then compares the cost of a winner lookup
+    with that of recomputing every bidder's total from the bidding history, as done
+    before the leaderboard.
+    """
+    rng = random.Random(seed)
+    owner = make_runtime_user(0)
+    bidder_list = [
+        make_runtime_user(i, balance=Decimal(10 ** 9)) for i in range(1, bidders + 1)
+    ]
+    auction = make_auction(
+        1,
+        owner,
+        'highest_contribution',
+        minimum_bid_amount=Decimal(1),
+        maximum_price=Decimal(10 ** 12),
+    )
+    strategy = auction.bidding_strategy
+    auction.start()
+
+    started_at = time.perf_counter()
+    for _ in range(bids):
+        auction.bid(rng.choice(bidder_list), Decimal(rng.randint(1, 5)))
+        strategy.get_current_winner_and_amount()
+    bid_elapsed = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    for _ in range(reads):
+        winner, amount = strategy.get_current_winner_and_amount()
+    read_elapsed = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    for _ in range(reads):
+        totals = {}
+        for bidder, bid_amount in strategy.bidding_history:
+            totals[bidder] = totals.get(bidder, Decimal(0)) + bid_amount
+        recomputed = max(totals.items(), key=lambda bidder_total: bidder_total[1])
+    recompute_elapsed = time.perf_counter() - started_at
+
+    violations = []
+    if (winner, amount) != recomputed:
+        violations.append(f'Leaderboard winner {winner.id} ({amount}) != {recomputed}')
+    return {
+        'bids': bids,
+        'bidders': bidders,
+        'us_per_bid': round(bid_elapsed / bids * 10 ** 6, 2),
+        'winner_lookup_us': round(read_elapsed / reads * 10 ** 6, 2),
+        'recomputed_winner_lookup_us': round(recompute_elapsed / reads * 10 ** 6, 2),
+        'violations': violations,
+    }
+
+
+@benchmark('settlement')
+def settlement(contributors=4000, steps=4, seed=0):
+    """
+    Closes highest contribution auctions with an increasing number of contributors,
+    up to `contributors`, and compares the bulk settlement of the losers with saving
+    their transactions one by one, as done before. Unlike the other benchmarks this
+    one writes to the database, inside a transaction which is rolled back.
+    """
+    rng = random.Random(seed)
+    report = {}
+    violations = []
+
+    with atomic():
+        next_id = (User.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        owner = make_runtime_user(next_id)
+        bidder_list = [
+            make_runtime_user(next_id + i, balance=Decimal(10 ** 6))
+            for i in range(1, contributors + 1)
+        ]
+        User.objects.bulk_create(
+            [runtime_user.persistent_user for runtime_user in [owner, *bidder_list]]
+        )
+
+        for step in range(steps):
+            size = max(1, contributors >> (steps - step - 1))
+            item = Item.objects.create(title=f'Item of {size}', item_type='Benchmark')
+            uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+            auction = Auction(
+                uhi,
+                'highest_contribution',
+                minimum_bid_amount=Decimal(1),
+                maximum_price=Decimal(10 ** 9),
+            )
+            auction.start()
+            for bidder in bidder_list[:size]:
+                auction.bid(bidder, Decimal(rng.randint(1, 5)))
+            price = auction.bidding_strategy.get_current_price()
+            owner_balance = User.objects.get(id=owner.id).balance
+
+            reset_queries()
+            with CaptureQueriesContext(connection) as queries:
+                started_at = time.perf_counter()
+                auction.stop()
+                close_elapsed = time.perf_counter() - started_at
+
+            owner_balance = User.objects.get(id=owner.id).balance - owner_balance
+            if owner_balance != price:
+                violations.append(
+                    f'{size} contributors: owner received {owner_balance} of {price}.'
+                )
+
+            winner, _ = auction.bidding_strategy.get_current_winner_and_amount()
+            losers = [
+                Transaction(
+                    source=bidder.persistent_user,
+                    destination=owner.persistent_user,
+                    amount=amount,
+                    item=item,
+                )
+                for bidder, amount in auction.bidding_strategy.totals_per_bidder.items()
+                if bidder is not winner
+            ]
+            started_at = time.perf_counter()
+            for transaction in losers:
+                transaction.save()
+            per_row_elapsed = time.perf_counter() - started_at
+
+            report[f'close_ms_{size}'] = round(close_elapsed * 1000, 1)
+            report[f'close_queries_{size}'] = len(queries)
+            report[f'per_row_settlement_ms_{size}'] = round(per_row_elapsed * 1000, 1)
+
+        set_rollback(True)
+
+    return {**report, 'violations': violations}
+
+
+@benchmark('money')
+def money(bids=200000, seed=0):
+    """
+    Compares the money bookkeeping of a bid with Decimal amounts, as the runtime does,
+    with the same bookkeeping in integer cents, both as plain ints and as a Money value
+    type: reading the amount off the wire, the reservation of the bidder, the new price
+    and encoding the amounts notified. Each codec's wire format is used as is: JSON
+    carries amounts as decimal numbers and MessagePack as integer cents, so cents are
+    never converted through Decimal. Also times the arithmetic alone, and counts the
+    amounts which Decimal would have read with float artefacts.
+    """
+    rng = random.Random(seed)
+    # Amounts last notified by each bookkeeping run, which must not depend on the
+    # representation
+    notified = {}
+    wire_amounts = {'json': [round(rng.uniform(1, 1000), 2) for _ in range(bids)]}
+    wire_amounts['msgpack'] = [round(amount * 100) for amount in wire_amounts['json']]
+
+    class Money:
+        __slots__ = ('cents',)
+
+        def __init__(self, cents):
+            self.cents = cents
+
+        def __add__(self, other):
+            return Money(self.cents + other.cents)
+
+        def __sub__(self, other):
+            return Money(self.cents - other.cents)
+
+        def __lt__(self, other):
+            return self.cents < other.cents
+
+        def __gt__(self, other):
+            return self.cents > other.cents
+
+    def format_cents(cents):
+        return '%d.%02d' % divmod(cents, 100)
+
+    def identity(amount):
+        return amount
+
+    # Zero, the minimum increment and the balance of the bidder
+    constants = {
+        'decimal': (Decimal(0), Decimal(1), Decimal(10 ** 9)),
+        'cents': (0, 100, 10 ** 11),
+        'money': (Money(0), Money(100), Money(10 ** 11)),
+    }
+    # How amounts are read off the wire and encoded back, by codec
+    edges = {
+        'decimal': {
+            'json': (CODECS['json'].parse_amount, str),
+            # As MessagePackCodec does
+            'msgpack': (
+                lambda cents: parse_amount(Decimal(cents).scaleb(-2)),
+                encode_msgpack_default,
+            ),
+        },
+        'cents': {'json': (to_cents, format_cents), 'msgpack': (identity, identity)},
+        'money': {
+            'json': (
+                lambda amount: Money(to_cents(amount)),
+                lambda amount: format_cents(amount.cents),
+            ),
+            'msgpack': (Money, lambda amount: amount.cents),
+        },
+    }
+
+    def bookkeeping(amounts, parse, encode, zero, increment, balance):
+        reserved, highest = zero, zero
+        for amount in amounts:
+            amount = parse(amount)
+            if amount > balance - reserved or amount - highest < increment:
+                highest = zero
+            reserved += amount - highest
+            highest = amount
+            notified = (encode(amount), encode(highest + increment))
+        return notified
+
+    def timed(key, *args):
+        started_at = time.perf_counter()
+        notified[key] = bookkeeping(*args)
+        return round((time.perf_counter() - started_at) / bids * 10 ** 9)
+
+    report = {
+        'bids': bids,
+        'decimal_from_float_json_ns_per_bid': timed(
+            'decimal_from_float_json',
+            wire_amounts['json'],
+            Decimal,
+            str,
+            *constants['decimal'],
+        ),
+    }
+
+    for codec, amounts in wire_amounts.items():
+        for name, (parse, encode) in ((name, edges[name][codec]) for name in edges):
+            report[f'{name}_{codec}_ns_per_bid'] = timed(
+                f'{name}_{codec}', amounts, parse, encode, *constants[name]
+            )
+
+    for name in edges:
+        parse, _ = edges[name]['msgpack']
+        amounts = [parse(amount) for amount in wire_amounts['msgpack']]
+        report[f'{name}_arithmetic_ns_per_bid'] = timed(
+            f'{name}_arithmetic', amounts, identity, identity, *constants[name]
+        )
+
+    decimal_amounts = [parse_amount(amount) for amount in wire_amounts['json']]
+    # The amounts as the clients wrote them
+    violations = [
+        f'{amount} was read as {decimal}.'
+        for amount, decimal in zip(wire_amounts['json'], decimal_amounts)
+        if decimal != Decimal(repr(amount))
+    ][:10]
+
+    for codec in wire_amounts:
+        amounts = {name: notified[f'{name}_{codec}'] for name in edges}
+
+        if len(set(amounts.values())) > 1:
+            violations.append(f'Amounts notified in {codec} differ: {amounts}')
+
+    return {
+        **report,
+        'float_artefacts': sum(
+            Decimal(amount) != decimal
+            for amount, decimal in zip(wire_amounts['json'], decimal_amounts)
+        ),
+        'violations': violations,
+    }
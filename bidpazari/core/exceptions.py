@@ -9,6 +9,7 @@ class BiddingErrorReason(Enum):
 
 class BiddingNotAllowed(Exception):
     def __init__(self, reason=None):
+        super().__init__(reason)
         self.reason = reason
 
     def __str__(self):
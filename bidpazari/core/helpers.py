@@ -15,10 +15,11 @@ def construct_verification_url(user: User):
 
 def get_auction_or_404(pk):
     from bidpazari.core.runtime.common import runtime_manager
+    from bidpazari.core.runtime.exceptions import AuctionDoesNotExist
 
     try:
-        return runtime_manager.auctions[pk]
-    except KeyError:
+        return runtime_manager.get_auction_by_id(pk)
+    except AuctionDoesNotExist:
         raise Http404("Auction not found.")
 
 
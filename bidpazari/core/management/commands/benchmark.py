@@ -0,0 +1,39 @@
+from django.core.management import BaseCommand, CommandError
+
+from bidpazari.core.benchmarks import BENCHMARKS, get_benchmark_by_name
+
+
+class Command(BaseCommand):
+    help = "Runs a benchmark of the auction runtime and prints its report."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            '--param',
+            action='append',
+            default=[],
+            metavar='KEY=VALUE',
+            help="Overrides an integer parameter of the benchmark.",
+        )
+
+    def handle(self, *args, **options):
+        benchmark = get_benchmark_by_name(options['name'])
+        params = {}
+
+        for param in options['param']:
+            key, _, value = param.partition('=')
+            try:
+                params[key] = int(value)
+            except ValueError:
+                raise CommandError(f'Invalid parameter: {param}')
+
+        report = benchmark(**params)
+        violations = report.pop('violations', [])
+
+        for key, value in report.items():
+            self.stdout.write(f'{key}: {value}')
+
+        if violations:
+            for violation in violations:
+                self.stderr.write(violation)
+            raise CommandError(f'{len(violations)} invariant violations.')
@@ -0,0 +1,52 @@
+from decimal import Decimal
+
+from django.core.management import BaseCommand, CommandError
+from django.db.models import F
+from django.db.transaction import atomic
+
+from bidpazari.core.models import Transaction, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifies the balance column of every user against the sum of their "
+        "transactions, and optionally fixes the users whose balance differs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help="Sets the balance of mismatching users to their ledger balance.",
+        )
+
+    def handle(self, *args, **options):
+        with atomic():
+            ledger_balances = Transaction.objects.get_ledger_balances()
+            mismatches = []
+
+            for user_id, balance in User.objects.values_list('id', 'balance'):
+                ledger_balance = ledger_balances.get(user_id, Decimal(0))
+
+                if balance != ledger_balance:
+                    mismatches.append((user_id, balance, ledger_balance))
+
+            if options['fix']:
+                for user_id, balance, ledger_balance in mismatches:
+                    # Relative update, in case a transaction is being added meanwhile
+                    User.objects.filter(id=user_id).update(
+                        balance=F('balance') + (ledger_balance - balance)
+                    )
+
+        for user_id, balance, ledger_balance in mismatches:
+            self.stderr.write(
+                f'User #{user_id}: balance is {balance}, ledger says {ledger_balance}.'
+            )
+
+        if mismatches and not options['fix']:
+            raise CommandError(f'{len(mismatches)} balances do not match the ledger.')
+
+        if mismatches:
+            self.stdout.write(f'Fixed {len(mismatches)} balances.')
+        else:
+            self.stdout.write('All balances match the ledger.')
@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand
+
+from bidpazari.core.runtime.backends import LocalAuctionBackend
+from bidpazari.core.runtime.broker import BrokerServer
+from bidpazari.core.runtime.common import runtime_manager
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the auction broker, which owns all auctions and serves them to the "
+        "processes configured with the \"broker\" runtime backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=RUNTIME_CONFIG['BROKER_ADDRESS'])
+
+    def handle(self, *args, **options):
+        # The broker is the one process keeping auctions in memory.
+        runtime_manager.backend = LocalAuctionBackend()
+        server = BrokerServer(options['address'], RUNTIME_CONFIG['BROKER_AUTHKEY'])
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.close()
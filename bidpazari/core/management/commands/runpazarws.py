@@ -0,0 +1,82 @@
+import multiprocessing
+import signal
+
+import django
+from django.core.management import BaseCommand, CommandError
+
+from bidpazari.core.runtime.net.constants import WS_CONFIG
+
+
+def run_worker(**server_options):
+    """
+    Entry point of the worker processes. They are spawned rather than forked, so each
+    one sets Django up and starts its own runtime (with its shard and settlement
+    threads, which a forked process would not have).
+    """
+    django.setup()
+
+    from bidpazari.core.runtime.net.websocket import run_pazar_ws
+
+    run_pazar_ws(**server_options)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the WebSocket server as a standalone process. With --workers, several "
+        "processes share the listening port through SO_REUSEPORT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=WS_CONFIG['HOST'])
+        parser.add_argument('--port', type=int, default=WS_CONFIG['PORT'])
+        parser.add_argument('--backlog', type=int, default=WS_CONFIG['BACKLOG'])
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument(
+            '--event-loop',
+            choices=['auto', 'asyncio', 'uvloop'],
+            default=WS_CONFIG['EVENT_LOOP'],
+        )
+        parser.add_argument(
+            '--drain-timeout', type=float, default=WS_CONFIG['DRAIN_TIMEOUT']
+        )
+
+    def handle(self, *args, **options):
+        workers = options.pop('workers')
+        server_options = {
+            'host': options['host'],
+            'port': options['port'],
+            'backlog': options['backlog'],
+            'event_loop': options['event_loop'],
+            'drain_timeout': options['drain_timeout'],
+        }
+
+        if workers < 1:
+            raise CommandError('There must be at least one worker.')
+
+        if workers == 1:
+            from bidpazari.core.runtime.net.websocket import run_pazar_ws
+
+            run_pazar_ws(**server_options)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(
+                target=run_worker, kwargs={**server_options, 'reuse_port': True}
+            )
+            for _ in range(workers)
+        ]
+
+        def stop_workers(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        for process in processes:
+            process.start()
+
+        signal.signal(signal.SIGINT, stop_workers)
+        signal.signal(signal.SIGTERM, stop_workers)
+
+        for process in processes:
+            process.join()
@@ -1,4 +1,8 @@
+from collections import defaultdict
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import Sum
 
 
 class ItemQuerySet(models.QuerySet):
@@ -26,3 +30,22 @@ class UserHasItemQuerySet(models.QuerySet):
         if on_sale is None:
             return self.all()
         return self.filter(item__on_sale=on_sale)
+
+
+class TransactionQuerySet(models.QuerySet):
+    def get_ledger_balances(self):
+        """
+        Returns the balance of every user with transactions, by user ID, as the sum
+        of their incoming minus their outgoing transactions.
+        """
+        balances = defaultdict(Decimal)
+
+        for row in self.values('destination').annotate(total=Sum('amount')):
+            if row['destination'] is not None:
+                balances[row['destination']] += row['total']
+
+        for row in self.values('source').annotate(total=Sum('amount')):
+            if row['source'] is not None:
+                balances[row['source']] -= row['total']
+
+        return dict(balances)
@@ -0,0 +1,16 @@
+from bidpazari.core.runtime.common import runtime_manager
+
+
+class WebSessionMiddleware:
+    """
+    Keeps the users of the web sessions making requests online; see
+    RuntimeManager.connect_session().
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            runtime_manager.connect_session(request.session.session_key, request.user)
+        return self.get_response(request)
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.7 on 2026-10-17 23:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_auto_20200109_1532'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAuction',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('bidding_strategy_identifier', models.CharField(max_length=32)),
+                (
+                    'current_price',
+                    models.DecimalField(decimal_places=2, max_digits=7, null=True),
+                ),
+                (
+                    'winning_amount',
+                    models.DecimalField(decimal_places=2, max_digits=7, null=True),
+                ),
+                ('views', models.TextField()),
+                ('activity', models.TextField(blank=True)),
+                ('history', models.TextField(blank=True)),
+                (
+                    'uhi',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='archived_auctions',
+                        to='core.UserHasItem',
+                    ),
+                ),
+                (
+                    'winner',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name='won_auctions',
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={'abstract': False,},
+        ),
+    ]
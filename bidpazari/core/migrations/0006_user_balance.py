@@ -0,0 +1,39 @@
+# Generated by Django 2.2.7 on 2026-10-17 23:41
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def compute_balances(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    Transaction = apps.get_model('core', 'Transaction')
+
+    for user in User.objects.all():
+        incoming = Transaction.objects.filter(destination=user).aggregate(
+            Sum('amount')
+        )['amount__sum']
+        outgoing = Transaction.objects.filter(source=user).aggregate(Sum('amount'))[
+            'amount__sum'
+        ]
+        user.balance = (incoming or Decimal(0)) - (outgoing or Decimal(0))
+        user.save(update_fields=['balance'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_archivedauction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='balance',
+            field=models.DecimalField(
+                decimal_places=2, default=Decimal('0'), max_digits=12
+            ),
+        ),
+        migrations.RunPython(compute_balances, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,28 @@
 import random
 import string
 import uuid
+from collections import defaultdict
 from decimal import Decimal
 
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Case, F, Sum, Value, When
+from django.db.transaction import atomic, on_commit
+from django.dispatch import Signal
 
 from bidpazari.core.exceptions import InvalidPassword, UserVerificationError
-from bidpazari.core.managers import ItemQuerySet, UserHasItemQuerySet
+from bidpazari.core.managers import (
+    ItemQuerySet,
+    TransactionQuerySet,
+    UserHasItemQuerySet,
+)
+
+CENT = Decimal('0.01')
+BALANCE_UPDATE_BATCH_SIZE = 250
+
+# Sent once new transactions which change the balance of users are committed, with the
+# change of balance of every user by user ID as `deltas`.
+balances_updated = Signal(providing_args=['deltas'])
 
 
 def generate_verification_number():
@@ -35,6 +49,21 @@ class User(TimeStampedModel, AbstractUser):
         max_length=16, default=generate_verification_number, blank=True
     )
     auth_token = models.UUIDField(default=uuid.uuid4, unique=True)
+    # Sum of the user's transactions, updated by Transaction.save.
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+
+    def save(self, *args, **kwargs):
+        """
+        Saving an existing user leaves `balance` out: only Transaction.update_balances
+        writes it, and the instance may hold an outdated copy.
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'balance'
+            ]
+        super().save(*args, **kwargs)
 
     @property
     def runtime_user(self):
@@ -94,7 +123,11 @@ class User(TimeStampedModel, AbstractUser):
         return Item.objects.filter(id__in=item_ids)
 
     @property
-    def balance(self):
+    def ledger_balance(self):
+        """
+        Balance computed from all transactions of the user. `balance` is kept equal
+        to it (see Transaction.save and the reconcilebalances command).
+        """
         incoming_transactions_sum = self.incoming_transactions.aggregate(Sum("amount"))[
             "amount__sum"
         ]
@@ -127,10 +160,12 @@ class User(TimeStampedModel, AbstractUser):
             self.outgoing_transactions.all() | self.incoming_transactions.all()
         ).order_by("id")
         transactions = "\n".join(map(str, all_transactions))
+        # Not self.balance, which may be outdated
+        balance = User.objects.values_list('balance', flat=True).get(id=self.id)
 
         return f"""\
 Transaction History for {self.get_full_name()} (User #{self.id})
-Your Balance: {self.balance}
+Your Balance: {balance}
 
 
 Your Items On Sale
@@ -181,6 +216,84 @@ class Transaction(TimeStampedModel):
         null=True,
     )
 
+    objects = TransactionQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        """
+        Saving a new transaction also moves its amount between the balances of its
+        users, in the same database transaction.
+        """
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        with atomic():
+            deltas = Transaction.update_balances([self])
+            super().save(*args, **kwargs)
+            on_commit(lambda: Transaction.balances_committed([self], deltas))
+
+    @classmethod
+    def create_many(cls, transactions):
+        """
+        Like saving each of the transactions, but with a single insert, a single
+        balance update per user and a single balances_updated signal.
+        """
+        with atomic():
+            deltas = cls.update_balances(transactions)
+            transactions = cls.objects.bulk_create(transactions)
+            on_commit(lambda: cls.balances_committed(transactions, deltas))
+
+        return transactions
+
+    @staticmethod
+    def update_balances(transactions) -> dict:
+        """
+        Applies new transactions to the balances of their users in the database.
+        Returns the change of balance of every user, by user ID.
+        """
+        deltas = defaultdict(Decimal)
+
+        for transaction in transactions:
+            amount = Decimal(transaction.amount).quantize(CENT)
+
+            if transaction.source_id is not None:
+                deltas[transaction.source_id] -= amount
+            if transaction.destination_id is not None:
+                deltas[transaction.destination_id] += amount
+
+        # One UPDATE per batch of users, within the query parameter limits of SQLite
+        user_deltas = list(deltas.items())
+        for i in range(0, len(user_deltas), BALANCE_UPDATE_BATCH_SIZE):
+            batch = user_deltas[i : i + BALANCE_UPDATE_BATCH_SIZE]
+            User.objects.filter(id__in=[user_id for user_id, _ in batch]).update(
+                balance=F('balance')
+                + Case(
+                    *[When(id=user_id, then=Value(delta)) for user_id, delta in batch],
+                    output_field=models.DecimalField(max_digits=12, decimal_places=2),
+                )
+            )
+
+        return dict(deltas)
+
+    @staticmethod
+    def balances_committed(transactions, deltas: dict):
+        """
+        Once the new transactions are committed, applies them to the user instances
+        attached to them as well, and sends balances_updated.
+        """
+        users = {}
+
+        for transaction in transactions:
+            for field in ('source', 'destination'):
+                if transaction._meta.get_field(field).is_cached(transaction):
+                    user = getattr(transaction, field)
+                    if user is not None:
+                        users[id(user)] = user
+
+        for user in users.values():
+            user.balance = user.balance + deltas[user.id]
+
+        balances_updated.send(sender=Transaction, deltas=deltas)
+
     def __str__(self):
         if self.source is None:
             word = "Deposit" if self.amount > 0 else "Withdrawal"
@@ -208,3 +321,48 @@ class UserHasItem(TimeStampedModel):
         return (
             f'{"[SOLD]" if self.is_sold else ""}' f'{self.user} has {self.item.title}'
         )
+
+
+class ArchivedAuction(TimeStampedModel):
+    """
+    Closed auction evicted from the runtime (see RuntimeManager.archive_auction).
+    Keeps what is needed to show the auction read-only: its rendered views, report,
+    activity and history.
+    """
+
+    # An item relisted after an auction gets another auction of the same UHI.
+    uhi = models.ForeignKey(
+        UserHasItem, on_delete=models.CASCADE, related_name="archived_auctions"
+    )
+    bidding_strategy_identifier = models.CharField(max_length=32)
+    winner = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        related_name="won_auctions",
+        blank=True,
+        null=True,
+    )
+    current_price = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    winning_amount = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    # JSON documents; activity and history hold one JSON entry per line.
+    views = models.TextField()
+    activity = models.TextField(blank=True)
+    history = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Archived auction #{self.uhi_id} - {self.uhi.item.title}"
+
+
+class Settlement(TimeStampedModel):
+    """
+    Record of the settlement of a closed auction (see Auction.settle), written along
+    with it. Its key makes settling an auction again, e.g. on a retry, a no-op.
+    """
+
+    key = models.CharField(max_length=32, unique=True)
+    uhi = models.ForeignKey(
+        UserHasItem, on_delete=models.CASCADE, related_name="settlements"
+    )
+
+    def __str__(self):
+        return f"Settlement {self.key} of {self.uhi}"
@@ -0,0 +1,152 @@
+"""
+Activity logs of auctions. The most recent entries of a log are kept in memory; older
+ones are moved, a segment at a time, to append-only JSON-lines files and read back
+from there only when someone pages that far.
+"""
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from itertools import count, islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
+
+temporary_archive_dir = None
+log_ids = count(1)
+
+
+def get_archive_dir():
+    """
+    Returns RUNTIME_CONFIG['ACTIVITY_ARCHIVE_DIR'] or, if it is not set, a temporary
+    directory which lives as long as this process (and its in-memory auctions) does.
+    """
+    global temporary_archive_dir
+
+    if RUNTIME_CONFIG['ACTIVITY_ARCHIVE_DIR']:
+        os.makedirs(RUNTIME_CONFIG['ACTIVITY_ARCHIVE_DIR'], exist_ok=True)
+        return RUNTIME_CONFIG['ACTIVITY_ARCHIVE_DIR']
+
+    if temporary_archive_dir is None:
+        temporary_archive_dir = tempfile.mkdtemp(prefix='bidpazari-activity-')
+        atexit.register(shutil.rmtree, temporary_archive_dir, ignore_errors=True)
+    return temporary_archive_dir
+
+
+def encode_entry(entry) -> str:
+    return json.dumps(entry, separators=(',', ':'), cls=DjangoJSONEncoder)
+
+
+class ActivityLog:
+    """
+    Append-only log holding at most `capacity + segment_size` entries in memory. Once
+    that many are held, the oldest `segment_size` entries are written to a segment
+    file, which is never modified afterwards. Entries read back from segments go
+    through `decode`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        decode=json.loads,
+        capacity=RUNTIME_CONFIG['ACTIVITY_BUFFER_SIZE'],
+        segment_size=RUNTIME_CONFIG['ACTIVITY_SEGMENT_SIZE'],
+    ):
+        self.name = f'{name}-{next(log_ids)}'  # Auction IDs may be reused in tests
+        self.decode = decode
+        self.capacity = capacity
+        self.segment_size = segment_size
+        self.buffer = deque()
+        self.archived = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.archived + len(self.buffer)
+
+    def append(self, entry):
+        with self.lock:
+            self.buffer.append(entry)
+
+            if len(self.buffer) >= self.capacity + self.segment_size:
+                segment = [self.buffer.popleft() for _ in range(self.segment_size)]
+                self.write_segment(self.archived // self.segment_size, segment)
+                self.archived += len(segment)
+
+    def page(self, offset=0, limit=RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']):
+        """
+        Returns up to `limit` entries, newest first, skipping the `offset` newest.
+        """
+        with self.lock:
+            end = self.archived + len(self.buffer) - offset
+            start = max(0, end - limit)
+
+            if end <= 0:
+                return []
+
+            # Part of the page held in the buffer, as buffer indices [oldest, newest)
+            newest = max(0, end - self.archived)
+            oldest = max(0, start - self.archived)
+            entries = list(
+                islice(
+                    reversed(self.buffer),
+                    len(self.buffer) - newest,
+                    len(self.buffer) - oldest,
+                )
+            )
+            archived_end = min(end, self.archived)
+
+        if start < archived_end:
+            entries.extend(reversed(self.read_archived(start, archived_end)))
+
+        return entries
+
+    def __iter__(self):
+        """
+        Iterates over all entries, oldest first.
+        """
+        with self.lock:
+            archived = self.archived
+            buffer = list(self.buffer)
+
+        yield from self.read_archived(0, archived)
+        yield from buffer
+
+    def discard(self):
+        """
+        Empties the log and deletes its segment files.
+        """
+        with self.lock:
+            for index in range(self.archived // self.segment_size):
+                try:
+                    os.remove(self.get_segment_path(index))
+                except FileNotFoundError:
+                    pass
+
+            self.buffer.clear()
+            self.archived = 0
+
+    def get_segment_path(self, index: int):
+        return os.path.join(get_archive_dir(), f'{self.name}.{index:06d}.jsonl')
+
+    def write_segment(self, index: int, entries: list):
+        with open(self.get_segment_path(index), 'w') as segment_file:
+            segment_file.write(''.join(f'{encode_entry(e)}\n' for e in entries))
+
+    def read_archived(self, start: int, end: int):
+        entries = []
+
+        for index in range(
+            start // self.segment_size, (end - 1) // self.segment_size + 1
+        ):
+            with open(self.get_segment_path(index)) as segment_file:
+                segment = [self.decode(line) for line in segment_file]
+
+            offset = index * self.segment_size
+            entries.extend(segment[max(0, start - offset) : end - offset])
+
+        return entries
@@ -0,0 +1,173 @@
+"""
+Archive of closed auctions. Some time after an auction closes, it is rendered one last
+time into an ArchivedAuction row and dropped from memory, so that the runtime only
+holds live auctions. Lookups of archived auctions are served by ArchivedAuctionView.
+"""
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.functional import cached_property
+
+from bidpazari.core.exceptions import BiddingErrorReason, BiddingNotAllowed
+from bidpazari.core.models import ArchivedAuction
+from bidpazari.core.runtime.activity import encode_entry
+from bidpazari.core.runtime.auction import (
+    AuctionStatus,
+    decode_activity,
+    format_history,
+)
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
+from bidpazari.core.runtime.exceptions import InvalidAuctionStatus
+from bidpazari.core.runtime.watchers import AuctionWatcher
+
+# Entries of Auction.to_django() which are not stored but rebuilt from the record.
+DJANGO_VIEW_FIELDS_FROM_RECORD = (
+    'item',
+    'owner',
+    'current_price',
+    'winning_amount',
+    'activity',
+    'activity_count',
+)
+
+
+def archive_auction(auction) -> ArchivedAuction:
+    with auction.lock:
+        winner, amount = auction.bidding_strategy.get_current_winner_and_amount()
+        django = auction.to_django()
+
+        for field in DJANGO_VIEW_FIELDS_FROM_RECORD:
+            del django[field]
+
+        views = {
+            'state': auction.get_state(),
+            'json': auction.to_json(),
+            'django': django,
+            'report': auction.auction_report,
+        }
+
+        return ArchivedAuction.objects.create(
+            uhi=auction.uhi,
+            bidding_strategy_identifier=auction.bidding_strategy_identifier,
+            winner=winner and winner.persistent_user,
+            current_price=auction.bidding_strategy.get_current_price(),
+            winning_amount=amount,
+            views=json.dumps(views, cls=DjangoJSONEncoder),
+            activity=''.join(f'{encode_entry(e)}\n' for e in auction.activity_log_v2),
+            history=''.join(f'{encode_entry(e)}\n' for e in auction.activity_log),
+        )
+
+
+def get_archived_auction(id_: int):
+    """
+    The last archived auction of the given ID; a relisted item has one per auction.
+    """
+    record = (
+        ArchivedAuction.objects.select_related('uhi__user', 'uhi__item', 'winner')
+        .filter(uhi_id=id_)
+        .order_by('-created', '-id')
+        .first()
+    )
+    if record is None:
+        return None
+    return ArchivedAuctionView(record)
+
+
+def page_lines(text: str, decode, offset: int, limit: int):
+    """
+    Like ActivityLog.page, for a log stored as JSON lines.
+    """
+    lines = text.splitlines()
+    end = max(0, len(lines) - offset)
+    return [decode(line) for line in reversed(lines[max(0, end - limit) : end])]
+
+
+class ArchivedAuctionView:
+    """
+    Read-only stand-in for an archived auction, with the reading interface of Auction.
+    Commands fail the same way they would on the closed auction.
+    """
+
+    status = AuctionStatus.CLOSED
+
+    def __init__(self, record: ArchivedAuction):
+        self.record = record
+        self.views = json.loads(record.views)
+
+    @property
+    def id(self):
+        return self.record.uhi_id
+
+    @property
+    def bidding_strategy_identifier(self):
+        return self.record.bidding_strategy_identifier
+
+    @cached_property
+    def owner(self):
+        return self.record.uhi.user
+
+    @cached_property
+    def item(self):
+        return self.record.uhi.item
+
+    def start(self):
+        raise InvalidAuctionStatus(
+            "You can perform this action only on auctions which have not yet been started."
+        )
+
+    def stop(self):
+        raise InvalidAuctionStatus('Auction has already been stopped.')
+
+    def sell(self):
+        self.stop()
+
+    def bid(self, user: "RuntimeUser", amount=None):
+        raise BiddingNotAllowed(BiddingErrorReason.AuctionClosed)
+
+    def register_user_to_updates(self, callback_method, is_alive=None):
+        # Archived auctions do not change anymore.
+        auction_watcher = AuctionWatcher(callback_method, is_alive=is_alive)
+        auction_watcher.cancel()
+        return auction_watcher
+
+    @property
+    def auction_report(self):
+        return self.views['report']
+
+    def get_state(self):
+        return {
+            **self.views['state'],
+            'current_price': self.record.current_price,
+            'winning_amount': self.record.winning_amount,
+        }
+
+    def get_snapshot(self):
+        return {'auction': self.to_json(), 'state': self.get_state()}
+
+    def to_json(self):
+        return dict(self.views['json'])
+
+    def to_django(self):
+        return {
+            **self.views['django'],
+            'item': self.item,
+            'owner': self.owner,
+            'current_price': self.record.current_price,
+            'winning_amount': self.record.winning_amount,
+            'activity': self.get_activity(),
+            'activity_count': len(self.record.activity.splitlines()),
+        }
+
+    def get_activity(self, offset=0, limit=RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']):
+        return page_lines(self.record.activity, decode_activity, offset, limit)
+
+    def get_history(self, offset=0, limit=None):
+        if limit is None:
+            return format_history(map(json.loads, self.record.history.splitlines()))
+        return format_history(
+            reversed(page_lines(self.record.history, json.loads, offset, limit))
+        )
+
+    @property
+    def auction_history(self):
+        return self.get_history()
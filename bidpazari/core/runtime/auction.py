@@ -1,6 +1,10 @@
+import json
+import uuid
 from decimal import Decimal
+from functools import wraps
 
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
 
 from bidpazari.core.exceptions import (
@@ -12,13 +16,61 @@ from bidpazari.core.helpers import (
     get_human_readable_activity_message,
     serialize_user,
 )
-from bidpazari.core.models import Transaction, UserHasItem
+from bidpazari.core.models import Settlement, Transaction, UserHasItem
+from bidpazari.core.runtime.activity import ActivityLog
+from bidpazari.core.runtime.common import runtime_manager
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
 from bidpazari.core.runtime.exceptions import InvalidAuctionStatus
+from bidpazari.core.runtime.settlement import after_settlement, settlement
 from bidpazari.core.runtime.strategies import BiddingStrategyFactory
 from bidpazari.core.runtime.watchers import AuctionWatcher
 from bidpazari.core.templatetags.core.tags import money
 
 
+def auction_command(fn):
+    """
+    Routes the method through RuntimeManager.execute, so that it runs on the shard
+    owning the auction when the runtime is sharded.
+    """
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        return runtime_manager.execute(self.id, fn, self, *args, **kwargs)
+
+    return wrapper
+
+
+def decode_activity(line: str) -> dict:
+    activity = json.loads(line)
+    activity['ts'] = parse_datetime(activity['ts'])
+    return activity
+
+
+def format_history(events) -> str:
+    log_text = "\n".join(events)
+    return f"""\
+Auction History
+===============
+{log_text}"""
+
+
+class RecentActivity:
+    """
+    Newest-first view of an activity log, limited to its `limit` most recent entries.
+    The log is not copied; every iteration reads its current most recent entries.
+    """
+
+    def __init__(self, log: ActivityLog, limit=RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']):
+        self.log = log
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.log.page(0, self.limit))
+
+    def __len__(self):
+        return min(len(self.log), self.limit)
+
+
 class AuctionStatus:
     INITIAL = 'INITIAL'
     OPEN = 'OPEN'
@@ -34,15 +86,32 @@ class Auction:
         )
         self.bidding_strategy.auction = self
         self.status = AuctionStatus.INITIAL
+        # Idempotency key of the auction's settlement, see settle()
+        self.settlement_key = uuid.uuid4().hex
+        # Set once the settlement is announced, which retries must not do again
+        self.settled = False
+        self.seq = 0
+        self.views = {}
+        self.views_version = 0
         self.auction_watchers = []
-        self.activity_log_v2 = []
-        self.activity_log = []  # TODO remove this
+        self.activity_log_v2 = ActivityLog(
+            f'auction-{self.id}-activity', decode=decode_activity
+        )
+        self.activity_log = ActivityLog(f'auction-{self.id}-history')  # TODO remove
         self.log_event("Auction created")
 
     @property
     def id(self):
         return self.uhi.id
 
+    @property
+    def lock(self):
+        """
+        Per-auction lock making bids, ticks, starts and stops linearizable. It may be
+        held while acquiring a bidder's balance lock, never the other way around.
+        """
+        return self.bidding_strategy.lock
+
     @cached_property
     def owner(self):
         return self.uhi.user
@@ -51,83 +120,156 @@ class Auction:
     def item(self):
         return self.uhi.item
 
+    @auction_command
     def start(self):
-        if self.status != AuctionStatus.INITIAL:
-            raise InvalidAuctionStatus(
-                "You can perform this action only on auctions which have not yet been started."
+        with self.lock:
+            if self.status != AuctionStatus.INITIAL:
+                raise InvalidAuctionStatus(
+                    "You can perform this action only on auctions which have not yet been started."
+                )
+
+            self.status = AuctionStatus.OPEN
+            self.bidding_strategy.start()
+            self.on_bidding_updated(
+                type="auction_started",
+                data={'current_price': self.bidding_strategy.get_current_price()},
             )
+            self.log_event("Auction started")
 
-        self.status = AuctionStatus.OPEN
-        self.bidding_strategy.start()
-        self.on_bidding_updated(
-            type="auction_started",
-            data={'current_price': self.bidding_strategy.get_current_price()},
-        )
-        self.log_event("Auction started")
-
+    @auction_command
     def stop(self):
-        self.bidding_strategy.stop()
+        with self.lock:
+            self.bidding_strategy.stop()
 
+    @auction_command
     def sell(self):
-        self.log_event("Auction ended manually by owner")
-        self.stop()
+        with self.lock:
+            self.log_event("Auction ended manually by owner")
+            self.stop()
 
     def on_bidding_updated(self, *args, **kwargs):
+        self.seq += 1
         msg = get_human_readable_activity_message({**kwargs})
         self.activity_log_v2.append({**kwargs, 'ts': timezone.now(), 'msg': msg})
+        self.invalidate_views()
         self.notify_users(*args, **kwargs)
 
     def on_bidding_stopped(self):
         if self.status == AuctionStatus.CLOSED:
             raise InvalidAuctionStatus('Auction has already been stopped.')
 
-        self.status = AuctionStatus.CLOSED
-        self.log_event("Auction stopped")
-
         winner, amount = self.bidding_strategy.get_current_winner_and_amount()
 
-        if winner:
-            UserHasItem.objects.create(user=winner.persistent_user, item=self.item)
-            Transaction.objects.create(
-                source=winner.persistent_user,
-                destination=self.owner,
-                item=self.item,
-                amount=amount,
-            )
+        # Closed right away, but maybe settled later, see RuntimeManager.settle
+        self.status = AuctionStatus.CLOSED
+        self.invalidate_views()
 
-            self.uhi.is_sold = True
-            self.uhi.save()
+        try:
+            runtime_manager.settle(self, winner, amount)
+        except Exception:
+            # Settling on this thread failed, so the auction goes on
+            self.reopen()
+            raise
 
-            self.log_event(
-                f"Winner: {winner.persistent_user.get_full_name()} for amount: {amount}"
+    def reopen(self):
+        """
+        Opens the closed auction again, with its bidding strategy as it was before it
+        stopped, when its settlement failed.
+        """
+        self.status = AuctionStatus.OPEN
+        self.bidding_strategy.reopen()
+        self.invalidate_views()
+
+    def settle(self, winner, amount):
+        """
+        Writes the outcome of the closed auction to the database, then announces it.
+        Only the first settlement of an auction writes anything: it records the
+        auction's settlement key, and retries find it there.
+        """
+        with settlement():
+            _, created = Settlement.objects.get_or_create(
+                key=self.settlement_key, defaults={'uhi': self.uhi}
             )
-        else:
-            self.log_event("Auction reached minimum price with no bidders.")
-
-        self.item.on_sale = False
-        self.item.save()
-
-        self.on_bidding_updated(
-            type="auction_stopped",
-            data={
-                'winner': winner and serialize_user(winner.persistent_user),
-                'amount': amount,
-            },
-        )
 
+            if created:
+                self.bidding_strategy.settle(winner)
+
+                if winner:
+                    UserHasItem.objects.create(
+                        user=winner.persistent_user, item=self.item
+                    )
+                    Transaction.objects.create(
+                        source=winner.persistent_user,
+                        destination=self.owner,
+                        item=self.item,
+                        amount=amount,
+                    )
+
+                    self.uhi.is_sold = True
+                    self.uhi.save(update_fields=['is_sold', 'modified'])
+
+                self.item.on_sale = False
+                self.item.save(update_fields=['on_sale', 'modified'])
+
+            after_settlement(self.on_settled, winner, amount)
+
+    def on_settled(self, winner, amount):
+        with self.lock:
+            if self.settled:
+                return
+            self.settled = True
+
+            self.log_event("Auction stopped")
+            if winner:
+                self.log_event(
+                    f"Winner: {winner.persistent_user.get_full_name()} "
+                    f"for amount: {amount}"
+                )
+            else:
+                self.log_event("Auction reached minimum price with no bidders.")
+
+            self.on_bidding_updated(
+                type="auction_stopped",
+                data={
+                    'winner': winner and serialize_user(winner.persistent_user),
+                    'amount': amount,
+                },
+            )
+            # The winner keeps its reservation until it has paid, so that it cannot
+            # spend the amount elsewhere meanwhile.
+            self.bidding_strategy.release_reservations()
+            runtime_manager.schedule_archive(self)
+
+    def on_settlement_failed(self):
+        """
+        Called when settling in the background failed for good. As when settling on
+        the closing thread fails, the auction goes on, unless the settlement did commit.
+        """
+        if Settlement.objects.filter(key=self.settlement_key).exists():
+            return
+
+        with self.lock:
+            if self.status != AuctionStatus.CLOSED or self.settled:
+                return
+
+            self.reopen()
+            self.log_event("Auction could not be settled, bidding goes on")
+
+    @auction_command
     def bid(self, user: "RuntimeUser", amount=None):
-        if self.status != AuctionStatus.OPEN:
-            raise BiddingNotAllowed(BiddingErrorReason.AuctionClosed)
+        with self.lock:
+            if self.status != AuctionStatus.OPEN:
+                raise BiddingNotAllowed(BiddingErrorReason.AuctionClosed)
 
-        if user.id == self.owner.id:
-            raise BiddingNotAllowed(BiddingErrorReason.OwnAuction)
+            if user.id == self.owner.id:
+                raise BiddingNotAllowed(BiddingErrorReason.OwnAuction)
 
-        try:
-            self.bidding_strategy.bid(user, amount)
-        except InsufficientBalanceError:
-            raise
-        except BiddingNotAllowed:
-            raise
+            try:
+                self.bidding_strategy.bid(user, amount)
+            except InsufficientBalanceError:
+                raise
+            except BiddingNotAllowed:
+                raise
 
     @property
     def auction_report(self):
@@ -151,7 +293,51 @@ Bidding Details
 {data['bidding_details']}
 """
 
+    def get_state(self):
+        """
+        The parts of the auction that change while it runs. `seq` is incremented with
+        every auction event, so watchers receiving only the changed fields of each
+        event can tell whether they missed one.
+        """
+        with self.lock:
+            winner, amount = self.bidding_strategy.get_current_winner_and_amount()
+            return {
+                'id': self.id,
+                'seq': self.seq,
+                'status': self.status,
+                'current_price': self.bidding_strategy.get_current_price(),
+                'winner': winner and serialize_user(winner.persistent_user),
+                'winning_amount': amount,
+            }
+
+    @auction_command
+    def get_snapshot(self):
+        with self.lock:
+            return {'auction': self.to_json(), 'state': self.get_state()}
+
+    def invalidate_views(self):
+        self.views_version += 1
+
+    def get_view(self, name, render):
+        """
+        Returns a copy of the view rendered by `render`, which is only called again
+        once the auction has changed (see invalidate_views).
+        """
+        version = self.views_version
+        cached = self.views.get(name)
+
+        if cached is None or cached[0] != version:
+            cached = self.views[name] = (version, render())
+
+        return dict(cached[1])
+
     def to_json(self):
+        return self.get_view('json', self.render_json)
+
+    def to_django(self):
+        return self.get_view('django', self.render_django)
+
+    def render_json(self):
         (
             current_winner,
             winning_amount,
@@ -181,7 +367,7 @@ Bidding Details
             'bidding_details': self.bidding_strategy.get_tooltip_text(),
         }
 
-    def to_django(self):
+    def render_django(self):
         (
             current_winner,
             winning_amount,
@@ -206,27 +392,48 @@ Bidding Details
             'current_winner': current_winner,
             'current_price': self.bidding_strategy.get_current_price(),
             'winning_amount': winning_amount,
-            'activity': list(reversed(self.activity_log_v2)),
+            'activity': RecentActivity(self.activity_log_v2),
+            'activity_count': len(self.activity_log_v2),
         }
 
-    def register_user_to_updates(self, callback_method):
-        auction_watcher = AuctionWatcher(callback_method)
-        self.auction_watchers.append(auction_watcher)
+    @auction_command
+    def register_user_to_updates(self, callback_method, is_alive=None):
+        """
+        Returns the watcher, whose `cancel()` stops the updates.
+        """
+        auction_watcher = AuctionWatcher(callback_method, is_alive=is_alive)
+
+        with self.lock:
+            self.auction_watchers.append(auction_watcher)
+        return auction_watcher
 
     def notify_users(self, *args, **kwargs):
-        for auction_watcher in self.auction_watchers:
+        active_watchers = [w for w in self.auction_watchers if w.active]
+
+        if len(active_watchers) != len(self.auction_watchers):
+            self.auction_watchers = active_watchers
+
+        for auction_watcher in active_watchers:
             auction_watcher.notify(*args, **kwargs)
 
     def log_event(self, message: str):
         self.activity_log.append(f"{timezone.now()} -- {message}")
 
+    def get_activity(self, offset=0, limit=RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']):
+        return self.activity_log_v2.page(offset, limit)
+
+    def get_history(self, offset=0, limit=None):
+        """
+        Auction history text; with a limit, only the `limit` events before the
+        `offset` most recent ones.
+        """
+        if limit is None:
+            return format_history(self.activity_log)
+        return format_history(reversed(self.activity_log.page(offset, limit)))
+
     @property
     def auction_history(self):
-        log_text = "\n".join(self.activity_log)
-        return f"""\
-Auction History
-===============
-{log_text}"""
+        return self.get_history()
 
     @property
     def initial_price(self):
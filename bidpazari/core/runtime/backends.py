@@ -0,0 +1,257 @@
+import threading
+from multiprocessing.connection import Client
+
+from django.utils.functional import cached_property
+
+from bidpazari.core.models import Item, User
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
+from bidpazari.core.runtime.exceptions import AuctionDoesNotExist
+from bidpazari.core.runtime.watchers import AuctionWatcher
+
+
+def get_auction_backend(config):
+    if config['BACKEND'] == 'broker':
+        return BrokerAuctionBackend(config['BROKER_ADDRESS'], config['BROKER_AUTHKEY'])
+    return LocalAuctionBackend()
+
+
+class LocalAuctionBackend:
+    """
+    Keeps auctions in the memory of the current process. This is the default, and the
+    backend used by the broker process itself.
+    """
+
+    is_remote = False
+
+    def __init__(self):
+        self.auctions = {}
+
+    def get(self, id_: int):
+        return self.auctions[id_]
+
+    def add(self, auction):
+        self.auctions[auction.id] = auction
+
+    def remove(self, id_: int):
+        self.auctions.pop(id_, None)
+
+    def all(self):
+        return list(self.auctions.values())
+
+
+class BrokerClient:
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.connect()
+        return self.local.connection
+
+    def connect(self):
+        return Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    def call(self, method, *args):
+        try:
+            self.connection.send((method, args))
+            ok, result = self.connection.recv()
+        except (EOFError, OSError):
+            # Broker was restarted, reconnect on the next call.
+            self.local.connection = None
+            raise
+
+        if not ok:
+            raise result
+        return result
+
+
+class BrokerAuctionBackend:
+    """
+    Forwards every auction operation to the broker process (see runtime/broker.py),
+    so that all processes using this backend see the same auctions.
+    """
+
+    is_remote = True
+
+    def __init__(self, address, authkey):
+        self.client = BrokerClient(address, authkey)
+        # One proxy per live auction, so that lookups of an auction return the same
+        # object (e.g. to share its broadcast) as long as the broker keeps it.
+        self.auctions = {}
+        self.lock = threading.Lock()
+
+    def get(self, id_: int):
+        try:
+            return self.get_remote_auction(self.client.call('get_auction', id_))
+        except AuctionDoesNotExist:
+            with self.lock:
+                self.auctions.pop(id_, None)
+            raise KeyError(id_)
+
+    def all(self):
+        return [
+            self.get_remote_auction(snapshot)
+            for snapshot in self.client.call('list_auctions')
+        ]
+
+    def create_auction(self, uhi, bidding_strategy_identifier: str, **kwargs):
+        snapshot = self.client.call(
+            'create_auction', uhi.id, bidding_strategy_identifier, kwargs
+        )
+        return self.get_remote_auction(snapshot)
+
+    def apply_balance_deltas(self, deltas: dict):
+        self.client.call('apply_balance_deltas', deltas)
+
+    def get_remote_auction(self, snapshot: dict) -> 'RemoteAuction':
+        """
+        Returns the proxy of the auction, refreshed with the snapshot. A relisted item
+        gets a new auction with the same ID, told apart by its settlement key.
+        """
+        with self.lock:
+            auction = self.auctions.get(snapshot['id'])
+
+            if auction is None or auction.key != snapshot['key']:
+                auction = self.auctions[snapshot['id']] = RemoteAuction(self, snapshot)
+            else:
+                auction.snapshot = snapshot
+            return auction
+
+
+class RemoteBiddingStrategy:
+    def __init__(self, auction: 'RemoteAuction'):
+        self.auction = auction
+
+    def get_current_winner_and_amount(self):
+        from bidpazari.core.runtime.common import runtime_manager
+
+        winner_id = self.auction.snapshot['winner_id']
+
+        if winner_id is None:
+            return None, None
+
+        winner = runtime_manager.get_or_create_runtime_user(
+            User.objects.get(id=winner_id)
+        )
+        return winner, self.auction.snapshot['winning_amount']
+
+    def get_current_price(self):
+        return self.auction.snapshot['current_price']
+
+
+class RemoteAuction:
+    """
+    Proxy of an auction living in the broker process. Reads are served from the
+    snapshot taken by the last call; commands are executed by the broker.
+    """
+
+    def __init__(self, backend: BrokerAuctionBackend, snapshot: dict):
+        self.backend = backend
+        self.snapshot = snapshot
+        self.bidding_strategy = RemoteBiddingStrategy(self)
+
+    @property
+    def id(self):
+        return self.snapshot['id']
+
+    @property
+    def key(self):
+        return self.snapshot['key']
+
+    @property
+    def status(self):
+        return self.snapshot['status']
+
+    @property
+    def bidding_strategy_identifier(self):
+        return self.snapshot['bidding_strategy_identifier']
+
+    @cached_property
+    def owner(self):
+        return User.objects.get(id=self.snapshot['owner_id'])
+
+    @cached_property
+    def item(self):
+        return Item.objects.get(id=self.snapshot['item_id'])
+
+    def _call(self, method, *args):
+        self.snapshot = self.backend.client.call('call_auction', self.id, method, *args)
+
+    def start(self):
+        self._call('start')
+
+    def stop(self):
+        self._call('stop')
+
+    def sell(self):
+        self._call('sell')
+
+    def bid(self, user: "RuntimeUser", amount=None):
+        self._call('bid', user.id, amount)
+
+    def register_user_to_updates(self, callback_method, is_alive=None):
+        """
+        Subscribes to the events of the auction in the broker, over a connection of
+        its own read by a thread. The state of the snapshot follows the events.
+        """
+        auction_watcher = AuctionWatcher(callback_method, is_alive=is_alive)
+        connection = self.backend.client.connect()
+        connection.send(('watch_auction', (self.id,)))
+        ok, error = connection.recv()
+
+        if not ok:
+            connection.close()
+            raise error
+
+        threading.Thread(
+            target=self._receive_updates,
+            args=(connection, auction_watcher),
+            name=f'bidpazari-auction-{self.id}-updates',
+            daemon=True,
+        ).start()
+        return auction_watcher
+
+    def _receive_updates(self, connection, auction_watcher):
+        with connection:
+            while auction_watcher.active:
+                try:
+                    state, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+                self.snapshot['state'] = state
+                self.snapshot['status'] = state['status']
+                auction_watcher.notify(**kwargs)
+
+    @property
+    def auction_report(self):
+        return self.snapshot['auction_report']
+
+    def get_activity(self, offset=0, limit=RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']):
+        return self.backend.client.call(
+            'read_auction', self.id, 'get_activity', offset, limit
+        )
+
+    def get_history(self, offset=0, limit=None):
+        return self.backend.client.call(
+            'read_auction', self.id, 'get_history', offset, limit
+        )
+
+    @property
+    def auction_history(self):
+        return self.get_history()
+
+    def get_state(self):
+        return dict(self.snapshot['state'])
+
+    def get_snapshot(self):
+        return {'auction': self.to_json(), 'state': self.get_state()}
+
+    def to_json(self):
+        return dict(self.snapshot['json'])
+
+    def to_django(self):
+        return dict(self.snapshot['django'])
@@ -0,0 +1,203 @@
+"""
+Auction broker: serves the auctions of one process to other processes (e.g. several
+WSGI workers) over a Unix socket. Processes configured with the "broker" backend talk
+to it through BrokerClient; see BrokerAuctionBackend.
+"""
+import logging
+import os
+import queue
+import threading
+from multiprocessing.connection import Listener
+
+from bidpazari.core.models import User, UserHasItem
+from bidpazari.core.runtime.common import runtime_manager
+from bidpazari.core.runtime.exceptions import AuctionDoesNotExist, BrokerError
+
+logger = logging.getLogger(__name__)
+
+BROKER_METHODS = {}
+AUCTION_METHODS = {'start', 'stop', 'sell', 'bid'}
+AUCTION_READ_METHODS = {'get_activity', 'get_history'}
+
+
+def broker_method(func):
+    BROKER_METHODS[func.__name__] = func
+    return func
+
+
+def snapshot(auction) -> dict:
+    with auction.lock:
+        winner, amount = auction.bidding_strategy.get_current_winner_and_amount()
+        django = auction.to_django()
+        return {
+            'id': auction.id,
+            'key': auction.settlement_key,
+            'status': auction.status,
+            'bidding_strategy_identifier': auction.bidding_strategy_identifier,
+            'owner_id': auction.owner.id,
+            'item_id': auction.item.id,
+            'winner_id': winner and winner.id,
+            'winning_amount': amount,
+            'current_price': auction.bidding_strategy.get_current_price(),
+            'auction_report': auction.auction_report,
+            'state': auction.get_state(),
+            'json': auction.to_json(),
+            'django': {**django, 'activity': list(django['activity'])},
+        }
+
+
+@broker_method
+def get_auction(auction_id):
+    try:
+        auction = runtime_manager.backend.get(auction_id)
+    except KeyError:
+        # Clients read archived auctions from the database themselves.
+        raise AuctionDoesNotExist(f'Auction with ID {auction_id} is not live.')
+    return snapshot(auction)
+
+
+@broker_method
+def list_auctions():
+    return [snapshot(auction) for auction in runtime_manager.list_auctions()]
+
+
+@broker_method
+def create_auction(uhi_id, bidding_strategy_identifier, kwargs):
+    uhi = UserHasItem.objects.select_related('user', 'item').get(id=uhi_id)
+    auction = runtime_manager.create_auction(uhi, bidding_strategy_identifier, **kwargs)
+    return snapshot(auction)
+
+
+@broker_method
+def call_auction(auction_id, method, *args):
+    if method not in AUCTION_METHODS:
+        raise ValueError(f'Auction method is not allowed: {method}')
+
+    auction = runtime_manager.get_auction_by_id(auction_id)
+
+    if method == 'bid':
+        user_id, *args = args
+        user = runtime_manager.get_or_create_runtime_user(User.objects.get(id=user_id))
+        auction.bid(user, *args)
+    else:
+        getattr(auction, method)()
+
+    return snapshot(auction)
+
+
+@broker_method
+def apply_balance_deltas(deltas):
+    runtime_manager.apply_balance_deltas(deltas)
+
+
+@broker_method
+def read_auction(auction_id, method, *args):
+    if method not in AUCTION_READ_METHODS:
+        raise ValueError(f'Auction method is not allowed: {method}')
+
+    return getattr(runtime_manager.get_auction_by_id(auction_id), method)(*args)
+
+
+class BrokerServer:
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.listener = None
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        logger.info(f'Auction broker listening on {self.address}')
+
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:  # Listener was closed
+                return
+            except Exception:
+                logger.exception('Broker connection failed')
+                continue
+
+            threading.Thread(
+                target=self.handle_connection, args=(connection,), daemon=True
+            ).start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+    @staticmethod
+    def handle_connection(connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except EOFError:
+                    return
+
+                if method == 'watch_auction':
+                    # The connection is dedicated to the updates from now on
+                    BrokerServer.stream_auction_updates(connection, *args)
+                    return
+
+                try:
+                    connection.send((True, BROKER_METHODS[method](*args)))
+                except Exception as e:
+                    try:
+                        connection.send((False, e))
+                    except Exception:
+                        # The exception could not be pickled
+                        connection.send((False, BrokerError(repr(e))))
+
+    @staticmethod
+    def stream_auction_updates(connection, auction_id):
+        """
+        Forwards the events of a live auction, each with the auction's state after it,
+        until the client closes the connection (see RemoteAuction's
+        register_user_to_updates).
+        """
+        try:
+            auction = runtime_manager.backend.get(auction_id)
+        except KeyError:
+            error = AuctionDoesNotExist(f'Auction with ID {auction_id} is not live.')
+            connection.send((False, error))
+            return
+
+        updates = queue.SimpleQueue()
+        closed = threading.Event()
+
+        def forward(**kwargs):
+            updates.put((auction.get_state(), kwargs))
+
+        def send_updates():
+            # Sent from a thread of its own, so that a slow client never blocks the
+            # auction.
+            while True:
+                update = updates.get()
+
+                if update is None:
+                    return
+
+                try:
+                    connection.send(update)
+                except (OSError, ValueError):
+                    closed.set()
+                    return
+
+        auction_watcher = auction.register_user_to_updates(
+            forward, is_alive=lambda: not closed.is_set()
+        )
+        connection.send((True, None))
+        threading.Thread(target=send_updates, daemon=True).start()
+
+        try:
+            # The client never sends anything else; this returns when it hangs up.
+            connection.recv()
+        except (EOFError, OSError):
+            pass
+        finally:
+            closed.set()
+            auction_watcher.cancel()
+            updates.put(None)
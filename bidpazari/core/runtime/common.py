@@ -1,25 +1,89 @@
+import logging
+import threading
+import time
+from functools import partial
 from typing import Optional
 
+from django.utils.functional import cached_property
+
 from bidpazari.core.models import User, UserHasItem
+from bidpazari.core.runtime.backends import get_auction_backend
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
 from bidpazari.core.runtime.exceptions import (
     AuctionDoesNotExist,
     ItemAlreadyOnSale,
 )
+from bidpazari.core.runtime.online import OnlineUsers
+from bidpazari.core.runtime.scheduler import Scheduler
+from bidpazari.core.runtime.settlement import SettlementPool
+from bidpazari.core.runtime.shards import ShardPool
+from bidpazari.core.runtime.watchers import ItemWatcherIndex
+
+logger = logging.getLogger(__name__)
 
 
 class RuntimeManager:
     thread = None
 
-    def __init__(self):
-        self.auctions = {}
-        self.item_watchers = []
-        self.online_users = set()
+    def __init__(self, shards=0, backend=None, settlement_workers=0):
+        self.backend = backend or get_auction_backend(RUNTIME_CONFIG)
+        self.item_watchers = ItemWatcherIndex()
+        self.online_users = OnlineUsers()
+        # User IDs, with the time of the last request, by the key of the web session
+        # they are connected for
+        self.web_sessions = {}
+        self.web_sessions_lock = threading.Lock()
+        self.scheduler = Scheduler()
+        self.shards = ShardPool(shards) if shards else None
+        self.settlements = (
+            SettlementPool(
+                settlement_workers,
+                self.scheduler,
+                retries=RUNTIME_CONFIG['SETTLEMENT_RETRIES'],
+                retry_delay=RUNTIME_CONFIG['SETTLEMENT_RETRY_DELAY'],
+            )
+            if settlement_workers
+            else None
+        )
+
+    def execute(self, auction_id: int, fn, *args, **kwargs):
+        """
+        Runs an auction command, on the shard owning the auction if sharding is on.
+        """
+        if self.shards is None:
+            return fn(*args, **kwargs)
+        return self.shards.call(auction_id, fn, *args, **kwargs)
+
+    def dispatch(self, auction_id: int, fn, *args, **kwargs):
+        """
+        Like execute, but does not wait for the command when sharding is on.
+        """
+        if self.shards is None:
+            fn(*args, **kwargs)
+        else:
+            self.shards.dispatch(auction_id, fn, *args, **kwargs)
+
+    def dispatch_later(self, delay: float, auction_id: int, fn, *args):
+        """
+        Dispatches an auction command after `delay` seconds. It never runs on the
+        scheduler's thread, which the calls coming due must not wait for: without
+        sharding, it runs on a worker of its own.
+        """
+        return self.scheduler.call_later(
+            delay, self._dispatch_scheduled, auction_id, fn, *args
+        )
+
+    @cached_property
+    def scheduled_commands(self) -> ShardPool:
+        # Only created (by the scheduler's thread) when sharding is off
+        return ShardPool(1, name='bidpazari-scheduled')
+
+    def _dispatch_scheduled(self, auction_id: int, fn, *args):
+        shards = self.shards if self.shards is not None else self.scheduled_commands
+        shards.dispatch(auction_id, fn, *args)
 
     def get_user_by_id(self, id_: int) -> Optional['RuntimeUser']:
-        for user in self.online_users:
-            if user.id == id_:
-                return user
-        return None
+        return self.online_users.get(id_)
 
     def get_or_create_runtime_user(self, user: User):
         from bidpazari.core.runtime.user import RuntimeUser
@@ -27,22 +91,124 @@ class RuntimeManager:
         runtime_user = self.get_user_by_id(user.id)
 
         if runtime_user is None:
-            runtime_user = RuntimeUser.from_persistent_user(user)
-            runtime_user.connect()
+            runtime_user = self.online_users.add(RuntimeUser.from_persistent_user(user))
 
         return runtime_user
 
+    def connect_user(self, user: User) -> 'RuntimeUser':
+        """
+        Connects the user once more, e.g. when it logs in over another connection,
+        and returns its RuntimeUser.
+        """
+        from bidpazari.core.runtime.user import RuntimeUser
+
+        runtime_user = self.get_user_by_id(user.id)
+
+        if runtime_user is None:
+            runtime_user = RuntimeUser.from_persistent_user(user)
+
+        return self.online_users.connect(runtime_user, reuse=True)
+
+    def connect_session(self, session_key: str, user: User):
+        """
+        Connects the user for a web session, or keeps it connected if it already is.
+        Called on login and on every request of the session (see
+        WebSessionMiddleware), since browsers leave without logging out: the user is
+        disconnected by disconnect_session(), or once the session has made no request
+        for WEB_SESSION_TIMEOUT seconds.
+        """
+        with self.web_sessions_lock:
+            user_id, _ = self.web_sessions.get(session_key, (None, None))
+            self.web_sessions[session_key] = (user.id, time.monotonic())
+
+            if user_id == user.id:
+                return
+            if user_id is None:
+                self.scheduler.call_later(
+                    RUNTIME_CONFIG['WEB_SESSION_TIMEOUT'],
+                    self._expire_session,
+                    session_key,
+                )
+            self.connect_user(user)
+
+        if user_id is not None:
+            self._disconnect_web_user(user_id)
+
+    def disconnect_session(self, session_key: str):
+        with self.web_sessions_lock:
+            user_id, _ = self.web_sessions.pop(session_key, (None, None))
+
+        if user_id is not None:
+            self._disconnect_web_user(user_id)
+
+    def _expire_session(self, session_key: str):
+        with self.web_sessions_lock:
+            if session_key not in self.web_sessions:
+                return
+
+            user_id, last_request = self.web_sessions[session_key]
+            timeout = last_request + RUNTIME_CONFIG['WEB_SESSION_TIMEOUT']
+
+            if timeout > time.monotonic():
+                self.scheduler.call_later(
+                    timeout - time.monotonic(), self._expire_session, session_key
+                )
+                return
+            del self.web_sessions[session_key]
+
+        self._disconnect_web_user(user_id)
+
+    def _disconnect_web_user(self, user_id: int):
+        runtime_user = self.get_user_by_id(user_id)
+
+        if runtime_user is not None:
+            runtime_user.disconnect()
+
+    def apply_balance_deltas(self, deltas: dict):
+        """
+        Applies changes of balance, by user ID, to the users who are online. With the
+        broker backend, they are applied to the broker's users as well, who bid there.
+        """
+        for user_id, delta in deltas.items():
+            runtime_user = self.get_user_by_id(user_id)
+
+            if runtime_user is not None:
+                runtime_user.apply_balance_delta(delta)
+
+        if self.backend.is_remote:
+            try:
+                self.backend.apply_balance_deltas(deltas)
+            except (EOFError, OSError):
+                # The changes are committed; a restarted broker reads them anyway.
+                logger.exception('Could not send balance changes to the broker')
+
     def get_auction_by_id(self, id_: int):
+        """
+        Returns the auction, or a read-only view of it if it has been archived.
+        """
+        from bidpazari.core.runtime.archive import get_archived_auction
+
         try:
-            return self.auctions[id_]
+            return self.backend.get(id_)
         except KeyError as e:
-            raise AuctionDoesNotExist(f'Auction with ID {e} does not exist.')
+            archived_auction = get_archived_auction(id_)
+            if archived_auction is None:
+                raise AuctionDoesNotExist(f'Auction with ID {e} does not exist.')
+            return archived_auction
+
+    def list_auctions(self):
+        return self.backend.all()
 
     def create_auction(
         self, uhi: UserHasItem, bidding_strategy_identifier: str, **kwargs
     ) -> 'Auction':
         from bidpazari.core.runtime.auction import Auction
 
+        if self.backend.is_remote:
+            return self.backend.create_auction(
+                uhi, bidding_strategy_identifier, **kwargs
+            )
+
         if uhi.item.on_sale:
             raise ItemAlreadyOnSale("This item is already on sale!")
 
@@ -51,16 +217,62 @@ class RuntimeManager:
         )
         auction.item.on_sale = True
         auction.item.save()
-        self.auctions[uhi.id] = auction
+        self.backend.add(auction)
         self.notify_users_of_new_auction(auction)
         return auction
 
+    def settle(self, auction, winner, amount):
+        """
+        Settles the closed auction, in the background if there are settlement workers.
+        """
+        if self.settlements is None:
+            auction.settle(winner, amount)
+        else:
+            self.settlements.submit(
+                auction.settle,
+                winner,
+                amount,
+                on_failure=partial(
+                    self.dispatch, auction.id, auction.on_settlement_failed
+                ),
+            )
+
+    def schedule_archive(self, auction):
+        delay = RUNTIME_CONFIG['ARCHIVE_CLOSED_AUCTIONS_AFTER']
+
+        if delay is not None:
+            self.dispatch_later(delay, auction.id, self.archive_auction, auction)
+
+    def archive_auction(self, auction):
+        """
+        Moves a closed auction from memory to the ArchivedAuction table.
+        """
+        from bidpazari.core.runtime.archive import archive_auction
+
+        archive_auction(auction)
+
+        # The item may have been relisted meanwhile, with a new auction of the same ID.
+        try:
+            if self.backend.get(auction.id) is auction:
+                self.backend.remove(auction.id)
+        except KeyError:
+            pass
+        auction.activity_log_v2.discard()
+        auction.activity_log.discard()
+
     def notify_users_of_new_auction(self, auction):
-        for item_watcher in self.item_watchers:
+        for item_watcher in self.item_watchers.get_matching(auction.item.item_type):
             item_watcher.notify(auction)
 
     def register_item_watcher(self, item_watcher):
-        self.item_watchers.append(item_watcher)
+        self.item_watchers.add(item_watcher)
 
+    def unregister_item_watcher(self, item_watcher):
+        item_watcher.cancel()
+        self.item_watchers.discard(item_watcher)
 
-runtime_manager = RuntimeManager()
+
+runtime_manager = RuntimeManager(
+    shards=RUNTIME_CONFIG['SHARDS'],
+    settlement_workers=RUNTIME_CONFIG['SETTLEMENT_WORKERS'],
+)
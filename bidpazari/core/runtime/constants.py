@@ -1 +1,37 @@
+from django.conf import settings
+
 # TODO move auction defaults here
+
+RUNTIME_CONFIG = {
+    # Number of shard threads auctions are hashed onto. Each shard owns its auctions
+    # exclusively and runs their bids, starts, sells, ticks and watches in order.
+    # 0 runs those commands on the calling thread instead.
+    'SHARDS': 0,
+    # Where auctions live: "local" keeps them in this process, "broker" forwards all
+    # auction operations to the process running `./manage.py runpazarbroker`.
+    'BACKEND': 'local',
+    'BROKER_ADDRESS': '/tmp/bidpazari-broker.sock',
+    'BROKER_AUTHKEY': settings.SECRET_KEY.encode(),
+    # Number of most recent activities shown with an auction.
+    'RECENT_ACTIVITY_SIZE': 100,
+    # Activity logs keep their ACTIVITY_BUFFER_SIZE most recent entries in memory and
+    # move older ones to files in ACTIVITY_ARCHIVE_DIR, ACTIVITY_SEGMENT_SIZE entries
+    # per file. Without ACTIVITY_ARCHIVE_DIR, a temporary directory is used.
+    'ACTIVITY_BUFFER_SIZE': 1000,
+    'ACTIVITY_SEGMENT_SIZE': 500,
+    'ACTIVITY_ARCHIVE_DIR': None,
+    # Closed auctions are moved from memory to the ArchivedAuction table this many
+    # seconds after they end, and served read-only from there. None keeps them.
+    'ARCHIVE_CLOSED_AUCTIONS_AFTER': 300,
+    # Number of threads settling closed auctions in the database, so that the command
+    # closing an auction does not wait for it. 0 settles them on the closing thread.
+    # Failed settlements are retried SETTLEMENT_RETRIES times, SETTLEMENT_RETRY_DELAY
+    # seconds apart.
+    'SETTLEMENT_WORKERS': 0,
+    'SETTLEMENT_RETRIES': 3,
+    'SETTLEMENT_RETRY_DELAY': 1.0,
+    # Users logged in on the website stay online until they log out, or until their
+    # session makes no request for this many seconds.
+    'WEB_SESSION_TIMEOUT': 1800,
+    **getattr(settings, 'BIDPAZARI_RUNTIME', {}),
+}
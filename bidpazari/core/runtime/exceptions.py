@@ -8,3 +8,9 @@ class InvalidAuctionStatus(Exception):
 
 class ItemAlreadyOnSale(Exception):
     pass
+
+
+class BrokerError(Exception):
+    """
+    Stands in for an exception raised in the broker which could not be sent over.
+    """
@@ -0,0 +1,38 @@
+"""
+Amounts of money at the edges of the runtime. Clients send amounts as JSON numbers,
+which arrive as floats, and Decimal takes a float with its binary artefacts:
+Decimal(10.1) is 10.0999999999999996447286321199499070644378662109375. Amounts are
+read as a whole number of cents instead, with to_cents() and parse_amount().
+
+Inside the runtime amounts stay Decimal. As the money benchmark shows, plain integer
+cents are cheaper, from the wire back to the wire, but they lose the type the codecs
+tell amounts by (JSON sends Decimals as strings, MessagePack as cents). A Money value
+type in integer cents would keep it, but its arithmetic, in Python, is several times
+slower than Decimal's, which is implemented in C.
+"""
+from decimal import ROUND_HALF_EVEN, Decimal
+
+CENTS_PER_UNIT = 100
+
+
+def to_cents(amount) -> int:
+    """
+    Converts an amount (a Decimal, int, str or float) to cents, rounding to the
+    nearest cent.
+    """
+    if isinstance(amount, float):
+        return round(amount * CENTS_PER_UNIT)
+    return int(
+        (Decimal(amount) * CENTS_PER_UNIT).to_integral_value(rounding=ROUND_HALF_EVEN)
+    )
+
+
+def from_cents(cents: int) -> Decimal:
+    return Decimal(cents).scaleb(-2)
+
+
+def parse_amount(value) -> Decimal:
+    """
+    Reads an amount received over the wire, to the cent.
+    """
+    return from_cents(to_cents(value))
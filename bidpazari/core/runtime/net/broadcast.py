@@ -0,0 +1,97 @@
+import logging
+import threading
+from weakref import WeakValueDictionary
+
+from bidpazari.core.runtime.net.decorators import make_notification
+
+logger = logging.getLogger(__name__)
+
+# A broadcast is kept alive by the auction it watches, and goes away with it.
+auction_broadcasts = WeakValueDictionary()
+auction_broadcasts_lock = threading.Lock()
+
+
+class AuctionBroadcast:
+    """
+    Single watcher of an auction on behalf of every websocket subscribed to it. Each
+    auction event is rendered exactly once and encoded once per codec in use, and the
+    resulting frames are pushed to the outboxes of all subscribers.
+
+    Notifications carry the auction's `id`, its `seq` and only the fields of its state
+    that changed since the previous event (`changes`). A subscriber that sees a gap in
+    `seq` (e.g. because its outbox overflowed) should fetch a snapshot of the auction.
+    """
+
+    def __init__(self, auction):
+        self.auction = auction
+        self.outboxes = []
+        self.outboxes_lock = threading.Lock()
+        self.state = {}
+        auction.register_user_to_updates(self.notify)
+
+    def subscribe(self, outbox):
+        # Outbox lists are replaced rather than changed, notify() may be iterating.
+        with self.outboxes_lock:
+            self.outboxes = [*self.outboxes, outbox]
+
+    def unsubscribe(self, outbox):
+        with self.outboxes_lock:
+            self.outboxes = [o for o in self.outboxes if o is not outbox]
+
+    def prune(self):
+        """
+        Drops the outboxes of closed connections.
+        """
+        with self.outboxes_lock:
+            self.outboxes = [o for o in self.outboxes if not o.closed]
+        return self.outboxes
+
+    def render(self):
+        state = self.auction.get_state()
+        changes = {
+            key: value
+            for key, value in state.items()
+            if key not in ('id', 'seq')
+            and (key not in self.state or self.state[key] != value)
+        }
+        self.state = state
+
+        return {'id': state['id'], 'seq': state['seq'], 'changes': changes}
+
+    def notify(self, **kwargs):
+        outboxes = self.outboxes
+
+        if any(outbox.closed for outbox in outboxes):
+            outboxes = self.prune()
+
+        if not outboxes:
+            return
+
+        frames = {}
+
+        try:
+            notification = make_notification(self.render())
+
+            for outbox in outboxes:
+                if outbox.codec.name not in frames:
+                    frames[outbox.codec.name] = outbox.codec.encode(notification)
+        except Exception:
+            logger.exception(
+                f'Could not render notification of auction {self.auction.id}'
+            )
+            return
+
+        for outbox in outboxes:
+            outbox.push(frames[outbox.codec.name])
+
+
+def get_auction_broadcast(auction) -> AuctionBroadcast:
+    # Watchers of an auction arrive from several threads of the blocking executor
+    with auction_broadcasts_lock:
+        broadcast = auction_broadcasts.get(auction.id)
+
+        # A relisted item gets a new auction with the same ID, while the closed one
+        # may still be around (e.g. waiting to be archived).
+        if broadcast is None or broadcast.auction is not auction:
+            broadcast = auction_broadcasts[auction.id] = AuctionBroadcast(auction)
+        return broadcast
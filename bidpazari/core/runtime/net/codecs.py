@@ -0,0 +1,105 @@
+"""
+Wire encodings of the WebSocket protocol. A connection uses compact JSON unless the
+client picks another codec, either through the WebSocket subprotocol
+(e.g. "bidpazari.msgpack") or with the "hello" command.
+"""
+import json
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from bidpazari.core.runtime.money import parse_amount
+
+CODECS = {}
+
+
+def get_codec(name: str):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unsupported codec: {name}')
+
+
+def get_subprotocols():
+    return [codec.subprotocol for codec in CODECS.values()]
+
+
+def get_codec_by_subprotocol(subprotocol):
+    for codec in CODECS.values():
+        if codec.subprotocol == subprotocol:
+            return codec
+    return CODECS['json']
+
+
+class Codec:
+    name = None
+
+    @property
+    def subprotocol(self):
+        return f'bidpazari.{self.name}'
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, frame):
+        raise NotImplementedError
+
+    def parse_amount(self, value) -> Decimal:
+        """
+        Reads an amount of money received in a frame of this codec.
+        """
+        return parse_amount(value)
+
+
+def register_codec(cls):
+    CODECS[cls.name] = cls()
+    return cls
+
+
+@register_codec
+class JSONCodec(Codec):
+    """
+    Compact JSON (no indentation, no key sorting). Decimals are sent as strings.
+    """
+
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':'), cls=DjangoJSONEncoder)
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def encode_msgpack_default(obj):
+    if isinstance(obj, Decimal):
+        return int((obj * 100).to_integral_value(ROUND_HALF_UP))
+    return DjangoJSONEncoder().default(obj)
+
+
+if msgpack is not None:
+
+    @register_codec
+    class MessagePackCodec(Codec):
+        """
+        Binary MessagePack frames. Amounts of money are integer cents, both ways.
+        """
+
+        name = 'msgpack'
+
+        def encode(self, obj):
+            return msgpack.packb(obj, default=encode_msgpack_default)
+
+        def decode(self, frame):
+            if isinstance(frame, str):
+                raise ValueError('MessagePack frames must be binary.')
+            return msgpack.unpackb(frame, raw=False)
+
+        def parse_amount(self, value) -> Decimal:
+            return parse_amount(Decimal(value).scaleb(-2))
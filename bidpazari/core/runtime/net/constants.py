@@ -10,6 +10,15 @@ TCP_CONFIG = {
 WS_CONFIG = {
     'HOST': '0.0.0.0',
     'PORT': 8765,
+    'BACKLOG': 100,
+    'EVENT_LOOP': 'auto',
+    'DRAIN_TIMEOUT': 10,
+    'OUTBOX_SIZE': 256,
+    'PIPELINE_DEPTH': 64,
+    'MAX_BATCH_SIZE': 1000,
+    'BLOCKING_WORKERS': 8,
+    'METRICS_WINDOW': 1000,
+    'LOOP_LAG_INTERVAL': 0.05,
 }
 
 
@@ -1,26 +1,39 @@
 import asyncio
-import json
-import threading
+import logging
+import time
 from functools import wraps
 
-from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
 from bidpazari.core.runtime.net.constants import CommandCode
 from bidpazari.core.runtime.net.exceptions import CommandFailed
+from bidpazari.core.runtime.net.executor import run_blocking
+from bidpazari.core.runtime.net.metrics import command_latency
+
+logger = logging.getLogger(__name__)
 
 
 class command:
-    def __init__(self, name: str):
+    """
+    Registers a command. Blocking commands (ORM queries, password hashing...) are
+    plain functions and are run in the blocking executor instead of the event loop.
+    """
+
+    def __init__(self, name: str, blocking: bool = False):
         self.name = name
+        self.blocking = blocking
 
     def __call__(self, func):
         from bidpazari.core.runtime.net.protocol import COMMANDS
 
         @wraps(func)
         async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
             try:
-                result_dict = await func(*args, **kwargs)
+                if self.blocking:
+                    result_dict = await run_blocking(func, *args, **kwargs)
+                else:
+                    result_dict = await func(*args, **kwargs)
                 return {
                     "event": self.name,
                     "timestamp": timezone.now().isoformat(),
@@ -41,51 +54,60 @@ class command:
                     "code": CommandCode.FATAL,
                     "error": {"exception": e.__class__.__name__, "message": str(e)},
                 }
+            finally:
+                command_latency.observe(self.name, time.perf_counter() - started_at)
 
         # Register command to COMMANDS
         COMMANDS[self.name] = wrapper
         return wrapper
 
 
+def make_notification(result):
+    return {
+        'event': 'notification',
+        "timestamp": timezone.now().isoformat(),
+        'code': CommandCode.OK,
+        'result': result,
+    }
+
+
 class push_notification:
-    def __init__(self, websocket):
-        self.websocket = websocket
+    def __init__(self, outbox):
+        self.outbox = outbox
 
     def __call__(self, func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            def push():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                asyncio.get_event_loop().run_until_complete(
-                    self.websocket.send(
-                        json.dumps(
-                            {
-                                'event': 'notification',
-                                "timestamp": timezone.now().isoformat(),
-                                'code': CommandCode.OK,
-                                'result': func(*args, **kwargs),
-                            },
-                            cls=DjangoJSONEncoder,
-                            indent=4,
-                            sort_keys=True,
-                        )
-                    )
+            try:
+                frame = self.outbox.codec.encode(
+                    make_notification(func(*args, **kwargs))
                 )
+            except Exception:
+                logger.exception(f'Could not render notification {func.__name__}')
+                return
 
-            thread = threading.Thread(target=push)
-            thread.start()
+            self.outbox.push(frame)
 
         return wrapper
 
 
 def login_required(func):
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        context, *_ = args
-
+    def check_login(context):
         if not context.runtime_user:
             raise CommandFailed("You must log in to perform this action.")
-        return await func(*args, **kwargs)
+
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            check_login(args[0])
+            return await func(*args, **kwargs)
+
+    else:
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            check_login(args[0])
+            return func(*args, **kwargs)
 
     return wrapper
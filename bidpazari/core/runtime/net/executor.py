@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.db import close_old_connections
+
+from bidpazari.core.runtime.net.constants import WS_CONFIG
+
+blocking_executor = None
+
+
+def get_blocking_executor():
+    global blocking_executor
+
+    if blocking_executor is None and WS_CONFIG['BLOCKING_WORKERS']:
+        blocking_executor = ThreadPoolExecutor(
+            max_workers=WS_CONFIG['BLOCKING_WORKERS'],
+            thread_name_prefix='bidpazari-blocking',
+        )
+    return blocking_executor
+
+
+def call_with_db_connection(func, *args, **kwargs):
+    # Same connection housekeeping Django does around every HTTP request.
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function (ORM queries, password hashing...) in the bounded
+    blocking executor, so that it does not hold up the event loop. With
+    BLOCKING_WORKERS set to 0, the function is run inline.
+    """
+    executor = get_blocking_executor()
+
+    if executor is None:
+        return func(*args, **kwargs)
+
+    return await asyncio.get_event_loop().run_in_executor(
+        executor, partial(call_with_db_connection, func, *args, **kwargs)
+    )
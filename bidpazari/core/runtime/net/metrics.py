@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from collections import defaultdict, deque
+
+from bidpazari.core.runtime.net.constants import WS_CONFIG
+
+
+def percentile(samples, fraction: float):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LatencyRecorder:
+    """
+    Keeps the last `window` latency samples (in seconds) of every key, which is enough
+    to report recent percentiles without unbounded memory.
+    """
+
+    def __init__(self, window=WS_CONFIG['METRICS_WINDOW']):
+        self.window = window
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def observe(self, key: str, seconds: float):
+        with self.lock:
+            self.counts[key] += 1
+            self.samples[key].append(seconds)
+
+    def summary(self) -> dict:
+        with self.lock:
+            samples = {key: list(values) for key, values in self.samples.items()}
+            counts = dict(self.counts)
+
+        return {
+            key: {
+                'count': counts[key],
+                'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+                'max_ms': round(max(values) * 1000, 3),
+            }
+            for key, values in samples.items()
+        }
+
+
+command_latency = LatencyRecorder()
+loop_lag = LatencyRecorder()
+
+
+async def monitor_loop_lag(recorder=loop_lag, interval=WS_CONFIG['LOOP_LAG_INTERVAL']):
+    """
+    Measures how late the event loop wakes up from a sleep of `interval` seconds,
+    i.e. how long callbacks were held up by whatever was running on the loop.
+    """
+    loop = asyncio.get_event_loop()
+
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        recorder.observe('event_loop', max(0.0, loop.time() - started_at - interval))
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+import websockets
+
+from bidpazari.core.runtime.net.codecs import get_codec
+from bidpazari.core.runtime.net.constants import WS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Bounded queue of outgoing frames for a single websocket connection. Frames may be
+    pushed from any thread; a single writer task running on the connection's event
+    loop drains the queue into the socket. When the client cannot keep up, the oldest
+    queued frame is dropped.
+    """
+
+    def __init__(
+        self, websocket, loop=None, maxsize=WS_CONFIG['OUTBOX_SIZE'], codec=None
+    ):
+        self.websocket = websocket
+        self.codec = codec or get_codec('json')
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+
+    def push(self, frame):
+        if self.closed:
+            return
+
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, frame)
+        except RuntimeError:  # Event loop is closed
+            self.closed = True
+
+    def _enqueue(self, frame):
+        if self.queue.full():
+            self.queue.get_nowait()
+            logger.warning(f'Outbox of {self.websocket.remote_address} is full.')
+        self.queue.put_nowait(frame)
+
+    async def run(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send(frame)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+
+    def close(self):
+        self.closed = True
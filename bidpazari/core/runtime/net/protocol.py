@@ -1,12 +1,15 @@
+import logging
+import traceback
 from decimal import Decimal
-from typing import Optional, Union
+from functools import partial
+from itertools import count
+from typing import List, Optional, Union
 
 from bidpazari.core.exceptions import (
     BiddingNotAllowed,
     InvalidPassword,
     UserVerificationError,
 )
-from bidpazari.core.helpers import get_human_readable_activity_message
 from bidpazari.core.models import Item, User
 from bidpazari.core.runtime.auction import Auction
 from bidpazari.core.runtime.common import runtime_manager
@@ -15,17 +18,32 @@ from bidpazari.core.runtime.exceptions import (
     InvalidAuctionStatus,
     ItemAlreadyOnSale,
 )
+from bidpazari.core.runtime.net.broadcast import get_auction_broadcast
+from bidpazari.core.runtime.net.codecs import CODECS, Codec, get_codec
+from bidpazari.core.runtime.net.constants import WS_CONFIG, CommandCode
 from bidpazari.core.runtime.net.decorators import (
     command,
     login_required,
     push_notification,
 )
 from bidpazari.core.runtime.net.exceptions import CommandFailed, InvalidCommand
+from bidpazari.core.runtime.net.metrics import command_latency, loop_lag
 from bidpazari.core.runtime.user import RuntimeUser
-from bidpazari.core.templatetags.core.tags import money
+
+logger = logging.getLogger(__name__)
 
 COMMANDS = {}
 
+# Parameters of the bidding strategies that are amounts of money
+AMOUNT_PARAMETERS = {
+    'initial_price',
+    'minimum_increment',
+    'maximum_price',
+    'minimum_price',
+    'price_decrement_rate',
+    'minimum_bid_amount',
+}
+
 
 def get_command_by_identifier(command_identifier):
     try:
@@ -40,13 +58,63 @@ class CommandContext:
     of every command function.
     """
 
-    def __init__(self, websocket=None, runtime_user: RuntimeUser = None):
+    def __init__(
+        self,
+        websocket=None,
+        outbox=None,
+        runtime_user: RuntimeUser = None,
+        codec: Codec = None,
+    ):
         self.websocket = websocket
+        self.outbox = outbox
         self.runtime_user = runtime_user
+        self.codec = codec or get_codec('json')
+        self.subscriptions = {}
+        self.subscription_ids = count(1)
+
+    def add_subscription(self, cancel) -> int:
+        """
+        Keeps the function cancelling a subscription of the connection (e.g. to an
+        auction's notifications), and returns the ID clients can unwatch it with.
+        """
+        subscription_id = next(self.subscription_ids)
+        self.subscriptions[subscription_id] = cancel
+        return subscription_id
+
+    def cancel_subscription(self, subscription_id: int):
+        self.subscriptions.pop(subscription_id)()
+
+    def close(self):
+        """
+        Cancels all subscriptions and logs out; called when the connection is closed.
+        """
+        while self.subscriptions:
+            self.subscriptions.popitem()[1]()
+
+        if self.runtime_user is not None:
+            self.runtime_user.disconnect()
+            self.runtime_user = None
+
+
+@command("hello")
+async def hello(context: CommandContext, codec: str):
+    """
+    Switches the connection to another codec (see runtime/net/codecs.py). The response
+    of this command is already encoded with the new codec.
+    """
+    try:
+        context.codec = get_codec(codec)
+    except ValueError as e:
+        raise CommandFailed(str(e))
+
+    if context.outbox is not None:
+        context.outbox.codec = context.codec
 
+    return {'codec': context.codec.name, 'codecs': sorted(CODECS)}
 
-@command("create_user")
-async def create_user(
+
+@command("create_user", blocking=True)
+def create_user(
     context: CommandContext,
     username: str,
     password: str,
@@ -64,13 +132,12 @@ async def create_user(
         first_name=first_name,
         last_name=last_name,
     )
-    runtime_user = RuntimeUser.from_persistent_user(user)
-    context.runtime_user = runtime_user
+    context.runtime_user = runtime_manager.connect_user(user)
     return {'user': {'id': user.id}}
 
 
-@command("login")
-async def login(context: CommandContext, username: str, password: str):
+@command("login", blocking=True)
+def login(context: CommandContext, username: str, password: str):
     if context.runtime_user:
         raise CommandFailed("You are already logged in!")
 
@@ -79,20 +146,15 @@ async def login(context: CommandContext, username: str, password: str):
     except User.DoesNotExist:
         raise CommandFailed("Incorrect username or password.")
 
-    if user.check_password(password):
-        runtime_user = RuntimeUser.from_persistent_user(user)
-    else:
+    if not user.check_password(password):
         raise CommandFailed("Incorrect username or password.")
 
-    runtime_user.connect()
-    context.runtime_user = runtime_user
-    return {"user": {"id": runtime_user.id}}
+    context.runtime_user = runtime_manager.connect_user(user)
+    return {"user": {"id": user.id}}
 
 
-@command("login_with_auth_token")
-async def login_with_auth_token(
-    context: CommandContext, username: str, auth_token: str
-):
+@command("login_with_auth_token", blocking=True)
+def login_with_auth_token(context: CommandContext, username: str, auth_token: str):
     if context.runtime_user:
         raise CommandFailed("You are already logged in!")
 
@@ -101,21 +163,16 @@ async def login_with_auth_token(
     except User.DoesNotExist:
         raise CommandFailed("Incorrect username or token.")
 
-    if user.check_auth_token(auth_token):
-        runtime_user = RuntimeUser.from_persistent_user(user)
-    else:
+    if not user.check_auth_token(auth_token):
         raise CommandFailed("Incorrect username or token.")
 
-    runtime_user.connect()
-    context.runtime_user = runtime_user
-    return {"user": {"id": runtime_user.id}}
+    context.runtime_user = runtime_manager.connect_user(user)
+    return {"user": {"id": user.id}}
 
 
-@command("change_password")
+@command("change_password", blocking=True)
 @login_required
-async def change_password(
-    context: CommandContext, new_password: str, old_password: str
-):
+def change_password(context: CommandContext, new_password: str, old_password: str):
     """
     Used for changing the password of an already logged in user. If the password is forgotten,
     use the "reset_password" command.
@@ -133,8 +190,8 @@ async def change_password(
     return {'message': 'Your password has been changed.'}
 
 
-@command("reset_password")
-async def reset_password(context: CommandContext, email: str):
+@command("reset_password", blocking=True)
+def reset_password(context: CommandContext, email: str):
     try:
         user = User.objects.get(email=email)
         user.change_password(new_password=None, old_password=None)
@@ -144,9 +201,9 @@ async def reset_password(context: CommandContext, email: str):
         }
 
 
-@command("verify")
+@command("verify", blocking=True)
 @login_required
-async def verify(context: CommandContext, verification_number):
+def verify(context: CommandContext, verification_number):
     user = context.runtime_user
 
     try:
@@ -166,18 +223,18 @@ async def logout(context: CommandContext):
     return {}
 
 
-@command("add_balance")
+@command("add_balance", blocking=True)
 @login_required
-async def add_balance(context: CommandContext, amount: Union[Decimal, float]):
+def add_balance(context: CommandContext, amount: Union[Decimal, float]):
     user = context.runtime_user
-    amount = Decimal(amount)
+    amount = context.codec.parse_amount(amount)
     user.add_balance_transaction(amount)
     return {"current_balance": user.initial_balance}
 
 
-@command("list_items")
+@command("list_items", blocking=True)
 @login_required
-async def list_items(
+def list_items(
     context: CommandContext, item_type: Optional[str], on_sale: Optional[bool]
 ):
     user = context.runtime_user
@@ -197,36 +254,40 @@ async def list_items(
 @command("watch_items")
 @login_required
 async def watch_items(context: CommandContext, item_type: str = None):
-    @push_notification(context.websocket)
+    @push_notification(context.outbox)
     def notify(auction: Auction):
         return {
             'domain': 'item',
             'auction': {**auction.to_json()},
         }
 
-    context.runtime_user.register_item_watcher(notify, item_type=item_type)
+    item_watcher = context.runtime_user.register_item_watcher(
+        notify, item_type=item_type, is_alive=lambda: not context.outbox.closed
+    )
+    subscription_id = context.add_subscription(
+        partial(runtime_manager.unregister_item_watcher, item_watcher)
+    )
 
-    return {}
+    return {'subscription_id': subscription_id}
 
 
-@command("view_transaction_history")
+@command("view_transaction_history", blocking=True)
 @login_required
-async def view_transaction_history(context: CommandContext):
+def view_transaction_history(context: CommandContext):
     user = context.runtime_user
     return {"history": user.transaction_history}
 
 
-@command("create_auction")
+@command("create_auction", blocking=True)
 @login_required
-async def create_auction(
+def create_auction(
     context: CommandContext, item_id: int, bidding_strategy_identifier: str, **kwargs
 ):
     user = context.runtime_user
 
-    # Coerce all floats to decimals
     for key, value in kwargs.items():
-        if isinstance(value, float):
-            kwargs[key] = Decimal(value)
+        if key in AMOUNT_PARAMETERS and value is not None:
+            kwargs[key] = context.codec.parse_amount(value)
 
     try:
         auction_id = user.create_auction(
@@ -241,9 +302,9 @@ async def create_auction(
     return {'auction': {**auction.to_json()}}
 
 
-@command("start_auction")
+@command("start_auction", blocking=True)
 @login_required
-async def start_auction(context: CommandContext, auction_id: int):
+def start_auction(context: CommandContext, auction_id: int):
     user = context.runtime_user
 
     try:
@@ -260,14 +321,14 @@ async def start_auction(context: CommandContext, auction_id: int):
         raise CommandFailed(
             "You must be the owner of the auction to perform this action."
         )
-    return {'auction': {**auction.to_json()}}
+    return {'auction': auction.get_state()}
 
 
-@command("bid")
+@command("bid", blocking=True)
 @login_required
-async def bid(context: CommandContext, auction_id: int, amount: float):
+def bid(context: CommandContext, auction_id: int, amount: float):
     user = context.runtime_user
-    amount = Decimal(amount)
+    amount = context.codec.parse_amount(amount)
 
     try:
         auction = runtime_manager.get_auction_by_id(auction_id)
@@ -276,12 +337,12 @@ async def bid(context: CommandContext, auction_id: int, amount: float):
         raise CommandFailed(f"Could not bid in auction: {e}")
     except BiddingNotAllowed as e:
         raise CommandFailed(f"Bidding not allowed: {e.reason.value}")
-    return {'auction': {**auction.to_json()}}
+    return {'auction': auction.get_state()}
 
 
-@command("sell")
+@command("sell", blocking=True)
 @login_required
-async def sell(context: CommandContext, auction_id: int):
+def sell(context: CommandContext, auction_id: int):
     user = context.runtime_user
 
     try:
@@ -294,39 +355,50 @@ async def sell(context: CommandContext, auction_id: int):
             )
     except AuctionDoesNotExist as e:
         raise CommandFailed(f"Could not end auction: {e}")
-    return {'auction': {**auction.to_json()}}
+    return {'auction': auction.get_state()}
 
 
-@command("watch_auction")
+@command("watch_auction", blocking=True)
 @login_required
-async def watch_auction(context: CommandContext, auction_id: int):
+def watch_auction(context: CommandContext, auction_id: int):
     try:
         auction = runtime_manager.get_auction_by_id(auction_id)
     except AuctionDoesNotExist as e:
         raise CommandFailed(f"Could not watch auction report: {e}")
 
-    @push_notification(context.websocket)
-    def notify(**kwargs):
-        notification_object = {
-            'domain': 'auction',
-            'type': kwargs.get('type'),
-            'data': kwargs.get('data'),
-            'current_price': money(auction.bidding_strategy.current_price),
-        }
-
-        notification_object['msg'] = get_human_readable_activity_message(
-            notification_object
-        )
+    broadcast = get_auction_broadcast(auction)
+    broadcast.subscribe(context.outbox)
+    subscription_id = context.add_subscription(
+        partial(broadcast.unsubscribe, context.outbox)
+    )
+    return {'auction': auction.get_state(), 'subscription_id': subscription_id}
 
-        return notification_object
 
-    auction.register_user_to_updates(notify)
+@command("unwatch")
+async def unwatch(context: CommandContext, subscription_id: int):
+    """
+    Cancels a subscription made by watch_auction or watch_items.
+    """
+    try:
+        context.cancel_subscription(subscription_id)
+    except KeyError:
+        raise CommandFailed(f"Subscription does not exist: {subscription_id}")
     return {}
 
 
-@command("view_auction_report")
+@command("view_auction_snapshot", blocking=True)
+@login_required
+def view_auction_snapshot(context: CommandContext, auction_id: int):
+    try:
+        auction = runtime_manager.get_auction_by_id(auction_id)
+    except AuctionDoesNotExist as e:
+        raise CommandFailed(f"Could not view auction snapshot: {e}")
+    return auction.get_snapshot()
+
+
+@command("view_auction_report", blocking=True)
 @login_required
-async def view_auction_report(context: CommandContext, auction_id: int):
+def view_auction_report(context: CommandContext, auction_id: int):
     try:
         auction = runtime_manager.get_auction_by_id(auction_id)
     except AuctionDoesNotExist as e:
@@ -334,14 +406,62 @@ async def view_auction_report(context: CommandContext, auction_id: int):
     return {'auction': {'report': auction.auction_report}}
 
 
-@command("view_auction_history")
+@command("view_auction_history", blocking=True)
 @login_required
-async def view_auction_history(context: CommandContext, auction_id: int):
+def view_auction_history(
+    context: CommandContext,
+    auction_id: int,
+    offset: int = 0,
+    limit: Optional[int] = None,
+):
+    """
+    Without a limit, returns the whole history. Otherwise, returns the `limit` events
+    preceding the `offset` most recent ones.
+    """
+    for name, value in (('offset', offset), ('limit', 0 if limit is None else limit)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise CommandFailed(
+                f"Could not view auction history: {name} must be a non-negative "
+                f"integer."
+            )
+
     try:
         auction = runtime_manager.get_auction_by_id(auction_id)
     except AuctionDoesNotExist as e:
         raise CommandFailed(f"Could not view auction history: {e}")
-    return {'auction': {'report': auction.auction_history}}
+    return {'auction': {'report': auction.get_history(offset, limit)}}
+
+
+@command("batch")
+async def batch(context: CommandContext, commands: List[dict]):
+    """
+    Runs the given commands one after another with the same context, and returns all
+    of their responses at once. Saves a round trip per command, e.g. for watching
+    many auctions on startup.
+    """
+    if len(commands) > WS_CONFIG['MAX_BATCH_SIZE']:
+        raise CommandFailed(
+            f"A batch can contain at most {WS_CONFIG['MAX_BATCH_SIZE']} commands."
+        )
+
+    results = []
+
+    for request_obj in commands:
+        if isinstance(request_obj, dict) and request_obj.get('command') == 'batch':
+            results.append(get_fatal_result(InvalidCommand('Batches cannot be nested')))
+        else:
+            results.append(await execute_request(context, request_obj))
+
+    return {'results': results}
+
+
+@command("view_server_metrics")
+@login_required
+async def view_server_metrics(context: CommandContext):
+    return {
+        'commands': command_latency.summary(),
+        'event_loop': loop_lag.summary().get('event_loop', {}),
+    }
 
 
 def extract_request_data(request_obj):
@@ -351,3 +471,28 @@ def extract_request_data(request_obj):
     except KeyError as e:
         raise InvalidCommand(f'Command has missing key: {e}')
     return command_identifier, params
+
+
+def get_fatal_result(e: Exception):
+    return {
+        'code': CommandCode.FATAL,
+        'error': {'exception': e.__class__.__name__, 'message': str(e)},
+    }
+
+
+async def execute_request(context, request_obj):
+    try:
+        command_identifier, params = extract_request_data(request_obj)
+        command_handler = get_command_by_identifier(command_identifier)
+        command_result = await command_handler(context, **params)
+    except InvalidCommand as e:
+        command_result = get_fatal_result(e)
+    except Exception as e:
+        logger.error(f'Unexpected exception: {e}')
+        command_result = get_fatal_result(e)
+        traceback.print_tb(e.__traceback__)
+
+    if isinstance(request_obj, dict) and 'request_id' in request_obj:
+        command_result = {**command_result, 'request_id': request_obj['request_id']}
+
+    return command_result
@@ -1,57 +1,257 @@
 import asyncio
-import json
 import logging
-import traceback
-from json import JSONDecodeError
+import signal
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
 
 import websockets
-from django.core.serializers.json import DjangoJSONEncoder
 
-from bidpazari.core.runtime.net.constants import WS_CONFIG, CommandCode
-from bidpazari.core.runtime.net.exceptions import InvalidCommand
+from bidpazari.core.runtime.net.codecs import (
+    get_codec_by_subprotocol,
+    get_subprotocols,
+)
+from bidpazari.core.runtime.net.constants import WS_CONFIG
+from bidpazari.core.runtime.net.metrics import monitor_loop_lag
+from bidpazari.core.runtime.net.outbox import Outbox
 from bidpazari.core.runtime.net.protocol import (
     CommandContext,
-    extract_request_data,
-    get_command_by_identifier,
+    execute_request,
+    get_fatal_result,
 )
 
 logger = logging.getLogger(__name__)
 
 
-def start_pazar_ws():
-    start_ws = websockets.serve(
-        handle_commands_ws, WS_CONFIG['HOST'], WS_CONFIG['PORT']
+def new_event_loop(name=WS_CONFIG['EVENT_LOOP']):
+    """
+    Creates an event loop of the given kind: "asyncio", "uvloop", or "auto" for
+    uvloop when it is installed and asyncio otherwise.
+    """
+    if name in ('auto', 'uvloop'):
+        try:
+            import uvloop
+        except ImportError:
+            if name == 'uvloop':
+                raise
+        else:
+            return uvloop.new_event_loop()
+
+    return asyncio.new_event_loop()
+
+
+class ServerState:
+    """
+    Commands being run by the WebSocket server of this process. A server being stopped
+    accepts no more connections nor commands, and waits for these to finish before
+    closing the connections (see run_pazar_ws).
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.stopping = False
+
+    @contextmanager
+    def command(self):
+        self.commands += 1
+        try:
+            yield
+        finally:
+            self.commands -= 1
+
+    async def drain(self, server, timeout: float) -> bool:
+        """
+        Stops accepting connections and commands, and waits up to `timeout` seconds for
+        the running commands to finish. Returns whether they all did.
+        """
+        self.stopping = True
+        server.server.close()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+
+        while self.commands and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        return not self.commands
+
+
+server_state = ServerState()
+
+
+def serve_pazar_ws(
+    host=WS_CONFIG['HOST'],
+    port=WS_CONFIG['PORT'],
+    backlog=WS_CONFIG['BACKLOG'],
+    reuse_port=False,
+):
+    return websockets.serve(
+        handle_commands_ws,
+        host,
+        port,
+        subprotocols=get_subprotocols(),
+        backlog=backlog,
+        reuse_port=reuse_port,
     )
-    asyncio.get_event_loop().run_until_complete(start_ws)
+
+
+def start_pazar_ws():
+    asyncio.get_event_loop().run_until_complete(serve_pazar_ws())
+    asyncio.ensure_future(monitor_loop_lag())
     asyncio.get_event_loop().run_forever()
 
 
-def encode_response_ws(response_dict):
-    return json.dumps(response_dict, indent=4, sort_keys=True, cls=DjangoJSONEncoder)
+def run_pazar_ws(
+    host=WS_CONFIG['HOST'],
+    port=WS_CONFIG['PORT'],
+    backlog=WS_CONFIG['BACKLOG'],
+    reuse_port=False,
+    event_loop=WS_CONFIG['EVENT_LOOP'],
+    drain_timeout=WS_CONFIG['DRAIN_TIMEOUT'],
+):
+    """
+    Runs the WebSocket server in the current (main) thread until SIGINT or SIGTERM.
+    It then stops accepting connections and commands, gives the running commands
+    `drain_timeout` seconds to finish and send their responses, and closes the
+    connections.
+    """
+    loop = new_event_loop(event_loop)
+    asyncio.set_event_loop(loop)
+    stopped = asyncio.Event()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    server = loop.run_until_complete(
+        serve_pazar_ws(host, port, backlog=backlog, reuse_port=reuse_port)
+    )
+    lag_monitor = loop.create_task(monitor_loop_lag())
+    logger.info(f'WebSocket server listening on {host}:{port}')
+
+    try:
+        loop.run_until_complete(stopped.wait())
+        logger.info('Draining WebSocket connections...')
+        if not loop.run_until_complete(server_state.drain(server, drain_timeout)):
+            logger.warning('Some commands did not finish in time')
+        server.close()
+        loop.run_until_complete(asyncio.wait_for(server.wait_closed(), drain_timeout))
+    except asyncio.TimeoutError:
+        logger.warning('Some WebSocket connections did not close in time')
+    finally:
+        lag_monitor.cancel()
+        loop.run_until_complete(asyncio.gather(lag_monitor, return_exceptions=True))
+        loop.close()
 
 
 async def handle_commands_ws(websocket, path):
-    context = CommandContext(websocket=websocket)
-    command_result = {}
+    codec = get_codec_by_subprotocol(websocket.subprotocol)
+    outbox = Outbox(websocket, codec=codec)
+    writer = asyncio.ensure_future(outbox.run())
+    context = CommandContext(websocket=websocket, outbox=outbox, codec=codec)
+    query = parse_qs(urlsplit(path).query)
+
+    try:
+        if query.get('mode') == ['pipelined']:
+            await process_commands_pipelined_ws(websocket, context)
+        else:
+            await process_commands_ws(websocket, context)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        context.close()
+        outbox.close()
+        writer.cancel()
+
 
+async def process_commands_ws(websocket, context):
     while request := await websocket.recv():
+        if server_state.stopping:
+            break
+
+        with server_state.command():
+            try:
+                request_obj = context.codec.decode(request)
+            except ValueError as e:
+                command_result = get_fatal_result(e)
+            else:
+                command_result = await execute_request(context, request_obj)
+
+            await websocket.send(context.codec.encode(command_result))
+
+
+async def process_commands_pipelined_ws(websocket, context):
+    pipeline = CommandPipeline(websocket, context)
+
+    try:
+        while request := await websocket.recv():
+            if server_state.stopping:
+                break
+            await pipeline.submit(request)
+    finally:
+        await pipeline.drain()
+
+
+def get_ordering_key(request_obj):
+    """
+    Requests about one auction must run in the order they were sent; anything else
+    (e.g. logging in) may change the connection's state and runs on its own.
+    """
+    try:
+        key = request_obj['params']['auction_id']
+        hash(key)
+    except (TypeError, KeyError):
+        return None
+    return key
+
+
+class CommandPipeline:
+    """
+    Runs the requests of one connection concurrently (up to `depth` at a time) while
+    keeping the order of requests about the same auction. Responses are sent as soon
+    as they are ready, so clients match them through their "request_id".
+    """
+
+    def __init__(self, websocket, context, depth=WS_CONFIG['PIPELINE_DEPTH']):
+        self.websocket = websocket
+        self.context = context
+        self.semaphore = asyncio.Semaphore(depth)
+        self.tails = {}
+        self.pending = set()
+
+    async def submit(self, request):
         try:
-            request_obj = json.loads(request)
-            command_identifier, params = extract_request_data(request_obj)
-            command_handler = get_command_by_identifier(command_identifier)
-            command_result = await command_handler(context, **params)
-        except (JSONDecodeError, InvalidCommand) as e:
-            command_result = {
-                'code': CommandCode.FATAL,
-                'error': {'exception': e.__class__.__name__, 'message': str(e)},
-            }
-        except Exception as e:
-            logger.error(f'Unexpected exception: {e}')
-            command_result = {
-                'code': CommandCode.FATAL,
-                'error': {'exception': e.__class__.__name__, 'message': str(e)},
-            }
-            traceback.print_tb(e.__traceback__)
-        finally:
-            response = encode_response_ws(command_result)
-            await websocket.send(response)
+            request_obj = self.context.codec.decode(request)
+        except ValueError as e:
+            await self.websocket.send(self.context.codec.encode(get_fatal_result(e)))
+            return
+
+        key = get_ordering_key(request_obj)
+
+        if key is None:
+            await self.drain()
+            await self.run(None, request_obj)
+            return
+
+        await self.semaphore.acquire()
+        task = asyncio.ensure_future(self.run(self.tails.get(key), request_obj))
+        task.add_done_callback(partial(self._forget, key))
+        self.tails[key] = task
+        self.pending.add(task)
+
+    async def drain(self):
+        if self.pending:
+            await asyncio.wait(self.pending)
+
+    async def run(self, previous, request_obj):
+        with server_state.command():
+            if previous is not None:
+                await asyncio.wait([previous])
+
+            command_result = await execute_request(self.context, request_obj)
+            await self.websocket.send(self.context.codec.encode(command_result))
+
+    def _forget(self, key, task):
+        self.pending.discard(task)
+        self.semaphore.release()
+
+        if self.tails.get(key) is task:
+            del self.tails[key]
@@ -0,0 +1,82 @@
+import threading
+from typing import Optional
+
+
+class OnlineUsers:
+    """
+    Runtime users who are logged in, by user ID. Every login (a websocket connection,
+    a web session) connects the user and every logout disconnects it. All of a user's
+    connections share one RuntimeUser, and with it its reserved balance, and the user
+    stays online until the last of them is gone. A user who still has balance reserved
+    for its bids stays until the reservations are released too, so that it cannot
+    reconnect and spend the reserved amount again.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.users.values()))
+
+    def __contains__(self, runtime_user):
+        return runtime_user.id in self.users
+
+    def get(self, id_: int) -> Optional['RuntimeUser']:
+        return self.users.get(id_)
+
+    def connect(self, runtime_user: 'RuntimeUser', reuse=False) -> 'RuntimeUser':
+        """
+        Adds a connection of the user and returns the RuntimeUser its connections
+        share from now on: the given one or, with `reuse`, the one the user is
+        already online with, if any.
+        """
+        with self.lock:
+            if reuse:
+                runtime_user = self.users.setdefault(runtime_user.id, runtime_user)
+            else:
+                self.users[runtime_user.id] = runtime_user
+            self.connections[runtime_user.id] = (
+                self.connections.get(runtime_user.id, 0) + 1
+            )
+            return runtime_user
+
+    def add(self, runtime_user: 'RuntimeUser') -> 'RuntimeUser':
+        """
+        Like connect(reuse=True), without adding a connection: the user is dropped as
+        soon as it is idle.
+        """
+        with self.lock:
+            return self.users.setdefault(runtime_user.id, runtime_user)
+
+    def disconnect(self, runtime_user: 'RuntimeUser'):
+        with self.lock:
+            connections = self.connections.get(runtime_user.id, 0) - 1
+
+            if connections > 0:
+                self.connections[runtime_user.id] = connections
+            else:
+                self.connections.pop(runtime_user.id, None)
+                self._drop_if_idle(runtime_user.id)
+
+    def release(self, runtime_user: 'RuntimeUser'):
+        """
+        Called when the reservations of the user are released.
+        """
+        with self.lock:
+            self._drop_if_idle(runtime_user.id)
+
+    def _drop_if_idle(self, id_: int):
+        runtime_user = self.users.get(id_)
+
+        if (
+            runtime_user is not None
+            and id_ not in self.connections
+            and not runtime_user.reserved_balance
+        ):
+            del self.users[id_]
@@ -0,0 +1,97 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledCall:
+    def __init__(self, deadline, callback, args, kwargs):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        self.callback(*self.args, **self.kwargs)
+
+
+class Scheduler:
+    """
+    Runs delayed callbacks from a single daemon thread. Pending calls are kept in a
+    heap ordered by deadline; cancelled calls are skipped lazily when they reach the
+    top, so cancellation is O(1) and each wakeup only touches expired calls.
+    """
+
+    def __init__(self, name='bidpazari-scheduler'):
+        self.name = name
+        self.thread = None
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def call_later(self, delay: float, callback, *args, **kwargs) -> ScheduledCall:
+        scheduled_call = ScheduledCall(time.monotonic() + delay, callback, args, kwargs)
+
+        with self._condition:
+            heapq.heappush(
+                self._heap,
+                (scheduled_call.deadline, next(self._counter), scheduled_call),
+            )
+            self._ensure_started()
+            self._condition.notify()
+
+        return scheduled_call
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for *_, call in self._heap if not call.cancelled)
+
+    def _ensure_started(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True
+            )
+            self.thread.start()
+
+    def _pop_expired(self):
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                deadline = self._heap[0][0]
+                timeout = deadline - time.monotonic()
+
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+
+                expired = []
+                now = time.monotonic()
+
+                while self._heap and self._heap[0][0] <= now:
+                    *_, scheduled_call = heapq.heappop(self._heap)
+                    if not scheduled_call.cancelled:
+                        expired.append(scheduled_call)
+                return expired
+
+    def _run(self):
+        while True:
+            for scheduled_call in self._pop_expired():
+                if scheduled_call.cancelled:
+                    continue
+                try:
+                    scheduled_call.run()
+                except Exception:
+                    logger.exception(f'Scheduled call {scheduled_call.callback} failed')
@@ -0,0 +1,100 @@
+"""
+Settlement of closed auctions. The database writes of closing an auction (the item
+changing hands, the transactions of the winner and of the losers) are made in a single
+database transaction, so that a failure midway leaves none of them behind. The runtime
+side effects of the settlement (balances of online users, notifications, scheduling
+the archive) are deferred meanwhile with transaction.on_commit(), and applied only once
+the outermost transaction commits.
+
+With RUNTIME_CONFIG['SETTLEMENT_WORKERS'], auctions are settled by a SettlementPool,
+off the thread of the command which closed them.
+"""
+import logging
+import queue
+import threading
+from functools import partial
+
+from django.db import close_old_connections
+from django.db.transaction import atomic, on_commit
+
+logger = logging.getLogger(__name__)
+
+
+def settlement():
+    """
+    Runs the block in a database transaction. The side effects deferred with
+    after_settlement() within it run once the outermost transaction commits, and are
+    dropped if it rolls back.
+    """
+    return atomic()
+
+
+def after_settlement(func, *args, **kwargs):
+    """
+    Calls the function once the current database transaction commits, or right away
+    outside of one.
+    """
+    on_commit(partial(func, *args, **kwargs))
+
+
+class SettlementPool:
+    """
+    Threads running settlements in the background. A failed settlement is submitted
+    again after `retry_delay` seconds, up to `retries` times; settlements are
+    idempotent (see Auction.settle), so retrying one which did commit does no harm.
+    Once the retries are exhausted, `on_failure` is called.
+    """
+
+    def __init__(self, workers: int, scheduler, retries=3, retry_delay=1.0):
+        self.scheduler = scheduler
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.SimpleQueue()
+        self.threads = [
+            threading.Thread(
+                target=self._run, name=f'bidpazari-settlement-{index}', daemon=True
+            )
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self.threads)
+
+    def submit(self, fn, *args, on_failure=None, attempt=1):
+        self.queue.put((fn, args, on_failure, attempt))
+
+    def _run(self):
+        while True:
+            fn, args, on_failure, attempt = self.queue.get()
+
+            try:
+                fn(*args)
+            except Exception:
+                if attempt > self.retries:
+                    logger.exception('Settlement failed %d times, giving up', attempt)
+                    self._give_up(on_failure)
+                else:
+                    logger.warning('Settlement failed, retrying', exc_info=True)
+                    self.scheduler.call_later(
+                        self.retry_delay,
+                        self.submit,
+                        fn,
+                        *args,
+                        on_failure=on_failure,
+                        attempt=attempt + 1,
+                    )
+            finally:
+                # Drops the connection if it broke, as a request would
+                close_old_connections()
+
+    @staticmethod
+    def _give_up(on_failure):
+        if on_failure is None:
+            return
+
+        try:
+            on_failure()
+        except Exception:
+            logger.exception('Could not handle the failed settlement')
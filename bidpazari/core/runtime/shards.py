@@ -0,0 +1,79 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class ShardWorker:
+    """
+    Single thread consuming a command queue. Every auction hashed onto this shard is
+    only ever mutated from here, so commands on one auction run in arrival order.
+    """
+
+    def __init__(self, index: int, name='bidpazari-shard'):
+        self.index = index
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self._run, name=f'{name}-{index}', daemon=True
+        )
+        self.thread.start()
+
+    @property
+    def is_current(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            future, fn, args, kwargs = self.queue.get()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class ShardPool:
+    def __init__(self, shards: int, name='bidpazari-shard'):
+        self.workers = [ShardWorker(index, name=name) for index in range(shards)]
+
+    def __len__(self):
+        return len(self.workers)
+
+    def get_shard(self, auction_id) -> ShardWorker:
+        return self.workers[hash(auction_id) % len(self.workers)]
+
+    def call(self, auction_id, fn, *args, **kwargs):
+        """
+        Runs fn on the shard owning the auction and waits for its result. Calls made
+        from the owning shard itself run inline.
+        """
+        shard = self.get_shard(auction_id)
+
+        if shard.is_current:
+            return fn(*args, **kwargs)
+        return shard.submit(fn, *args, **kwargs).result()
+
+    def dispatch(self, auction_id, fn, *args, **kwargs):
+        """
+        Queues fn on the shard owning the auction without waiting for it.
+        """
+        future = self.get_shard(auction_id).submit(fn, *args, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+
+def _log_failure(future):
+    exception = future.exception()
+
+    if exception is not None:
+        logger.error('Dispatched shard command failed', exc_info=exception)
@@ -1,7 +1,8 @@
+import heapq
 from collections import defaultdict
 from decimal import Decimal
-from operator import itemgetter
-from threading import Timer
+from itertools import count
+from threading import RLock
 
 from bidpazari.core.exceptions import (
     BiddingErrorReason,
@@ -10,6 +11,7 @@ from bidpazari.core.exceptions import (
 )
 from bidpazari.core.helpers import serialize_user
 from bidpazari.core.models import Transaction
+from bidpazari.core.runtime.common import runtime_manager
 from bidpazari.core.templatetags.core.tags import money
 
 
@@ -17,13 +19,18 @@ class BaseBiddingStrategy:
     def __init__(self):
         self.bidders = set()
         self.bidding_history = []
+        # Balance reserved by each bidder for its bids in the auction
+        self.reservations = defaultdict(Decimal)
         self.auction = None
+        # Serializes bids, ticks and stops of the auction; see Auction.lock.
+        self.lock = RLock()
 
     def reserve_for_bid(self, bidder, amount):
         try:
             bidder.reserve_balance(amount)
         except InsufficientBalanceError:
             raise
+        self.reservations[bidder] += amount
 
     def start(self):
         pass
@@ -31,7 +38,32 @@ class BaseBiddingStrategy:
     def stop(self):
         self.auction.on_bidding_stopped()
 
+    def reopen(self):
+        """
+        Undoes stop(), when the auction is reopened after its settlement failed.
+        Reservations are only released by a settlement, so bidders still hold theirs.
+        """
+
+    def settle(self, winner):
+        """
+        Writes what the strategy adds to the settlement of the auction, within
+        Auction.settle.
+        """
+
+    def release_reservations(self):
+        """
+        Releases the balance reserved for the bids, once the settlement of the auction
+        has committed and the amounts paid have been taken from the balances.
+        """
+        with self.lock:
+            for bidder, amount in self.reservations.items():
+                if amount:
+                    bidder.unreserve_balance(amount)
+            self.reservations.clear()
+
     def bid(self, bidder, amount):
+        self.bidders.add(bidder)
+        self.bidding_history.append((bidder, amount))
         self.auction.log_event(
             f"{bidder.persistent_user.get_full_name()} made a bid: {amount}"
         )
@@ -39,8 +71,6 @@ class BaseBiddingStrategy:
             type="bid_received",
             data={'bidder': serialize_user(bidder.persistent_user), 'amount': amount},
         )
-        self.bidders.add(bidder)
-        self.bidding_history.append((bidder, amount))
 
     def get_current_winner_and_amount(self):
         raise NotImplementedError
@@ -65,8 +95,6 @@ class IncrementBiddingStrategy(BaseBiddingStrategy):
         self.maximum_price = maximum_price
         self.highest_bid = initial_price
         self.highest_bidder = None
-        # TODO Refactor this to be bidding_history itself.
-        self.bids_by_user = defaultdict(Decimal)
 
     def reserve_for_bid(self, bidder, amount):
         if amount < self.highest_bid:
@@ -74,35 +102,22 @@ class IncrementBiddingStrategy(BaseBiddingStrategy):
         if amount - self.highest_bid < self.minimum_increment:
             raise BiddingNotAllowed(BiddingErrorReason.InsufficientAmount)
 
-        super().reserve_for_bid(bidder, amount)
-
-    def stop(self):
-        for bidder in self.bidders:
-            amount = self.bids_by_user[bidder]
-            bidder.unreserve_balance(amount)
-            self.bids_by_user[bidder] = Decimal('0')
-
-        super().stop()
+        # The bidder's previous bid in this auction is released in the same step, so
+        # no other auction can claim the balance in between.
+        bidder.replace_reservation(self.reservations[bidder], amount)
+        self.reservations[bidder] = amount
 
     def bid(self, bidder: "RuntimeUser", amount):
-        past_bidding_amount = self.bids_by_user[bidder]
-        bidder.unreserve_balance(past_bidding_amount)
-        self.bids_by_user[bidder] = Decimal('0')
-
-        try:
+        with self.lock:
             self.reserve_for_bid(bidder, amount)
-        except:
-            bidder.reserve_balance(past_bidding_amount)
-            raise
 
-        super().bid(bidder, amount)  # log to bidding history
-        self.bids_by_user[bidder] += amount
-        # This must be the highest bid, since no other bids are allowed.
-        self.highest_bid = amount
-        self.highest_bidder = bidder
+            # This must be the highest bid, since no other bids are allowed.
+            self.highest_bid = amount
+            self.highest_bidder = bidder
+            super().bid(bidder, amount)  # log to bidding history and notify watchers
 
-        if self.maximum_price and self.maximum_price <= self.highest_bid:
-            self.stop()
+            if self.maximum_price and self.maximum_price <= self.highest_bid:
+                self.stop()
 
     def get_current_winner_and_amount(self):
         if self.highest_bidder:
@@ -146,9 +161,13 @@ class DecrementBiddingStrategy(BaseBiddingStrategy):
         self.price_decrement_rate = price_decrement_rate
         self.tick_ms = tick_ms
         self.tick_s = tick_ms / 1000
-        self.decrementing_thread = Timer(self.tick_s, self._decrement_price)
+        self.next_tick = None
 
     def _decrement_price(self):
+        with self.lock:
+            self._decrement_price_locked()
+
+    def _decrement_price_locked(self):
         from bidpazari.core.runtime.auction import AuctionStatus
 
         should_decrement = (self.auction.status == AuctionStatus.OPEN) and (
@@ -163,18 +182,44 @@ class DecrementBiddingStrategy(BaseBiddingStrategy):
                 type="price_decremented",
                 data={'current_price': self.get_current_price()},
             )
-            self.decrementing_thread = Timer(self.tick_s, self._decrement_price)
-            self.decrementing_thread.start()
+            self._schedule_tick()
         elif not self.auction.status == AuctionStatus.CLOSED:
             self.stop()
 
+    def _schedule_tick(self):
+        self.next_tick = runtime_manager.dispatch_later(
+            self.tick_s, self.auction.id, self._decrement_price
+        )
+
+    def _cancel_tick(self):
+        if self.next_tick is not None:
+            self.next_tick.cancel()
+            self.next_tick = None
+
     def start(self):
-        self.decrementing_thread.start()
+        self._schedule_tick()
+
+    def stop(self):
+        with self.lock:
+            self._cancel_tick()
+            super().stop()
+
+    def reopen(self):
+        with self.lock:
+            # The first bid wins and stops the auction, so it did not win after all.
+            if self.bidding_history:
+                bidder, amount = self.bidding_history.pop()
+                self.bidders.discard(bidder)
+                del self.reservations[bidder]
+                bidder.unreserve_balance(amount)
+
+            self._schedule_tick()
 
     def bid(self, bidder, amount=None):
-        self.reserve_for_bid(bidder, self.get_current_price())
-        super().bid(bidder, self.get_current_price())
-        self.stop()
+        with self.lock:
+            self.reserve_for_bid(bidder, self.get_current_price())
+            super().bid(bidder, self.get_current_price())
+            self.stop()
 
     def get_current_winner_and_amount(self):
         if len(self.bidding_history) == 1:
@@ -200,12 +245,55 @@ class DecrementBiddingStrategy(BaseBiddingStrategy):
         }
 
 
+class ContributionLeaderboard:
+    """
+    Running contribution totals of the bidders, with a heap to find the highest one
+    in O(log n). Raising a total pushes a new heap entry; outdated entries are dropped
+    when they reach the top. Ties go to the bidder who contributed first.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.first_contributions = {}
+        self.heap = []
+        self.pushes = count()
+
+    def add(self, bidder, amount):
+        total = self.totals.get(bidder, Decimal(0)) + amount
+        self.totals[bidder] = total
+        first = self.first_contributions.setdefault(
+            bidder, len(self.first_contributions)
+        )
+        heapq.heappush(self.heap, (-total, first, next(self.pushes), bidder))
+
+        if len(self.heap) > 2 * len(self.totals) + 64:
+            self.compact()
+
+    def get_highest(self):
+        while self.heap:
+            negative_total, _, _, bidder = self.heap[0]
+
+            if self.totals[bidder] == -negative_total:
+                return bidder, -negative_total
+            heapq.heappop(self.heap)
+
+        return None, None
+
+    def compact(self):
+        self.heap = [
+            (-total, self.first_contributions[bidder], next(self.pushes), bidder)
+            for bidder, total in self.totals.items()
+        ]
+        heapq.heapify(self.heap)
+
+
 class HighestContributionBiddingStrategy(BaseBiddingStrategy):
     def __init__(self, minimum_bid_amount=Decimal(1.0), maximum_price=None):
         super().__init__()
         self.minimum_bid_amount = minimum_bid_amount
         self.maximum_price = maximum_price
         self.current_price = Decimal(0.0)
+        self.leaderboard = ContributionLeaderboard()
 
     def reserve_for_bid(self, bidder, amount):
         if amount < self.minimum_bid_amount:
@@ -214,50 +302,40 @@ class HighestContributionBiddingStrategy(BaseBiddingStrategy):
         super().reserve_for_bid(bidder, amount)
 
     def bid(self, bidder, amount):
-        self.reserve_for_bid(bidder, amount)
+        with self.lock:
+            self.reserve_for_bid(bidder, amount)
 
-        self.current_price += amount
+            self.current_price += amount
+            self.leaderboard.add(bidder, amount)
 
-        super().bid(bidder, amount)
+            super().bid(bidder, amount)
 
-        if self.current_price >= self.maximum_price:
-            self.stop()
+            if self.current_price >= self.maximum_price:
+                self.stop()
 
-    def stop(self):
+    def settle(self, winner):
+        # Losers pay their contributions too, all in a single insert
         totals = self.totals_per_bidder
+        totals.pop(winner, None)
 
-        if totals:
-            highest_bidder, _ = max(self.totals_per_bidder.items(), key=itemgetter(1))
-            totals.pop(highest_bidder)
-
-            for loser, lost_amount in totals.items():
-                Transaction.objects.create(
+        Transaction.create_many(
+            [
+                Transaction(
                     source=loser.persistent_user,
                     destination=self.auction.owner,
                     amount=lost_amount,
                     item=self.auction.item,
                 )
-
-        super().stop()
+                for loser, lost_amount in totals.items()
+            ]
+        )
 
     @property
     def totals_per_bidder(self):
-        if not self.bidding_history:
-            return {}
-
-        totals = defaultdict(Decimal)
-
-        for bidder, amount in self.bidding_history:
-            totals[bidder] += amount
-
-        return dict(totals)
+        return dict(self.leaderboard.totals)
 
     def get_current_winner_and_amount(self):
-        if not self.bidding_history:
-            return None, None
-
-        highest_bidder, amount = max(self.totals_per_bidder.items(), key=itemgetter(1))
-        return highest_bidder, amount
+        return self.leaderboard.get_highest()
 
     def get_current_price(self):
         return self.current_price
@@ -1,6 +1,8 @@
 from decimal import Decimal
-from functools import wraps
+from functools import partial, wraps
+from threading import RLock
 
+from django.db.transaction import on_commit
 from django.utils.functional import cached_property
 
 from bidpazari.core.exceptions import (
@@ -10,6 +12,7 @@ from bidpazari.core.exceptions import (
 from bidpazari.core.models import User, UserHasItem
 from bidpazari.core.runtime.common import runtime_manager
 from bidpazari.core.runtime.exceptions import ItemAlreadyOnSale
+from bidpazari.core.runtime.money import parse_amount
 from bidpazari.core.runtime.watchers import ItemWatcher
 
 
@@ -35,6 +38,8 @@ class RuntimeUser:
         self.persistent_user = None
         self.initial_balance = Decimal(0)
         self.reserved_balance = Decimal(0)
+        # Guards reserved_balance. Acquired after an auction's lock, never before it.
+        self.balance_lock = RLock()
 
     """
     Persistence methods
@@ -97,7 +102,14 @@ class RuntimeUser:
     @persistent_user_proxy_method
     def add_balance_transaction(self, amount):
         self.persistent_user.add_balance(amount)
-        self.initial_balance = self.persistent_user.balance
+
+        # Online users get the change through balances_updated, like any other.
+        if runtime_manager.get_user_by_id(self.id) is not self:
+            on_commit(partial(self.apply_balance_delta, parse_amount(amount)))
+
+    def apply_balance_delta(self, delta):
+        with self.balance_lock:
+            self.initial_balance += delta
 
     @property
     @persistent_user_proxy_method
@@ -105,32 +117,63 @@ class RuntimeUser:
         return self.persistent_user.transaction_history
 
     @staticmethod
-    def register_item_watcher(callback_method, item_type=None):
-        item_watcher = ItemWatcher(callback_method, item_type=item_type)
+    def register_item_watcher(callback_method, item_type=None, is_alive=None):
+        item_watcher = ItemWatcher(
+            callback_method, item_type=item_type, is_alive=is_alive
+        )
         runtime_manager.register_item_watcher(item_watcher)
+        return item_watcher
 
     @property
     def reservable_balance(self):
         return self.initial_balance - self.reserved_balance
 
     def reserve_balance(self, amount):
-        if amount > self.reservable_balance:
-            raise InsufficientBalanceError("Amount is higher than reservable balance.")
-        self.reserved_balance += amount
+        with self.balance_lock:
+            if amount > self.reservable_balance:
+                raise InsufficientBalanceError(
+                    "Amount is higher than reservable balance."
+                )
+            self.reserved_balance += amount
 
     def unreserve_balance(self, amount):
-        if amount > self.reserved_balance:
-            raise InsufficientBalanceError("Amount is higher than reserved balance.")
-        self.reserved_balance -= amount
+        with self.balance_lock:
+            if amount > self.reserved_balance:
+                raise InsufficientBalanceError(
+                    "Amount is higher than reserved balance."
+                )
+            self.reserved_balance -= amount
+
+        if not self.reserved_balance:
+            runtime_manager.online_users.release(self)
+
+    def replace_reservation(self, old_amount, new_amount):
+        """
+        Atomically swaps a reservation of old_amount for one of new_amount. Nothing
+        changes if the bidder cannot afford the difference.
+        """
+        with self.balance_lock:
+            if old_amount > self.reserved_balance:
+                raise InsufficientBalanceError(
+                    "Amount is higher than reserved balance."
+                )
+            if new_amount - old_amount > self.reservable_balance:
+                raise InsufficientBalanceError(
+                    "Amount is higher than reservable balance."
+                )
+            self.reserved_balance += new_amount - old_amount
 
     def unreserve_all(self):
-        self.reserved_balance = Decimal(0)
+        with self.balance_lock:
+            self.reserved_balance = Decimal(0)
+
+        runtime_manager.online_users.release(self)
 
     def connect(self):
-        runtime_manager.online_users.add(self)
+        runtime_manager.online_users.connect(self)
 
     def disconnect(self):
-        runtime_manager.online_users.remove(self)
+        runtime_manager.online_users.disconnect(self)
 
     def __hash__(self):
         return self.id
@@ -1,10 +1,32 @@
+import threading
+
+
 class Watcher:
-    pass
+    """
+    Subscription handle returned when registering a watcher. A cancelled watcher is
+    not notified anymore, and is dropped by whoever notifies it. `is_alive` may tell
+    whether the subscriber is still there (e.g. its connection is open); once it
+    returns False, the watcher cancels itself.
+    """
+
+    def __init__(self, callback_method, is_alive=None):
+        self.callback_method = callback_method
+        self.is_alive = is_alive
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def active(self):
+        if not self.cancelled and self.is_alive is not None and not self.is_alive():
+            self.cancel()
+        return not self.cancelled
 
 
 class ItemWatcher(Watcher):
-    def __init__(self, callback_method, item_type=None):
-        self.callback_method = callback_method
+    def __init__(self, callback_method, item_type=None, is_alive=None):
+        super().__init__(callback_method, is_alive=is_alive)
         self.item_type = item_type
 
     def notify(self, auction):
@@ -15,8 +37,63 @@ class ItemWatcher(Watcher):
 
 
 class AuctionWatcher(Watcher):
-    def __init__(self, callback_method):
-        self.callback_method = callback_method
-
     def notify(self, *args, **kwargs):
         self.callback_method(*args, **kwargs)
+
+
+class ItemWatcherIndex:
+    """
+    Item watchers grouped by the item type they watch, so that announcing an auction
+    only touches the watchers of its item type and those watching every type (kept
+    under None). Buckets are dicts used as insertion-ordered sets.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets.values())
+
+    def __iter__(self):
+        with self.lock:
+            watchers = [w for bucket in self.buckets.values() for w in bucket]
+        return iter(watchers)
+
+    def add(self, item_watcher: ItemWatcher):
+        with self.lock:
+            bucket = self.buckets.setdefault(item_watcher.item_type or None, {})
+            bucket[item_watcher] = None
+
+    def discard(self, item_watcher: ItemWatcher):
+        key = item_watcher.item_type or None
+
+        with self.lock:
+            bucket = self.buckets.get(key, {})
+            bucket.pop(item_watcher, None)
+
+            if not bucket:
+                self.buckets.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def get_matching(self, item_type):
+        """
+        Returns the active watchers of the item type, and drops the inactive ones.
+        """
+        with self.lock:
+            watchers = list(self.buckets.get(None, ()))
+            if item_type:
+                watchers.extend(self.buckets.get(item_type, ()))
+
+        active_watchers = []
+        for item_watcher in watchers:
+            if item_watcher.active:
+                active_watchers.append(item_watcher)
+            else:
+                self.discard(item_watcher)
+
+        return active_watchers
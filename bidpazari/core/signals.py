@@ -1,26 +1,25 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from bidpazari.core.helpers import construct_verification_url
-from bidpazari.core.models import Transaction, User
+from bidpazari.core.models import User, balances_updated
 from bidpazari.core.runtime.common import runtime_manager
 
 
-@receiver(
-    post_save, sender=Transaction, dispatch_uid="update_balances_of_runtime_users"
-)
-def update_balances_of_runtime_users(sender, instance: Transaction, **kwargs):
-    if not kwargs["created"]:
-        return
+@receiver(balances_updated, dispatch_uid="update_balances_of_runtime_users")
+def update_balances_of_runtime_users(sender, deltas, **kwargs):
+    runtime_manager.apply_balance_deltas(deltas)
+
+
+@receiver(user_logged_in, dispatch_uid="connect_runtime_user")
+def connect_runtime_user(sender, request, user, **kwargs):
+    runtime_manager.connect_session(request.session.session_key, user)
 
-    source_user = instance.source
-    destination_user = instance.destination
 
-    for user in runtime_manager.online_users:
-        if source_user and user.id == source_user.id:
-            user.initial_balance = source_user.balance
-        elif user.id == destination_user.id:
-            user.initial_balance = destination_user.balance
+@receiver(user_logged_out, dispatch_uid="disconnect_runtime_user")
+def disconnect_runtime_user(sender, request, user, **kwargs):
+    runtime_manager.disconnect_session(request.session.session_key)
 
 
 @receiver(post_save, sender=User, dispatch_uid="send_registration_email")
@@ -3,7 +3,7 @@ from time import sleep
 from unittest import skip
 from unittest.mock import Mock, call, patch
 
-from django.test import TestCase, override_settings
+from django.test import TransactionTestCase, override_settings
 
 from bidpazari.core.exceptions import (
     BiddingErrorReason,
@@ -18,7 +18,7 @@ from bidpazari.core.runtime.user import RuntimeUser
 
 
 @override_settings(EMAIL_BACKEND="django.core.mail.backends.console.EmailBackend")
-class UserTestCase(TestCase):
+class UserTestCase(TransactionTestCase):
     def test_all(self):
         user = RuntimeUser(
             username="BillieJean",
@@ -138,7 +138,7 @@ class UserTestCase(TestCase):
 
 
 @override_settings(EMAIL_BACKEND="django.core.mail.backends.console.EmailBackend")
-class BiddingTestCase(TestCase):
+class BiddingTestCase(TransactionTestCase):
     def test_increment_bidding_happy_path(self):
         john = RuntimeUser(
             username="john1144",
@@ -1,23 +1,81 @@
+import asyncio
+import json
+import os
+import tempfile
 from decimal import Decimal
+from io import StringIO
+from queue import Queue
+from threading import Event, Lock, Thread, current_thread
 from time import sleep
-from unittest.mock import Mock
+from unittest import skipUnless
+from unittest.mock import Mock, patch
 
-from django.test import TestCase
+import websockets
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError
+from django.db.transaction import atomic
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
 
+from bidpazari.core.benchmarks import (
+    bid_stress,
+    make_auction,
+    make_runtime_user,
+    money,
+)
 from bidpazari.core.exceptions import (
     BiddingErrorReason,
     BiddingNotAllowed,
     InsufficientBalanceError,
 )
+from bidpazari.core.models import Item, Transaction, User, UserHasItem
+from bidpazari.core.runtime.activity import ActivityLog
+from bidpazari.core.runtime.archive import ArchivedAuctionView
+from bidpazari.core.runtime.auction import AuctionStatus
+from bidpazari.core.runtime.backends import (
+    BrokerAuctionBackend,
+    BrokerClient,
+    LocalAuctionBackend,
+    RemoteAuction,
+)
+from bidpazari.core.runtime.broker import BROKER_METHODS, BrokerServer
+from bidpazari.core.runtime.common import RuntimeManager, runtime_manager
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
+from bidpazari.core.runtime.exceptions import AuctionDoesNotExist, BrokerError
+from bidpazari.core.runtime.money import from_cents, parse_amount, to_cents
+from bidpazari.core.runtime.net.broadcast import (
+    AuctionBroadcast,
+    get_auction_broadcast,
+)
+from bidpazari.core.runtime.net.codecs import CODECS, get_codec
+from bidpazari.core.runtime.net.constants import CommandCode
+from bidpazari.core.runtime.net.decorators import command, login_required
+from bidpazari.core.runtime.net.metrics import command_latency
+from bidpazari.core.runtime.net.protocol import COMMANDS, CommandContext
+from bidpazari.core.runtime.net.websocket import (
+    CommandPipeline,
+    ServerState,
+    serve_pazar_ws,
+)
+from bidpazari.core.runtime.online import OnlineUsers
+from bidpazari.core.runtime.scheduler import Scheduler
+from bidpazari.core.runtime.settlement import (
+    SettlementPool,
+    after_settlement,
+    settlement,
+)
+from bidpazari.core.runtime.shards import ShardPool
 from bidpazari.core.runtime.strategies import (
+    ContributionLeaderboard,
     DecrementBiddingStrategy,
     HighestContributionBiddingStrategy,
     IncrementBiddingStrategy,
 )
 from bidpazari.core.runtime.user import RuntimeUser
+from bidpazari.core.runtime.watchers import ItemWatcher, ItemWatcherIndex
 
 
-class IncrementBiddingStrategyTestCase(TestCase):
+class IncrementBiddingStrategyTestCase(TransactionTestCase):
     def test_bid_success(self):
         strategy = IncrementBiddingStrategy(initial_price=Decimal(3.00))
         strategy.auction = Mock()
@@ -122,7 +180,7 @@ class IncrementBiddingStrategyTestCase(TestCase):
         )
 
 
-class DecrementBiddingStrategyTestCase(TestCase):
+class DecrementBiddingStrategyTestCase(TransactionTestCase):
     def test_get_current_winner(self):
         tick_ms = 10
         strategy = DecrementBiddingStrategy(initial_price=Decimal(5), tick_ms=tick_ms)
@@ -157,7 +215,7 @@ class DecrementBiddingStrategyTestCase(TestCase):
         strategy.stop()
 
 
-class HighestContributionBiddingStrategyTestCase(TestCase):
+class HighestContributionBiddingStrategyTestCase(TransactionTestCase):
     def test_bid_less_than_minimum_bid_amount_fails(self):
         strategy = HighestContributionBiddingStrategy(minimum_bid_amount=Decimal(5))
         strategy.auction = Mock()
@@ -247,3 +305,1108 @@ class HighestContributionBiddingStrategyTestCase(TestCase):
         self.assertEqual(
             strategy.get_current_winner_and_amount(), (bidder_1, Decimal(60))
         )
+
+    def test_losers_are_settled_in_bulk(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        owner.persist()
+        bidders = []
+        for name in ('alice', 'bob', 'carol'):
+            bidder = RuntimeUser(name, f'{name}@bidpazari.local', name, name, 'Doe')
+            bidder.persist()
+            bidder.add_balance_transaction(Decimal(100))
+            bidders.append(bidder)
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi,
+            'highest_contribution',
+            minimum_bid_amount=Decimal(1),
+            maximum_price=Decimal(1000),
+        )
+        auction.start()
+        for bidder, amount in zip(bidders, (10, 30, 20)):
+            auction.bid(bidder, Decimal(amount))
+
+        with patch.object(
+            Transaction.objects, 'create', wraps=Transaction.objects.create
+        ) as create:
+            auction.stop()
+
+        # Only the winner's transaction is created on its own
+        create.assert_called_once()
+        owner.persistent_user.refresh_from_db()
+        self.assertEqual(owner.persistent_user.balance, Decimal(60))
+        for bidder, balance in zip(bidders, (90, 70, 80)):
+            bidder.persistent_user.refresh_from_db()
+            self.assertEqual(bidder.persistent_user.balance, Decimal(balance))
+
+    def test_leaderboard_ties_go_to_first_contributor(self):
+        leaderboard = ContributionLeaderboard()
+        self.assertEqual(leaderboard.get_highest(), (None, None))
+
+        leaderboard.add('alice', Decimal(10))
+        leaderboard.add('bob', Decimal(5))
+        leaderboard.add('bob', Decimal(5))
+        self.assertEqual(leaderboard.get_highest(), ('alice', Decimal(10)))
+
+        leaderboard.add('bob', Decimal(1))
+        self.assertEqual(leaderboard.get_highest(), ('bob', Decimal(11)))
+
+        # Enough raises to compact the heap
+        for _ in range(100):
+            leaderboard.add('alice', Decimal(1))
+        self.assertLess(len(leaderboard.heap), 100)
+        self.assertEqual(leaderboard.get_highest(), ('alice', Decimal(110)))
+        self.assertEqual(
+            leaderboard.totals, {'alice': Decimal(110), 'bob': Decimal(11)}
+        )
+
+
+class SchedulerTestCase(TestCase):
+    def test_calls_run_in_deadline_order(self):
+        scheduler = Scheduler()
+        calls = []
+        done = Event()
+
+        scheduler.call_later(0.03, lambda: (calls.append(3), done.set()))
+        scheduler.call_later(0.01, calls.append, 1)
+        scheduler.call_later(0.02, calls.append, 2)
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_cancelled_call_does_not_run(self):
+        scheduler = Scheduler()
+        calls = []
+        done = Event()
+
+        cancelled = scheduler.call_later(0.01, calls.append, 'cancelled')
+        scheduler.call_later(0.02, done.set)
+        cancelled.cancel()
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, [])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_auction_commands_do_not_run_on_the_scheduler_thread(self):
+        manager = RuntimeManager(backend=LocalAuctionBackend())
+        threads = Queue()
+
+        manager.dispatch_later(0, 1, lambda: threads.put(current_thread()))
+
+        self.assertIsNot(threads.get(timeout=1), manager.scheduler.thread)
+
+
+class AuctionBroadcastTestCase(TestCase):
+    def test_event_is_encoded_once_for_all_subscribers(self):
+        auction = Mock()
+        auction.get_state.return_value = {
+            'id': 1,
+            'seq': 1,
+            'status': 'OPEN',
+            'current_price': Decimal(5),
+            'winner': None,
+            'winning_amount': None,
+        }
+        broadcast = AuctionBroadcast(auction)
+        outboxes = [Mock(codec=get_codec('json'), closed=False) for _ in range(3)]
+
+        for outbox in outboxes:
+            broadcast.subscribe(outbox)
+
+        auction.register_user_to_updates.assert_called_once_with(broadcast.notify)
+
+        broadcast.notify(type="price_decremented", data={'current_price': Decimal(5)})
+
+        frame = outboxes[0].push.call_args[0][0]
+        self.assertEqual(
+            json.loads(frame)['result'],
+            {
+                'id': 1,
+                'seq': 1,
+                'changes': {
+                    'status': 'OPEN',
+                    'current_price': '5',
+                    'winner': None,
+                    'winning_amount': None,
+                },
+            },
+        )
+        for outbox in outboxes:
+            outbox.push.assert_called_once()
+            self.assertIs(outbox.push.call_args[0][0], frame)
+
+    def test_relisted_auction_gets_its_own_broadcast(self):
+        closed_auction, relisted_auction = Mock(id=1), Mock(id=1)
+        broadcast = get_auction_broadcast(closed_auction)
+
+        self.assertIs(get_auction_broadcast(closed_auction), broadcast)
+        relisted_broadcast = get_auction_broadcast(relisted_auction)
+        self.assertIs(relisted_broadcast.auction, relisted_auction)
+        relisted_auction.register_user_to_updates.assert_called_once_with(
+            relisted_broadcast.notify
+        )
+
+
+class ConcurrentBiddingTestCase(TestCase):
+    def test_no_lost_updates(self):
+        report = bid_stress(auctions=4, users=16, threads=8, bids_per_thread=250)
+
+        self.assertEqual(report['violations'], [])
+        self.assertEqual(report['accepted'] + report['rejected'], report['bids'])
+
+
+class ShardPoolTestCase(TestCase):
+    def test_commands_of_an_auction_run_in_order_on_one_shard(self):
+        shards = ShardPool(4)
+        calls = []
+
+        for i in range(100):
+            shards.dispatch(7, calls.append, i)
+        shards.call(7, lambda: None)
+
+        self.assertEqual(calls, list(range(100)))
+
+    def test_nested_calls_run_inline_and_errors_propagate(self):
+        shards = ShardPool(2)
+
+        def outer():
+            return shards.call(3, lambda: shards.get_shard(3).is_current)
+
+        self.assertTrue(shards.call(3, outer))
+        with self.assertRaises(ZeroDivisionError):
+            shards.call(3, lambda: 1 / 0)
+
+
+class BrokerTestCase(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.address = address = os.path.join(directory, 'broker.sock')
+        self.server = BrokerServer(address, b'secret')
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        while self.server.listener is None:
+            sleep(0.01)
+        self.client = BrokerClient(address, b'secret')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_calls_are_served_and_errors_are_raised_in_the_client(self):
+        self.assertEqual(
+            [auction['id'] for auction in self.client.call('list_auctions')],
+            [auction.id for auction in runtime_manager.list_auctions()],
+        )
+
+        with self.assertRaises(AuctionDoesNotExist):
+            self.client.call('get_auction', 4242)
+
+    def test_errors_which_cannot_be_pickled_are_sent_as_broker_errors(self):
+        def fail():
+            raise ValueError(Lock())
+
+        with patch.dict(BROKER_METHODS, {'fail': fail}):
+            with self.assertRaises(BrokerError):
+                self.client.call('fail')
+
+        # The connection is still served
+        self.client.call('list_auctions')
+
+    def test_auction_updates_are_forwarded(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidder = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        owner.persist()
+        bidder.persist()
+        bidder.add_balance_transaction(Decimal(100))
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+
+        backend = BrokerAuctionBackend(self.address, b'secret')
+        remote_auction = backend.get(auction.id)
+        self.assertIs(backend.get(auction.id), remote_auction)
+        updates = Queue()
+        remote_auction.register_user_to_updates(lambda **kwargs: updates.put(kwargs))
+        auction.bid(bidder, Decimal(7))
+
+        self.assertEqual(updates.get(timeout=5)['type'], 'bid_received')
+        self.assertEqual(remote_auction.get_state(), auction.get_state())
+
+        with self.assertRaises(AuctionDoesNotExist):
+            RemoteAuction(
+                remote_auction.backend, {'id': 4242}
+            ).register_user_to_updates(Mock())
+
+    def test_balance_changes_reach_the_users_of_the_broker(self):
+        user = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        user.persist()
+        broker_user = runtime_manager.connect_user(user.persistent_user)
+        self.addCleanup(broker_user.disconnect)
+
+        manager = RuntimeManager(backend=BrokerAuctionBackend(self.address, b'secret'))
+        manager.apply_balance_deltas({user.id: Decimal(5)})
+
+        self.assertEqual(broker_user.initial_balance, Decimal(5))
+
+
+class BlockingCommandTestCase(TestCase):
+    def test_blocking_command_runs_outside_of_the_event_loop(self):
+        @login_required
+        def whoami(context):
+            return {'thread': current_thread().name}
+
+        handler = command("test_whoami", blocking=True)(whoami)
+        COMMANDS.pop("test_whoami")
+        loop = asyncio.new_event_loop()
+
+        try:
+            response = loop.run_until_complete(handler(Mock()))
+            anonymous_response = loop.run_until_complete(
+                handler(Mock(runtime_user=None))
+            )
+        finally:
+            loop.close()
+
+        self.assertTrue(response['result']['thread'].startswith('bidpazari-blocking'))
+        self.assertEqual(anonymous_response['code'], CommandCode.ERROR)
+        self.assertEqual(command_latency.summary()['test_whoami']['count'], 2)
+
+    def test_auction_lookups_run_outside_of_the_event_loop(self):
+        # Archived auctions are read from the database, remote ones from the broker
+        threads = []
+
+        def get_auction_by_id(auction_id):
+            threads.append(current_thread().name)
+            raise AuctionDoesNotExist(auction_id)
+
+        loop = asyncio.new_event_loop()
+        try:
+            with patch.object(runtime_manager, 'get_auction_by_id', get_auction_by_id):
+                for name in (
+                    'watch_auction',
+                    'view_auction_snapshot',
+                    'view_auction_report',
+                    'view_auction_history',
+                ):
+                    response = loop.run_until_complete(
+                        COMMANDS[name](Mock(), auction_id=4242)
+                    )
+                    self.assertEqual(response['code'], CommandCode.ERROR)
+        finally:
+            loop.close()
+
+        self.assertEqual(len(threads), 4)
+        self.assertTrue(all(name.startswith('bidpazari-blocking') for name in threads))
+
+
+class CommandPipelineTestCase(TestCase):
+    def test_requests_of_an_auction_keep_their_order(self):
+        @command("test_sleep")
+        async def sleep_command(context, auction_id, delay):
+            await asyncio.sleep(delay)
+            return {}
+
+        self.addCleanup(COMMANDS.pop, "test_sleep")
+        responses = []
+
+        class WebSocket:
+            async def send(self, frame):
+                responses.append(json.loads(frame)['request_id'])
+
+        async def run_pipeline():
+            pipeline = CommandPipeline(WebSocket(), context=CommandContext())
+            for request_id, auction_id, delay in [
+                ('a', 1, 0.05),
+                ('b', 2, 0),
+                ('c', 1, 0),
+                ('d', None, 0),
+                ('e', 2, 0),
+            ]:
+                await pipeline.submit(
+                    json.dumps(
+                        {
+                            'command': "test_sleep",
+                            'request_id': request_id,
+                            'params': {'auction_id': auction_id, 'delay': delay},
+                        }
+                    )
+                )
+            await pipeline.drain()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run_pipeline())
+        finally:
+            loop.close()
+
+        self.assertEqual(responses, ['b', 'a', 'c', 'd', 'e'])
+
+
+class ServerDrainTestCase(TestCase):
+    def test_running_commands_finish_before_the_connections_close(self):
+        @command("test_sleep")
+        async def sleep_command(context, delay):
+            await asyncio.sleep(delay)
+            return {}
+
+        self.addCleanup(COMMANDS.pop, "test_sleep")
+        server_state = ServerState()
+
+        async def run():
+            server = await serve_pazar_ws(host='127.0.0.1', port=0)
+            port = server.server.sockets[0].getsockname()[1]
+            client = await websockets.connect(f'ws://127.0.0.1:{port}/')
+            await client.send(
+                json.dumps({'command': "test_sleep", 'params': {'delay': 0.2}})
+            )
+            await asyncio.sleep(0.05)
+
+            drained = await server_state.drain(server, timeout=1)
+            response = json.loads(await client.recv())
+            server.close()
+            await server.wait_closed()
+
+            with self.assertRaises(websockets.ConnectionClosed):
+                await client.recv()
+            with self.assertRaises(OSError):
+                await websockets.connect(f'ws://127.0.0.1:{port}/')
+            return drained, response
+
+        loop = asyncio.new_event_loop()
+        try:
+            with patch(
+                'bidpazari.core.runtime.net.websocket.server_state', server_state
+            ):
+                drained, response = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        self.assertTrue(drained)
+        self.assertEqual(response['code'], CommandCode.OK)
+
+
+class BatchCommandTestCase(TestCase):
+    def test_batch_returns_the_response_of_every_command(self):
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(
+                COMMANDS['batch'](
+                    Mock(),
+                    commands=[
+                        {
+                            'command': 'view_server_metrics',
+                            'params': {},
+                            'request_id': 1,
+                        },
+                        {'command': 'batch', 'params': {'commands': []}},
+                        {'command': 'does_not_exist', 'params': {}},
+                    ],
+                )
+            )
+        finally:
+            loop.close()
+
+        results = response['result']['results']
+        self.assertEqual(
+            [result['code'] for result in results],
+            [CommandCode.OK, CommandCode.FATAL, CommandCode.FATAL],
+        )
+        self.assertEqual(results[0]['request_id'], 1)
+
+
+class CodecTestCase(TestCase):
+    def test_json_is_compact(self):
+        frame = get_codec('json').encode({'amount': Decimal('5.25'), 'ok': True})
+        self.assertEqual(frame, '{"amount":"5.25","ok":true}')
+        self.assertEqual(get_codec('json').parse_amount(5.25), Decimal('5.25'))
+
+    @skipUnless('msgpack' in CODECS, "msgpack is not installed")
+    def test_msgpack_sends_decimals_as_cents(self):
+        codec = get_codec('msgpack')
+        frame = codec.encode({'amount': Decimal('5.25')})
+
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual(codec.decode(frame), {'amount': 525})
+        self.assertEqual(codec.parse_amount(525), Decimal('5.25'))
+        with self.assertRaises(ValueError):
+            codec.decode('{"command": "login"}')
+
+
+class AuctionDeltaNotificationTestCase(TestCase):
+    def test_notifications_carry_seq_and_changed_fields(self):
+        owner = make_runtime_user(1)
+        bidder = make_runtime_user(2, balance=Decimal(100))
+        auction = make_auction(
+            1,
+            owner,
+            'increment',
+            initial_price=Decimal(5),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        outbox = Mock(codec=get_codec('json'), closed=False)
+        AuctionBroadcast(auction).subscribe(outbox)
+
+        auction.start()
+        auction.bid(bidder, Decimal(7))
+
+        started, bid_received = [
+            json.loads(push_call[0][0])['result']
+            for push_call in outbox.push.call_args_list
+        ]
+        self.assertEqual((started['seq'], bid_received['seq']), (1, 2))
+        self.assertEqual(
+            set(started['changes']),
+            {'status', 'current_price', 'winner', 'winning_amount'},
+        )
+        self.assertEqual(
+            set(bid_received['changes']), {'current_price', 'winner', 'winning_amount'}
+        )
+        self.assertEqual(auction.get_state()['seq'], 2)
+
+
+class AuctionViewCacheTestCase(TestCase):
+    def test_views_are_rendered_again_only_after_auction_events(self):
+        owner = make_runtime_user(1)
+        bidder = make_runtime_user(2, balance=Decimal(100))
+        auction = make_auction(
+            1,
+            owner,
+            'increment',
+            initial_price=Decimal(5),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        auction.start()
+        auction.render_django = Mock(wraps=auction.render_django)
+
+        first, second = auction.to_django(), auction.to_django()
+        self.assertEqual(auction.render_django.call_count, 1)
+        self.assertEqual(first, second)
+
+        auction.bid(bidder, Decimal(7))
+        view = auction.to_django()
+
+        self.assertEqual(auction.render_django.call_count, 2)
+        self.assertEqual(view['winning_amount'], Decimal(7))
+        self.assertEqual(
+            [activity['type'] for activity in view['activity']],
+            ['bid_received', 'auction_started'],
+        )
+
+
+class ActivityLogTestCase(TestCase):
+    def test_old_entries_are_archived_and_paged_back(self):
+        log = ActivityLog('test', capacity=4, segment_size=3)
+
+        for i in range(20):
+            log.append({'i': i})
+
+        self.assertEqual(len(log), 20)
+        self.assertLess(len(log.buffer), 4 + 3)
+        self.assertEqual(log.archived, 15)
+        self.assertEqual([e['i'] for e in log], list(range(20)))
+        self.assertEqual([e['i'] for e in log.page(0, 3)], [19, 18, 17])
+        self.assertEqual([e['i'] for e in log.page(3, 6)], [16, 15, 14, 13, 12, 11])
+        self.assertEqual([e['i'] for e in log.page(18, 5)], [1, 0])
+        self.assertEqual(log.page(20, 5), [])
+
+    def test_history_command_rejects_negative_offset_and_limit(self):
+        loop = asyncio.new_event_loop()
+        try:
+            responses = [
+                loop.run_until_complete(
+                    COMMANDS['view_auction_history'](Mock(), auction_id=1, **params)
+                )
+                for params in [{'offset': -1}, {'limit': -1}, {'offset': '1'}]
+            ]
+        finally:
+            loop.close()
+
+        for response in responses:
+            self.assertEqual(response['code'], CommandCode.ERROR)
+            self.assertIn(
+                "must be a non-negative integer", response['error']['message']
+            )
+
+
+class ArchivedAuctionTestCase(TransactionTestCase):
+    def test_closed_auction_is_served_from_the_archive(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidder = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        owner.persist()
+        bidder.persist()
+        bidder.add_balance_transaction(Decimal(100))
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+        auction.bid(bidder, Decimal(7))
+        auction.sell()
+        report, history = auction.auction_report, auction.auction_history
+        activity = auction.get_activity()
+
+        runtime_manager.archive_auction(auction)
+        self.assertNotIn(auction, runtime_manager.list_auctions())
+
+        archived = runtime_manager.get_auction_by_id(uhi.id)
+        self.assertIsInstance(archived, ArchivedAuctionView)
+        self.assertEqual(archived.auction_report, report)
+        self.assertEqual(archived.auction_history, history)
+        self.assertEqual(
+            [entry['msg'] for entry in archived.get_activity()],
+            [entry['msg'] for entry in activity],
+        )
+        self.assertEqual(archived.get_state()['winning_amount'], Decimal(7))
+        self.assertEqual(archived.to_django()['owner'], owner.persistent_user)
+        with self.assertRaises(BiddingNotAllowed):
+            archived.bid(bidder, Decimal(8))
+
+    def test_relisted_auction_is_not_archived_with_the_closed_one(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        owner.persist()
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+        auction.sell()
+        relisted_auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(4), minimum_increment=Decimal(1)
+        )
+        self.addCleanup(runtime_manager.backend.remove, relisted_auction.id)
+
+        runtime_manager.archive_auction(auction)
+        self.assertIs(runtime_manager.get_auction_by_id(uhi.id), relisted_auction)
+
+        relisted_auction.start()
+        relisted_auction.sell()
+        state = relisted_auction.get_state()
+        runtime_manager.archive_auction(relisted_auction)
+        self.assertEqual(uhi.archived_auctions.count(), 2)
+        self.assertEqual(runtime_manager.get_auction_by_id(uhi.id).get_state(), state)
+
+
+class WatcherLifecycleTestCase(TestCase):
+    def test_subscriptions_are_cancelled_with_the_connection(self):
+        owner = make_runtime_user(1)
+        auction = make_auction(
+            9001,
+            owner,
+            'increment',
+            initial_price=Decimal(5),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        runtime_manager.backend.add(auction)
+        self.addCleanup(runtime_manager.backend.remove, auction.id)
+        outbox = Mock(codec=get_codec('json'), closed=False)
+        context = CommandContext(outbox=outbox, runtime_user=owner)
+
+        item_watcher_count = len(runtime_manager.item_watchers)
+        loop = asyncio.new_event_loop()
+        try:
+            watch_items, watch_auction = [
+                loop.run_until_complete(COMMANDS[name](context, **params))['result']
+                for name, params in [
+                    ('watch_items', {}),
+                    ('watch_auction', {'auction_id': auction.id}),
+                ]
+            ]
+            self.assertEqual(len(runtime_manager.item_watchers), item_watcher_count + 1)
+            loop.run_until_complete(
+                COMMANDS['unwatch'](
+                    context, subscription_id=watch_items['subscription_id']
+                )
+            )
+        finally:
+            loop.close()
+
+        broadcast = get_auction_broadcast(auction)
+        self.assertEqual(len(runtime_manager.item_watchers), item_watcher_count)
+        self.assertEqual(broadcast.outboxes, [outbox])
+        self.assertEqual(
+            list(context.subscriptions), [watch_auction['subscription_id']]
+        )
+
+        context.close()
+        self.assertEqual(broadcast.outboxes, [])
+
+    def test_closed_outboxes_are_pruned(self):
+        owner = make_runtime_user(1)
+        auction = make_auction(
+            1,
+            owner,
+            'increment',
+            initial_price=Decimal(5),
+            minimum_increment=Decimal(1),
+            maximum_price=None,
+        )
+        broadcast = AuctionBroadcast(auction)
+        open_outbox = Mock(codec=get_codec('json'), closed=False)
+        closed_outbox = Mock(codec=get_codec('json'), closed=True)
+        broadcast.subscribe(open_outbox)
+        broadcast.subscribe(closed_outbox)
+
+        auction.start()
+
+        self.assertEqual(broadcast.outboxes, [open_outbox])
+        open_outbox.push.assert_called_once()
+        closed_outbox.push.assert_not_called()
+
+
+class ItemWatcherIndexTestCase(TestCase):
+    def test_only_matching_watchers_are_returned(self):
+        index = ItemWatcherIndex()
+        wildcard = ItemWatcher(Mock())
+        kitchen = ItemWatcher(Mock(), item_type='Kitchen')
+        cancelled = ItemWatcher(Mock(), item_type='Kitchen')
+        clothing = ItemWatcher(Mock(), item_type='Clothing')
+
+        for item_watcher in (wildcard, kitchen, cancelled, clothing):
+            index.add(item_watcher)
+        cancelled.cancel()
+
+        self.assertEqual(index.get_matching('Kitchen'), [wildcard, kitchen])
+        self.assertEqual(index.get_matching(''), [wildcard])
+        self.assertEqual(len(index), 3)
+
+        index.discard(clothing)
+        self.assertEqual(list(index), [wildcard, kitchen])
+
+
+class OnlineUsersTestCase(TestCase):
+    def test_connections_share_a_runtime_user_until_the_last_one_is_gone(self):
+        online_users = OnlineUsers()
+        first, second = make_runtime_user(1), make_runtime_user(1)
+
+        self.assertIs(online_users.connect(first), first)
+        self.assertIs(online_users.connect(second, reuse=True), first)
+        self.assertIs(online_users.get(1), first)
+
+        online_users.disconnect(second)
+        self.assertIn(first, online_users)
+
+        online_users.disconnect(first)
+        online_users.disconnect(first)
+        self.assertIsNone(online_users.get(1))
+        self.assertEqual(len(online_users), 0)
+
+    def test_users_with_reservations_stay_until_they_are_released(self):
+        online_users = OnlineUsers()
+        user = make_runtime_user(1, balance=Decimal(10))
+
+        online_users.connect(user)
+        user.reserve_balance(Decimal(5))
+        online_users.disconnect(user)
+        self.assertIs(online_users.connect(make_runtime_user(1), reuse=True), user)
+        self.assertEqual(user.reservable_balance, Decimal(5))
+
+        online_users.disconnect(user)
+        user.unreserve_balance(Decimal(5))
+        online_users.release(user)
+        self.assertIsNone(online_users.get(1))
+
+    def test_web_logout_leaves_other_connections_online(self):
+        runtime_user = RuntimeUser('web', 'web@bidpazari.local', 'web', 'W', 'Eb')
+        runtime_user.persist()
+        user = runtime_user.persistent_user
+
+        patcher = patch.object(runtime_manager, 'online_users', OnlineUsers())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        websocket_user = runtime_manager.connect_user(user)
+        self.client.force_login(user)
+        self.client.get(reverse('logout'))
+        self.assertIs(runtime_manager.get_user_by_id(user.id), websocket_user)
+
+        websocket_user.disconnect()
+        self.assertIsNone(runtime_manager.get_user_by_id(user.id))
+
+    def test_web_sessions_without_requests_expire(self):
+        runtime_user = RuntimeUser('web', 'web@bidpazari.local', 'web', 'W', 'Eb')
+        runtime_user.persist()
+        user = runtime_user.persistent_user
+
+        patcher = patch.object(runtime_manager, 'online_users', OnlineUsers())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with patch.dict(RUNTIME_CONFIG, {'WEB_SESSION_TIMEOUT': 0.2}):
+            runtime_manager.connect_session('session', user)
+
+            # Each request of the session keeps it alive
+            for _ in range(3):
+                sleep(0.1)
+                runtime_manager.connect_session('session', user)
+            self.assertIsNotNone(runtime_manager.get_user_by_id(user.id))
+
+            sleep(0.4)
+            self.assertIsNone(runtime_manager.get_user_by_id(user.id))
+            self.assertNotIn('session', runtime_manager.web_sessions)
+
+
+class UserBalanceTestCase(TransactionTestCase):
+    def test_balance_follows_transactions_and_is_reconciled(self):
+        alice = User.objects.create_user('alice', 'alice@bidpazari.local', 'alice')
+        bob = User.objects.create_user('bob', 'bob@bidpazari.local', 'bob')
+        alice.add_balance(Decimal('10.50'))
+        Transaction.objects.create(source=alice, destination=bob, amount=Decimal(3))
+
+        self.assertEqual(alice.balance, Decimal('7.50'))
+        self.assertEqual(bob.balance, Decimal(3))
+        for user in (alice, bob):
+            user.refresh_from_db()
+            self.assertEqual(user.balance, user.ledger_balance)
+
+        User.objects.filter(id=bob.id).update(balance=Decimal(100))
+        with self.assertRaises(CommandError):
+            call_command('reconcilebalances', stderr=StringIO(), stdout=StringIO())
+        call_command(
+            'reconcilebalances', fix=True, stderr=StringIO(), stdout=StringIO()
+        )
+
+        bob.refresh_from_db()
+        self.assertEqual(bob.balance, Decimal(3))
+
+    def test_batched_transactions_update_online_users_once(self):
+        alice = User.objects.create_user('alice', 'alice@bidpazari.local', 'alice')
+        bob = User.objects.create_user('bob', 'bob@bidpazari.local', 'bob')
+        runtime_alice = RuntimeUser.from_persistent_user(alice)
+        runtime_alice.connect()
+        self.addCleanup(runtime_alice.disconnect)
+
+        with patch.object(
+            runtime_manager,
+            'apply_balance_deltas',
+            wraps=runtime_manager.apply_balance_deltas,
+        ) as apply_balance_deltas:
+            Transaction.create_many(
+                [
+                    Transaction(source=None, destination=alice, amount=Decimal(10)),
+                    Transaction(source=alice, destination=bob, amount=Decimal(2)),
+                    Transaction(source=alice, destination=bob, amount=Decimal(3)),
+                ]
+            )
+
+        apply_balance_deltas.assert_called_once_with({alice.id: 5, bob.id: 5})
+        self.assertEqual(runtime_alice.initial_balance, Decimal(5))
+        bob.refresh_from_db()
+        self.assertEqual(bob.balance, Decimal(5))
+
+    def test_deposit_keeps_the_changes_made_through_other_instances(self):
+        runtime_alice = RuntimeUser('alice', 'alice@bidpazari.local', 'alice', 'A', 'L')
+        runtime_alice.persist()
+        runtime_alice.connect()
+        self.addCleanup(runtime_alice.disconnect)
+        runtime_alice.add_balance_transaction(Decimal(100))
+
+        User.objects.get(id=runtime_alice.id).add_balance(Decimal(50))
+        runtime_alice.add_balance_transaction(Decimal(10))
+
+        self.assertEqual(runtime_alice.initial_balance, Decimal(160))
+        self.assertEqual(User.objects.get(id=runtime_alice.id).balance, Decimal(160))
+
+    def test_saving_an_outdated_user_keeps_its_balance(self):
+        alice = User.objects.create_user('alice', 'alice@bidpazari.local', 'alice')
+        User.objects.get(id=alice.id).add_balance(Decimal(50))
+
+        alice.change_password('secret', old_password='alice')
+
+        self.assertEqual(alice.balance, Decimal(0))
+        self.assertIn("Your Balance: 50.00", alice.transaction_history)
+        alice.refresh_from_db()
+        self.assertEqual(alice.balance, Decimal(50))
+        self.assertTrue(alice.check_password('secret'))
+
+    def test_balances_are_updated_once_transactions_commit(self):
+        alice = User.objects.create_user('alice', 'alice@bidpazari.local', 'alice')
+        runtime_alice = RuntimeUser.from_persistent_user(alice)
+        runtime_alice.connect()
+        self.addCleanup(runtime_alice.disconnect)
+
+        with self.assertRaises(DatabaseError):
+            with atomic():
+                alice.add_balance(Decimal(10))
+                raise DatabaseError
+
+        self.assertEqual(alice.balance, Decimal(0))
+        self.assertEqual(runtime_alice.initial_balance, Decimal(0))
+
+        with atomic():
+            alice.add_balance(Decimal(10))
+            self.assertEqual(runtime_alice.initial_balance, Decimal(0))
+
+        self.assertEqual(alice.balance, Decimal(10))
+        self.assertEqual(runtime_alice.initial_balance, Decimal(10))
+
+
+class SettlementTestCase(TransactionTestCase):
+    def test_failed_settlement_leaves_the_auction_open(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidder = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        owner.persist()
+        bidder.persist()
+        bidder.add_balance_transaction(Decimal(100))
+        bidder.connect()
+        self.addCleanup(bidder.disconnect)
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+        auction.bid(bidder, Decimal(7))
+        callback = Mock()
+        auction.register_user_to_updates(callback)
+
+        with patch.object(Item, 'save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                auction.sell()
+
+        self.assertEqual(auction.status, AuctionStatus.OPEN)
+        self.assertFalse(Transaction.objects.filter(item=item).exists())
+        self.assertEqual(UserHasItem.objects.filter(item=item).count(), 1)
+        self.assertEqual(bidder.initial_balance, Decimal(100))
+        self.assertEqual(bidder.reservable_balance, Decimal(93))
+        self.assertEqual(
+            auction.bidding_strategy.get_current_winner_and_amount(),
+            (bidder, Decimal(7)),
+        )
+        self.assertNotIn("Auction stopped", auction.auction_history)
+        callback.assert_not_called()
+
+        auction.sell()
+        self.assertEqual(auction.status, AuctionStatus.CLOSED)
+        self.assertEqual(auction.auction_history.count("Auction stopped"), 1)
+        self.assertEqual(bidder.initial_balance, Decimal(93))
+        self.assertEqual(bidder.reservable_balance, Decimal(93))
+        self.assertEqual(callback.call_args[1]['type'], 'auction_stopped')
+        uhi.refresh_from_db()
+        item.refresh_from_db()
+        self.assertTrue(uhi.is_sold)
+        self.assertFalse(item.on_sale)
+
+    def test_failed_settlement_undoes_the_winning_bid_of_a_decrement_auction(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidders = [
+            RuntimeUser(name, f'{name}@bidpazari.local', name, 'Bi', 'Dder')
+            for name in ('first', 'second')
+        ]
+        for user in (owner, *bidders):
+            user.persist()
+        for bidder in bidders:
+            bidder.connect()
+            self.addCleanup(bidder.disconnect)
+            bidder.add_balance_transaction(Decimal(100))
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi, 'decrement', initial_price=Decimal(50), tick_ms=60000
+        )
+        auction.start()
+        self.addCleanup(auction.bidding_strategy._cancel_tick)
+
+        with patch.object(Item, 'save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                auction.bid(bidders[0], None)
+
+        self.assertEqual(auction.status, AuctionStatus.OPEN)
+        self.assertEqual(bidders[0].reservable_balance, Decimal(100))
+        self.assertIsNotNone(auction.bidding_strategy.next_tick)
+
+        with patch.object(runtime_manager, 'schedule_archive'):
+            auction.bid(bidders[1], None)
+
+        self.assertEqual(auction.status, AuctionStatus.CLOSED)
+        self.assertEqual(
+            auction.bidding_strategy.get_current_winner_and_amount(),
+            (bidders[1], Decimal(50)),
+        )
+        self.assertEqual(bidders[1].initial_balance, Decimal(50))
+        self.assertEqual(bidders[1].reservable_balance, Decimal(50))
+
+    def test_settling_again_writes_nothing(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidder = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        owner.persist()
+        bidder.persist()
+        bidder.add_balance_transaction(Decimal(100))
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+        auction.bid(bidder, Decimal(7))
+        auction.sell()
+
+        seq = auction.seq
+        with patch.object(runtime_manager, 'schedule_archive') as schedule_archive:
+            auction.settle(bidder, Decimal(7))
+
+        schedule_archive.assert_not_called()
+        self.assertEqual(auction.seq, seq)
+        self.assertEqual(auction.auction_history.count("Auction stopped"), 1)
+        self.assertEqual(Transaction.objects.filter(item=item).count(), 1)
+        self.assertEqual(UserHasItem.objects.filter(item=item).count(), 2)
+        bidder.persistent_user.refresh_from_db()
+        self.assertEqual(bidder.persistent_user.balance, Decimal(93))
+
+    def test_side_effects_wait_for_the_outermost_transaction(self):
+        side_effect = Mock()
+
+        with self.assertRaises(DatabaseError):
+            with atomic():
+                with settlement():
+                    after_settlement(side_effect, 'rolled back')
+                raise DatabaseError
+
+        with atomic():
+            with settlement():
+                after_settlement(side_effect, 'committed')
+            side_effect.assert_not_called()
+
+        side_effect.assert_called_once_with('committed')
+
+    def test_pool_retries_failed_settlements(self):
+        scheduler = Scheduler()
+        pool = SettlementPool(2, scheduler, retries=2, retry_delay=0)
+        settled = Event()
+        outcomes = [DatabaseError, DatabaseError, None]
+
+        def settle_once_it_works(auction):
+            if outcomes.pop(0):
+                raise DatabaseError
+            settled.set()
+
+        settle = Mock(side_effect=settle_once_it_works)
+
+        with self.assertLogs('bidpazari.core.runtime.settlement', 'WARNING'):
+            pool.submit(settle, 'auction')
+            self.assertTrue(settled.wait(5))
+
+        self.assertEqual(settle.call_count, 3)
+        settle.assert_called_with('auction')
+
+    def test_winner_cannot_spend_its_bid_before_paying(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        bidder = RuntimeUser('bidder', 'bidder@bidpazari.local', 'bidder', 'Bi', 'Dder')
+        owner.persist()
+        bidder.persist()
+        bidder.connect()
+        self.addCleanup(bidder.disconnect)
+        bidder.add_balance_transaction(Decimal(100))
+        auctions = []
+
+        for title in ('Lamp', 'Chair'):
+            item = Item.objects.create(title=title, item_type='Furniture')
+            uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+            auction = runtime_manager.create_auction(
+                uhi, 'increment', initial_price=Decimal(5), maximum_price=Decimal(80)
+            )
+            auction.start()
+            auctions.append(auction)
+
+        settlements = Mock()
+        with patch.object(runtime_manager, 'settlements', settlements):
+            auctions[0].bid(bidder, Decimal(80))
+            with self.assertRaises(InsufficientBalanceError):
+                auctions[1].bid(bidder, Decimal(80))
+
+        fn, *args = settlements.submit.call_args[0]
+        with patch.object(runtime_manager, 'schedule_archive'):
+            fn(*args)
+
+        self.assertEqual(bidder.initial_balance, Decimal(20))
+        self.assertEqual(bidder.reservable_balance, Decimal(20))
+
+    def test_settlement_releases_the_reservations_of_every_bidder(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        owner.persist()
+        bidders = []
+
+        for name in ('winner', 'loser'):
+            bidder = RuntimeUser(name, f'{name}@bidpazari.local', name, 'Bi', 'Dder')
+            bidder.persist()
+            bidder.connect()
+            bidder.add_balance_transaction(Decimal(90))
+            bidders.append(bidder)
+        winner, loser = bidders
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+
+        auction = runtime_manager.create_auction(
+            uhi,
+            'highest_contribution',
+            minimum_bid_amount=Decimal(1),
+            maximum_price=Decimal(50),
+        )
+        auction.start()
+        auction.bid(loser, Decimal(10))
+        with patch.object(runtime_manager, 'schedule_archive'):
+            auction.bid(winner, Decimal(40))
+
+        self.assertEqual(loser.reservable_balance, Decimal(80))
+        self.assertEqual(winner.reservable_balance, Decimal(50))
+        for bidder in bidders:
+            bidder.disconnect()
+            self.assertIsNone(runtime_manager.get_user_by_id(bidder.id))
+
+    def test_auction_reopens_when_the_pool_gives_up(self):
+        owner = RuntimeUser('owner', 'owner@bidpazari.local', 'owner', 'Ow', 'Ner')
+        owner.persist()
+        item = Item.objects.create(title='Lamp', item_type='Furniture')
+        uhi = UserHasItem.objects.create(user=owner.persistent_user, item=item)
+        auction = runtime_manager.create_auction(
+            uhi, 'increment', initial_price=Decimal(5), minimum_increment=Decimal(1)
+        )
+        auction.start()
+        pool = SettlementPool(1, Scheduler(), retries=1, retry_delay=0)
+        reopened = Event()
+        reopen = auction.on_settlement_failed
+
+        def on_settlement_failed():
+            reopen()
+            reopened.set()
+
+        with patch.object(runtime_manager, 'settlements', pool), patch.object(
+            auction, 'on_settlement_failed', on_settlement_failed
+        ), patch.object(Item, 'save', side_effect=DatabaseError):
+            with self.assertLogs('bidpazari.core.runtime.settlement', 'WARNING'):
+                auction.sell()
+                self.assertTrue(reopened.wait(5))
+
+        self.assertEqual(auction.status, AuctionStatus.OPEN)
+        self.assertNotIn("Auction stopped", auction.auction_history)
+
+
+class MoneyTestCase(TestCase):
+    def test_amounts_are_read_to_the_cent(self):
+        self.assertEqual(to_cents(10.1), 1010)
+        self.assertEqual(to_cents(Decimal('10.10')), 1010)
+        self.assertEqual(to_cents('7'), 700)
+        self.assertEqual(to_cents(Decimal('0.125')), 12)
+        self.assertEqual(from_cents(1010), Decimal('10.10'))
+
+        amount = parse_amount(0.1 + 0.2)
+        self.assertEqual(amount, Decimal('0.30'))
+        self.assertEqual(str(amount), '0.30')
+        self.assertNotEqual(Decimal(0.1 + 0.2), amount)
+
+    def test_every_representation_notifies_the_same_amounts(self):
+        self.assertEqual(money(bids=1000)['violations'], [])
@@ -33,6 +33,7 @@ from bidpazari.core.helpers import get_auction_or_404
 from bidpazari.core.models import Item, Transaction, User, UserHasItem
 from bidpazari.core.runtime.auction import AuctionStatus
 from bidpazari.core.runtime.common import runtime_manager
+from bidpazari.core.runtime.constants import RUNTIME_CONFIG
 from bidpazari.core.runtime.exceptions import (
     InvalidAuctionStatus,
     ItemAlreadyOnSale,
@@ -136,8 +137,6 @@ class LoginView(DjangoLoginView):
 
 class LogoutView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
-        runtime_user = request.user.runtime_user
-        runtime_user.disconnect()
         logout(request)
         messages.add_message(request, messages.INFO, 'You have logged out.')
         return redirect(reverse('index'))
@@ -381,7 +380,7 @@ class AuctionsView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         auctions = []
-        for id_, auction in runtime_manager.auctions.items():
+        for auction in runtime_manager.list_auctions():
             if auction.status != AuctionStatus.CLOSED:
                 auctions.append(auction.to_django())
 
@@ -397,6 +396,21 @@ class AuctionDetailsView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         auction = get_auction_or_404(kwargs['pk'])
+        auction_dict = auction.to_django()
+
+        try:
+            activity_offset = max(0, int(self.request.GET.get('activity_offset', 0)))
+        except ValueError:
+            activity_offset = 0
+
+        if activity_offset:
+            auction_dict['activity'] = auction.get_activity(activity_offset)
+
+        activity_page_size = RUNTIME_CONFIG['RECENT_ACTIVITY_SIZE']
+        if activity_offset + activity_page_size < auction_dict['activity_count']:
+            activity_older_offset = activity_offset + activity_page_size
+        else:
+            activity_older_offset = None
 
         auction_is_initial = auction.status == AuctionStatus.INITIAL
         auction_is_open = auction.status == AuctionStatus.OPEN
@@ -411,8 +425,10 @@ class AuctionDetailsView(LoginRequiredMixin, TemplateView):
             bid_form = None
 
         return {
-            'auction': auction.to_django(),
+            'auction': auction_dict,
             'auction_live_updates_args': {'auctionId': auction.id,},
+            'activity_offset': activity_offset,
+            'activity_older_offset': activity_older_offset,
             'auction_is_initial': auction_is_initial,
             'auction_is_open': auction_is_open,
             'auction_is_closed': auction_is_closed,
@@ -38,6 +38,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "bidpazari.core.middleware.WebSessionMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -134,5 +135,8 @@ WEBPACK_LOADER = {
     }
 }
 
+# Auction runtime, see bidpazari.core.runtime.constants for the available options
+BIDPAZARI_RUNTIME = {}
+
 # Crispy forms
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
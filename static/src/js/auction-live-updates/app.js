@@ -14,6 +14,38 @@ const liveUpdatesRoot = document.querySelector('#auction-live-updates-tbody');
 const liveUpdatesStatusRoot = document.querySelector('#auction-live-updates-status');
 const liveUpdatesPriceRoot = document.querySelector('#auction-live-updates-price');
 
+function formatMoney(amount) {
+  return `$${Number(amount).toFixed(2)}`;
+}
+
+function formatName(user) {
+  return `${user.first_name} ${user.last_name}`;
+}
+
+// Describes an auction notification, given its changes and the auction state before and
+// after it.
+function describeChanges(changes, state, previousState) {
+  if (changes.status === 'OPEN') {
+    return `Auction started. Current price is ${formatMoney(state.current_price)}.`;
+  } else if (changes.status === 'CLOSED') {
+    if (!state.winner) {
+      return 'Auction stopped. Nobody won.';
+    }
+    const amount = formatMoney(state.winning_amount);
+    return `Auction stopped. ${formatName(state.winner)} won with ${amount}.`;
+  } else if ('winning_amount' in changes && state.winner) {
+    return `${formatName(state.winner)} made a bid: ${formatMoney(state.winning_amount)}.`;
+  } else if ('current_price' in changes) {
+    // Bids which do not change the leader (e.g. of a highest contribution auction)
+    // raise the price, ticks of a decrement auction lower it.
+    const price = formatMoney(state.current_price);
+    return Number(state.current_price) > Number(previousState.current_price)
+      ? `A bid raised the price to ${price}.`
+      : `Price decremented to ${price}.`;
+  }
+  return null;
+}
+
 class AuctionLiveUpdatesStatus extends React.Component {
   constructor(props) {
     super(props);
@@ -81,6 +113,10 @@ class AuctionLiveUpdates extends React.Component {
   @observable feed = [];
   @observable currentPrice = null;
 
+  // Auction state, kept up to date with the changes of each notification. Not named
+  // `state`, which belongs to React.
+  auctionState = {};
+
   constructor(props) {
     super(props);
 
@@ -117,20 +153,45 @@ class AuctionLiveUpdates extends React.Component {
     };
 
     this.client.on.watch_auction = data => {
+      if (data.code === 0) {
+        this.updateAuctionState(data.result.auction);
+      }
+
       runInAction(() => {
         this.watching = true;
       });
     };
 
+    this.client.on.view_auction_snapshot = data => {
+      // Sent after missed notifications, the feed may lack their entries.
+      if (data.code === 0) {
+        this.updateAuctionState(data.result.state);
+      }
+    };
+
     this.client.on.notification_auction = data => {
-      runInAction(() => {
-        this.currentPrice = data.result.current_price;
-      });
+      const {changes} = data.result;
+      const previousState = this.auctionState;
+      this.updateAuctionState({...previousState, ...changes});
 
-      this.feed.unshift(data);
+      const message = describeChanges(changes, this.auctionState, previousState);
+
+      if (message) {
+        runInAction(() => {
+          this.feed.unshift({timestamp: data.timestamp, message});
+        });
+      }
     };
   }
 
+  updateAuctionState(state) {
+    this.auctionState = state;
+
+    runInAction(() => {
+      this.currentPrice = formatMoney(state.current_price);
+    });
+  }
+
   componentDidMount() {
     this.client.connect();
   }
@@ -147,7 +208,7 @@ class AuctionLiveUpdates extends React.Component {
             <AuctionLiveUpdatesRow
               key={index}
               timestamp={item.timestamp}
-              message={item.result.msg}
+              message={item.message}
             />
           ))}
       </>
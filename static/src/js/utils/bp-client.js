@@ -10,6 +10,9 @@ export default class Client {
 
   socket;
 
+  // Last seen sequence number of every watched auction
+  auctionSeq = {};
+
   on = {
     // Generic handlers
     open: null,
@@ -18,6 +21,7 @@ export default class Client {
     login: null,
     watch_auction: null,
     watch_items: null,
+    view_auction_snapshot: null,
     // Notifications
     notification_auction: null,
     notification_item: null,
@@ -72,6 +76,18 @@ export default class Client {
       case 'notification':
         this.onNotification(data);
         break;
+      case 'watch_auction':
+        if (data.code === 0) {
+          this.auctionSeq[data.result.auction.id] = data.result.auction.seq;
+        }
+        this.handleEvent(data.event, data);
+        break;
+      case 'view_auction_snapshot':
+        if (data.code === 0) {
+          this.auctionSeq[data.result.state.id] = data.result.state.seq;
+        }
+        this.handleEvent(data.event, data);
+        break;
       default:
         this.handleEvent(data.event, data);
         return;
@@ -192,6 +208,13 @@ export default class Client {
     });
   }
 
+  unwatch(subscription_id) {
+    // subscription_id: returned by watch_auction and watch_items
+    this._sendCommand('unwatch', {
+      subscription_id,
+    });
+  }
+
   viewAuctionReport(auction_id) {
     this._sendCommand('view_auction_report', {
       auction_id,
@@ -204,6 +227,19 @@ export default class Client {
     });
   }
 
+  viewAuctionSnapshot(auction_id) {
+    this._sendCommand('view_auction_snapshot', {
+      auction_id,
+    });
+  }
+
+  batch(commands) {
+    // commands: [{command, params}, ...]
+    this._sendCommand('batch', {
+      commands,
+    });
+  }
+
   /// EVENT HANDLERS ===============================================================================
 
   @action
@@ -227,10 +263,20 @@ export default class Client {
 
   @action
   onNotification(data) {
-    if (data.result.domain === 'auction') {
-      this.handleEvent('notification_auction', data);
-    } else if (data.result.domain === 'item') {
+    if (data.result.domain === 'item') {
       this.handleEvent('notification_item', data);
+    } else {
+      // Auction notifications: {id, seq, changes}
+      const {id, seq} = data.result;
+      const lastSeq = this.auctionSeq[id];
+      this.auctionSeq[id] = seq;
+
+      if (lastSeq !== undefined && seq > lastSeq + 1) {
+        // Some updates were missed, fetch the whole auction again.
+        this.viewAuctionSnapshot(id);
+      }
+
+      this.handleEvent('notification_auction', data);
     }
   }
 }